@@ -0,0 +1,89 @@
+import sys
+import time
+import numpy as np
+from reticade.frame_assembly import RawFrameAssembler
+
+"""
+Compares the per-frame cost of assembling raw PrairieView samples into an image
+with the original implementation (kept here for reference) and RawFrameAssembler.
+
+Usage: python -m reticade.benchmarks.frame_assembly_benchmark [samples per pixel] [frames]
+"""
+
+IMAGE_SIZE = (512, 512)
+NUM_CHUNKS_PER_FRAME = 4
+
+
+class LegacyFrameAssembler:
+    def __init__(self, image_size, samples_per_pixel):
+        self.image_size = image_size
+        self.num_samples_per_frame = image_size[0] * \
+            image_size[1] * samples_per_pixel
+        self.data_layout = (image_size[0], image_size[1], samples_per_pixel)
+        self.frame_storage = [np.ndarray(
+            self.num_samples_per_frame, dtype=np.int16) for _ in range(2)]
+        self.mem_offset = 0
+        self.frame_idx = 0
+
+    def add_samples(self, shared_array):
+        num_samples_written = len(shared_array)
+        got_frame = False
+        samples_copied = 0
+        while (samples_copied < num_samples_written):
+            samples_to_read = min(num_samples_written - samples_copied,
+                                  self.num_samples_per_frame - self.mem_offset)
+            self.frame_storage[self.frame_idx][self.mem_offset:self.mem_offset +
+                                               samples_to_read] = shared_array[samples_copied:samples_copied + samples_to_read]
+            if samples_to_read == self.num_samples_per_frame - self.mem_offset:
+                got_frame = True
+                self.frame_idx = (self.frame_idx + 1) % 2
+            self.mem_offset = (
+                self.mem_offset + samples_to_read) % self.num_samples_per_frame
+            samples_copied += samples_to_read
+        return got_frame
+
+    def assemble_into(self, destination):
+        reshaped = self.frame_storage[(
+            self.frame_idx + 1) % 2].reshape(self.data_layout)
+        reshaped = reshaped - 8192
+        reshaped[reshaped < 0] = 0
+        mean_over_samples = np.mean(reshaped, axis=2)
+        mean_over_samples[1::2] = mean_over_samples[1::2, ::-1]
+        destination[:, :] = mean_over_samples
+        return destination
+
+
+def make_chunks(samples_per_pixel, num_frames):
+    rng = np.random.default_rng(0)
+    samples_per_frame = IMAGE_SIZE[0] * IMAGE_SIZE[1] * samples_per_pixel
+    chunk_size = samples_per_frame // NUM_CHUNKS_PER_FRAME + 1
+    stream = rng.integers(0, 16384, size=samples_per_frame *
+                          num_frames, dtype=np.int16)
+    return [stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+
+
+def time_assembler(assembler, chunks, destination):
+    frames = 0
+    start = time.perf_counter()
+    for chunk in chunks:
+        # Copy, as the real stream buffer is overwritten between reads
+        if assembler.add_samples(np.copy(chunk)):
+            assembler.assemble_into(destination)
+            frames += 1
+    return (time.perf_counter() - start) / frames
+
+
+if __name__ == '__main__':
+    samples_per_pixel = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    num_frames = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    chunks = make_chunks(samples_per_pixel, num_frames)
+    print(
+        f"Assembling {num_frames} frames of {IMAGE_SIZE[0]}x{IMAGE_SIZE[1]}x{samples_per_pixel} samples, {NUM_CHUNKS_PER_FRAME} chunks per frame")
+    legacy_time = time_assembler(LegacyFrameAssembler(
+        IMAGE_SIZE, samples_per_pixel), chunks, np.zeros(IMAGE_SIZE))
+    print(f"Legacy (float64 output): {(legacy_time * 1000):.2f} ms/frame")
+    for dtype in [np.float64, np.float32, np.uint16]:
+        assembler_time = time_assembler(RawFrameAssembler(
+            IMAGE_SIZE, samples_per_pixel), chunks, np.zeros(IMAGE_SIZE, dtype=dtype))
+        print(
+            f"RawFrameAssembler ({np.dtype(dtype).name} output): {(assembler_time * 1000):.2f} ms/frame ({(legacy_time / assembler_time):.1f}x)")
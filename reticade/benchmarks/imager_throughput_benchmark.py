@@ -0,0 +1,40 @@
+import sys
+import logging
+from reticade.sapv_link import StandaloneImager
+from reticade.tests.tools.fake_prairie_link import FakePrairieLink
+
+"""
+Streams raw samples from a fake PrairieLink through StandaloneImager at several
+frame rates, and reports how many of the streamed frames were published.
+
+Usage: python -m reticade.benchmarks.imager_throughput_benchmark [seconds per rate] [samples per pixel]
+"""
+
+IMAGE_SIZE = (512, 512)
+FRAME_RATES_HZ = [30.0, 60.0, 120.0]
+# Roughly a line's worth of samples per read, as PrairieView tends to deliver
+CHUNKS_PER_FRAME = 16
+
+
+def run_at_rate(frame_rate_hz, duration_s, samples_per_pixel):
+    samples_per_frame = IMAGE_SIZE[0] * IMAGE_SIZE[1] * samples_per_pixel
+    fake_link = FakePrairieLink(IMAGE_SIZE, samples_per_pixel, frame_rate_hz,
+                                chunk_size=samples_per_frame // CHUNKS_PER_FRAME)
+    imager = StandaloneImager(IMAGE_SIZE, prairie_link=fake_link)
+    try:
+        imager.run_liveview(duration_s)
+        frames_streamed = fake_link.stream_position // samples_per_frame
+        frames_published = imager.frame_ring.sequence_number
+    finally:
+        imager.close()
+    return frames_streamed, frames_published
+
+
+if __name__ == '__main__':
+    duration_s = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+    samples_per_pixel = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    logging.getLogger().setLevel(logging.WARNING)
+    for frame_rate_hz in FRAME_RATES_HZ:
+        streamed, published = run_at_rate(
+            frame_rate_hz, duration_s, samples_per_pixel)
+        print(f"{frame_rate_hz:.0f} Hz: {published}/{streamed} frames published ({(published / duration_s):.2f} Hz achieved)")
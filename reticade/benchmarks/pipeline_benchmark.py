@@ -0,0 +1,294 @@
+import sys
+import json
+import os
+import platform
+import tempfile
+import time
+import logging
+from datetime import datetime
+import numpy as np
+import sklearn
+import skimage
+from sklearn.svm import LinearSVC, SVC
+from skimage.transform import downscale_local_mean
+from scipy.ndimage import median_filter
+from reticade import decoder_harness
+from reticade.decoding import sig_proc, motion_correction, movement_controller, svm_decoder
+from reticade.decoding import dummy_decoder, autopilot_decoder, roi_extraction
+
+"""
+Times every stage in decoder_harness.known_pipeline_stages at several input
+sizes, and full pipelines laid out like train_decoder.train_decoder's, on
+synthetic frames, as well as how long that pipeline takes to load from disk
+in each file format. Results are saved as JSON so that releases can be compared.
+
+Usage:
+  python -m reticade.benchmarks.pipeline_benchmark run [out.json] [repeats]
+  python -m reticade.benchmarks.pipeline_benchmark compare baseline.json new.json [threshold]
+
+compare flags every case whose median time grew by more than threshold
+(a fraction, 0.2 by default), every case that failed, and every pipeline over
+the frame budget, and exits with status 1 if there were any. run also exits
+with status 1 if any case failed (after saving the rest).
+"""
+
+INPUT_SIZES = [512, 256, 128]
+DEFAULT_REPEATS = 30
+WARMUP_REPEATS = 3
+NUM_SYNTHETIC_FRAMES = 8
+DEFAULT_REGRESSION_THRESHOLD = 0.2
+# One frame at 30 Hz
+FRAME_BUDGET_MS = 1000.0 / 30
+NUM_CLASSES = 10
+NUM_TRAINING_SAMPLES = 40
+# Stages that take a decoded class (or nothing) rather than an image
+SCALAR_INPUT_STAGES = ['FakeController', 'ClassMovementController', 'ConstantVelocityController',
+                       'ReplayMovementController', 'Autopilot']
+# Library calls that stages replaced, timed on the same inputs for comparison
+REFERENCE_IMPLEMENTATIONS = {
+    'skimage downscale_local_mean (Downsampler)': lambda frame: downscale_local_mean(frame, (4, 4)),
+    'scipy median_filter 3x3 (FastMedianFilter)': lambda frame: median_filter(frame, size=3, mode='nearest'),
+}
+
+
+def synthetic_frames(size, seed=0):
+    # Roughly like raw PrairieView frames: a bright baseline with shot noise and a few active cells
+    rng = np.random.default_rng(seed)
+    frames = rng.normal(1000, 50, size=(NUM_SYNTHETIC_FRAMES, size, size))
+    for frame in frames:
+        for _ in range(20):
+            row, col = rng.integers(0, size - size // 32, size=2)
+            frame[row:row + size // 32, col:col + size // 32] += rng.uniform(100, 400)
+    return frames
+
+
+def synthetic_roi_mask(size):
+    # A grid of square cells, the same size as synthetic_frames' active ones
+    cell = max(size // 32, 1)
+    mask = np.zeros((size, size), dtype=np.uint16)
+    for label, (row, col) in enumerate(np.ndindex(size // (2 * cell), size // (2 * cell))):
+        mask[2 * cell * row:2 * cell * row + cell, 2 * cell * col:2 * cell * col + cell] = label + 1
+    return mask
+
+
+def train_svm(features, gated=False):
+    rng = np.random.default_rng(0)
+    training_data = rng.normal(size=(NUM_TRAINING_SAMPLES, features))
+    if gated:
+        # Moving or not, gated on the classifier's confidence, as train_decoder_gated sets it up
+        classes = np.arange(NUM_TRAINING_SAMPLES) % 2
+        return svm_decoder.GatedSvmClassifier.from_training_data(training_data, classes)
+    classes = np.arange(NUM_TRAINING_SAMPLES) % NUM_CLASSES
+    return svm_decoder.SvmClassifier(LinearSVC(dual=False).fit(training_data, classes))
+
+
+def make_stage(name, size):
+    """
+    Returns the stage to benchmark and the inputs to feed it.
+    """
+    frames = synthetic_frames(size)
+    if name == 'Downsampler':
+        return sig_proc.Downsampler((4, 4)), frames
+    if name == 'DoGFilter':
+        return sig_proc.DoGFilter(0.5, 2.5), frames
+    if name == 'DeltaFFilter':
+        return sig_proc.DeltaFFilter(0.3, 0.001, (size, size), initial_state=frames.mean(axis=0)), frames
+    if name == 'DeltaFSliding':
+        return sig_proc.DeltaFSliding(5, 300, (size, size)), frames
+    if name == 'Flatten':
+        return sig_proc.Flatten(), frames
+    if name == 'OutputScaler':
+        return sig_proc.OutputScaler(1.0 / 50), frames
+    if name == 'LowPassFilter':
+        return sig_proc.LowPassFilter(1.2), frames
+    if name == 'MedianFilter':
+        return sig_proc.MedianFilter(), frames
+    if name == 'FastMedianFilter':
+        return sig_proc.FastMedianFilter(3), frames
+    if name == 'Threshold':
+        return sig_proc.Threshold(0), frames - 1000
+    if name == 'Dummy':
+        return dummy_decoder.MeanValueTaker(), frames
+    if name == 'SvmClassifier':
+        return train_svm(size * size), frames.reshape(len(frames), -1)
+    if name == 'GatedSvmClassifier':
+        return train_svm(size * size, gated=True), frames.reshape(len(frames), -1)
+    if name == 'FlowMotionCorrection':
+        return motion_correction.FlowMotionCorrection(frames.mean(axis=0)), frames
+    if name == 'RoiExtractor':
+        return roi_extraction.RoiExtractor(synthetic_roi_mask(size)), frames
+    classes = np.arange(NUM_SYNTHETIC_FRAMES) % NUM_CLASSES
+    if name == 'FakeController':
+        return movement_controller.FakeController(5.0, 20.0, 1.0), classes
+    if name == 'ClassMovementController':
+        return movement_controller.ClassMovementController(list(np.linspace(4, 40, NUM_CLASSES)), 80), classes
+    if name == 'ConstantVelocityController':
+        return movement_controller.ConstantVelocityController(20.0), classes
+    if name == 'ReplayMovementController':
+        return movement_controller.ReplayMovementController(30, np.linspace(0, 40, 1000)), classes
+    if name == 'Autopilot':
+        # Reads the position from memory shared with LabView, so use a local array instead
+        autopilot = autopilot_decoder.AutopilotDecoder(40.0, NUM_CLASSES, init_mem=False)
+        autopilot.output_array = np.zeros(1)
+        return autopilot, classes
+    raise ValueError(f"No benchmark set up for stage {name}")
+
+
+def make_training_layout(reference_frames, precision=decoder_harness.DEFAULT_PRECISION):
+    # The same stages, with the same settings, as train_decoder.train_decoder
+    downsampler = sig_proc.Downsampler((4, 4))
+    low_pass = sig_proc.LowPassFilter(1.2)
+    reference_image = low_pass.process(downsampler.process(reference_frames.mean(axis=0)))
+    pipeline = [downsampler, low_pass,
+                motion_correction.FlowMotionCorrection(reference_image),
+                sig_proc.DeltaFFilter(0.3, 0.001, reference_image.shape, initial_state=reference_image),
+                sig_proc.DoGFilter(0.5, 2.5),
+                sig_proc.Threshold(0),
+                sig_proc.Downsampler((4, 4)),
+                sig_proc.Flatten(),
+                train_svm((reference_image.shape[0] // 4) * (reference_image.shape[1] // 4)),
+                movement_controller.ClassMovementController([25, 38, 40, 30, 20, 15, 4, 30, 40, 25], 80),
+                sig_proc.OutputScaler(1.0 / 50)]
+    indices_to_instrument = [7, 8, 9]
+    return decoder_harness.DecoderPipeline(pipeline, instrumented_stages=indices_to_instrument, precision=precision)
+
+
+def load_as_saved(pipeline):
+    # Decoders are run as they're loaded from disk, which fuses linear stages
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'decoder.json')
+        pipeline.to_json(path)
+        return decoder_harness.DecoderPipeline.from_json(path)
+
+
+def make_pipelines(frames):
+    return {
+        'train_decoder (as trained)': make_training_layout(frames),
+        'train_decoder (loaded)': load_as_saved(make_training_layout(frames)),
+        'train_decoder (loaded, float32)': load_as_saved(make_training_layout(frames, decoder_harness.PRECISION_FLOAT32)),
+    }
+
+
+def time_loading(pipeline, repeats):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for format_name, sidecar in [('json', False), ('sidecar', True)]:
+            path = os.path.join(directory, f'decoder-{format_name}.json')
+            pipeline.to_json(path, sidecar=sidecar)
+            results[format_name] = time_calls(decoder_harness.DecoderPipeline.from_json, [path], repeats)
+    return results
+
+
+def time_calls(call, inputs, repeats):
+    for i in range(WARMUP_REPEATS):
+        call(inputs[i % len(inputs)])
+    times_ms = np.zeros(repeats)
+    for i in range(repeats):
+        start_ns = time.perf_counter_ns()
+        call(inputs[i % len(inputs)])
+        times_ms[i] = (time.perf_counter_ns() - start_ns) * 1e-6
+    return {'median_ms': float(np.median(times_ms)), 'p99_ms': float(np.percentile(times_ms, 99)),
+            'min_ms': float(np.min(times_ms)), 'repeats': repeats}
+
+
+def run_benchmarks(repeats=DEFAULT_REPEATS):
+    results = {}
+    for name in decoder_harness.known_pipeline_stages:
+        sizes = [None] if name in SCALAR_INPUT_STAGES else INPUT_SIZES
+        for size in sizes:
+            stage, inputs = make_stage(name, size if size else INPUT_SIZES[-1])
+            key = f"stage/{name}" if size is None else f"stage/{name}/{size}"
+            try:
+                results[key] = time_calls(stage.process, inputs, repeats)
+            except Exception as err:
+                # Recorded, so that compare reports it rather than it quietly going missing
+                results[key] = {'failed': f"{type(err).__name__}: {err}"}
+                print(f"{key}: FAILED. Details: {results[key]['failed']}")
+                continue
+            print(f"{key}: {results[key]['median_ms']:.3f} ms")
+
+    for name, call in REFERENCE_IMPLEMENTATIONS.items():
+        for size in INPUT_SIZES:
+            key = f"reference/{name}/{size}"
+            results[key] = time_calls(call, synthetic_frames(size), repeats)
+            print(f"{key}: {results[key]['median_ms']:.3f} ms")
+
+    frames = synthetic_frames(INPUT_SIZES[0])
+    for name, pipeline in make_pipelines(frames).items():
+        key = f"pipeline/{name}"
+        results[key] = time_calls(pipeline.decode, frames, repeats)
+        pipeline.clear_instrumentation()
+        over_budget = " (over budget)" if results[key]['median_ms'] > FRAME_BUDGET_MS else ""
+        print(f"{key}: {results[key]['median_ms']:.3f} ms{over_budget}")
+
+    for format_name, result in time_loading(make_training_layout(frames), repeats).items():
+        key = f"load/train_decoder ({format_name})"
+        results[key] = result
+        print(f"{key}: {result['median_ms']:.3f} ms")
+    return results
+
+
+def describe_environment():
+    return {'date': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+            'machine': platform.machine(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+            'numpy': np.__version__, 'scipy': __import__('scipy').__version__,
+            'skimage': skimage.__version__, 'sklearn': sklearn.__version__}
+
+
+def failures(results):
+    return [(key, result['failed']) for key, result in results.items() if 'failed' in result]
+
+
+def compare(baseline, current, threshold=DEFAULT_REGRESSION_THRESHOLD):
+    """
+    Returns a list of (case, description) for regressions (including cases that
+    no longer run, or fail), and for pipelines over budget.
+    """
+    problems = [(key, f"failed: {details}") for key, details in failures(current['results'])]
+    for key, result in current['results'].items():
+        if 'failed' in result:
+            continue
+        median_ms = result['median_ms']
+        if key.startswith('pipeline/') and median_ms > FRAME_BUDGET_MS:
+            problems.append((key, f"{median_ms:.3f} ms is over the {FRAME_BUDGET_MS:.1f} ms frame budget"))
+        if key not in baseline['results'] or 'failed' in baseline['results'][key]:
+            continue
+        baseline_ms = baseline['results'][key]['median_ms']
+        if median_ms > baseline_ms * (1 + threshold):
+            problems.append((key, f"{baseline_ms:.3f} ms -> {median_ms:.3f} ms (+{(median_ms / baseline_ms - 1) * 100:.0f}%)"))
+    for key in baseline['results']:
+        if key not in current['results']:
+            problems.append((key, "no longer runs"))
+    return problems
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.WARNING)
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'run'
+    if mode == 'run':
+        out_file = sys.argv[2] if len(sys.argv) > 2 else 'benchmark-' + \
+            datetime.now().strftime("%Y-%m-%d-%H%M%S") + '.json'
+        repeats = int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_REPEATS
+        results = run_benchmarks(repeats)
+        with open(out_file, 'w') as f:
+            json.dump({'environment': describe_environment(), 'results': results}, f, indent=1)
+        print(f"Wrote results to {out_file}")
+        failed = failures(results)
+        for key, details in failed:
+            print(f"FAILED {key}: {details}")
+        sys.exit(1 if failed else 0)
+    elif mode == 'compare':
+        with open(sys.argv[2]) as f:
+            baseline = json.load(f)
+        with open(sys.argv[3]) as f:
+            current = json.load(f)
+        threshold = float(sys.argv[4]) if len(sys.argv) > 4 else DEFAULT_REGRESSION_THRESHOLD
+        problems = compare(baseline, current, threshold)
+        for key, description in problems:
+            print(f"REGRESSION {key}: {description}")
+        if not problems:
+            print(f"No regressions beyond {(threshold * 100):.0f}%")
+        sys.exit(1 if problems else 0)
+    else:
+        print(f"Unknown mode {mode}. Use 'run' or 'compare'.")
+        sys.exit(2)
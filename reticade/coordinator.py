@@ -1,4 +1,7 @@
 import logging
+import time
+import numpy as np
+from reticade.util.latency import LatencyRecorder
 
 
 class Coordinator:
@@ -6,24 +9,70 @@ class Coordinator:
         self.imaging = None
         self.decoder = None
         self.controller = None
+        self.latency = LatencyRecorder()
+        self.warned_preprocessing_mismatch = False
         # Todo(charlie): consider whether or not we need a lock here
 
     # Note(charlie): Even if we can't complete a full end-to-end pass,
     # we should still tick as far as we can.
     def tick(self):
         frame = None
+        sequence_number = None
+        acquisition_ns = None
+        stages_applied = 0
         if self.imaging != None:
             frame = self.imaging.get_current_frame()
+            # Frames carry their sequence number and acquisition time (if the link provides them)
+            sequence_number = getattr(self.imaging, 'last_sequence_number', None)
+            acquisition_ns = getattr(self.imaging, 'last_timestamp_ns', None)
+            # The imaging process may already have run the first few decoder stages
+            stages_applied = getattr(self.imaging, 'last_stages_applied', 0)
         if self.decoder == None:
             return
+        if stages_applied != self.decoder.imaging_stages:
+            self._warn_preprocessing_mismatch(stages_applied)
         # Sometimes it's fine to have no frame (e.g. autopilot)
-        decoded_command = self.decoder.decode(frame)
-        if self.controller == None:
+        decode_start_ns = time.perf_counter_ns()
+        frame_budget_s = getattr(self.decoder, 'frame_budget_s', None)
+        if frame_budget_s is not None and acquisition_ns:
+            # The budget runs from when the frame was acquired, not when decoding started
+            decoded_command = self.decoder.decode(
+                frame, first_stage=stages_applied, deadline_ns=acquisition_ns + int(frame_budget_s * 1e9))
+        else:
+            decoded_command = self.decoder.decode(frame, first_stage=stages_applied)
+        decode_end_ns = time.perf_counter_ns()
+        if self.imaging != None:
+            # The frame may be a view into shared memory, so hand it back
+            # as soon as the decoder is done with it.
+            self.imaging.release_frame()
+        if self.controller != None:
+            self.controller.send_command(float(decoded_command))
+        send_end_ns = time.perf_counter_ns()
+        self.latency.record(sequence_number, acquisition_ns,
+                            decode_start_ns, decode_end_ns, send_end_ns,
+                            degraded=getattr(self.decoder, 'last_frame_degraded', False))
+
+    def _warn_preprocessing_mismatch(self, stages_applied):
+        if self.warned_preprocessing_mismatch:
             return
-        self.controller.send_command(float(decoded_command))
+        logging.warn(
+            f"Imaging applied {stages_applied} decoder stages, but the decoder expects {self.decoder.imaging_stages}. Load the same decoder into the imaging process.")
+        self.warned_preprocessing_mismatch = True
+
+    def can_wait_for_frames(self):
+        return self.imaging != None and hasattr(self.imaging, 'wait_for_frame')
+
+    def wait_for_frame(self, timeout_s):
+        # Returns whether a new frame arrived before the timeout
+        return self.imaging.wait_for_frame(timeout_s)
 
     def set_decoder(self, new_decoder):
+        self.finish_instrumentation()
+        if hasattr(self.decoder, 'close'):
+            # Pipelined decoders have worker threads to stop
+            self.decoder.close()
         self.decoder = new_decoder
+        self.warned_preprocessing_mismatch = False
 
     def set_imaging(self, new_imaging):
         if (self.imaging != None):
@@ -38,7 +87,9 @@ class Coordinator:
     def get_debug_image(self):
         if self.imaging is None:
             return None
-        return self.imaging.get_current_frame()
+        image = np.copy(self.imaging.get_current_frame())
+        self.imaging.release_frame()
+        return image
 
     def send_debug_message(self, msg):
         if self.controller is None:
@@ -47,12 +98,62 @@ class Coordinator:
             return
         self.controller.send_command(msg)
 
-    def dump_instrumentation_data(self, out_file):
+    def start_instrumentation(self, out_prefix):
         if self.decoder == None:
             return
-        self.decoder.write_instrumented_stages(out_file)
+        self.decoder.start_instrumentation(out_prefix)
+
+    def finish_instrumentation(self):
+        if self.decoder == None:
+            return
+        self.decoder.finish_instrumentation()
+
+    def reset_latency(self):
+        self.latency.reset()
+        if self.decoder != None:
+            self.decoder.stage_timings.reset()
+            if hasattr(self.decoder, 'segment_timings'):
+                self.decoder.segment_timings.reset()
+
+    def log_latency_summary(self):
+        self.latency.log_summary()
+        self.log_stage_timings()
+
+    def log_stage_timings(self):
+        if self.decoder == None:
+            return
+        self.decoder.stage_timings.log_summary()
+        degraded_counts = getattr(self.decoder, 'degraded_counts', None)
+        if degraded_counts and any(degraded_counts):
+            printable = ", ".join([f"{name} {count}" for name, count in zip(
+                self.decoder.stage_timings.stage_names, degraded_counts) if count > 0])
+            logging.info(f"Stages degraded to meet frame deadlines: {printable}")
+        if hasattr(self.decoder, 'segment_timings'):
+            self.decoder.segment_timings.log_summary()
+
+    def slowest_recent_stage(self):
+        """
+        Returns (stage name, seconds) for the slowest decoder stage since the last call, or None.
+        """
+        if self.decoder == None:
+            return None
+        return self.decoder.stage_timings.take_interval_max()
+
+    def dump_stage_timings(self, out_file):
+        if self.decoder == None:
+            return
+        self.decoder.stage_timings.save(out_file)
+
+    def dump_latency_data(self, out_file):
+        if self.latency.num_ticks == 0:
+            return
+        np.save(out_file, self.latency.as_array())
+        logging.info(f"Wrote per-tick latencies to {out_file}")
 
     def close(self):
+        self.finish_instrumentation()
+        if hasattr(self.decoder, 'close'):
+            self.decoder.close()
         if self.controller != None:
             self.controller.close()
         if self.imaging != None:
@@ -1,10 +1,16 @@
 import json
+import os
 from reticade.decoding import sig_proc
 from reticade.decoding import dummy_decoder
 from reticade.decoding import movement_controller
 from reticade.decoding import svm_decoder
 from reticade.decoding import motion_correction
+from reticade.decoding import roi_extraction
 from reticade.decoding import autopilot_decoder
+from reticade.decoding import linear_fusion
+from reticade.util.stage_timing import StageTimings
+import reticade.util.serialization as serial
+from reticade.instrumentation_writer import InstrumentationWriter
 import numpy as np
 import logging
 import time
@@ -15,10 +21,12 @@ known_pipeline_stages = {
     'Downsampler': sig_proc.Downsampler,
     'DoGFilter': sig_proc.DoGFilter,
     'DeltaFFilter': sig_proc.DeltaFFilter,
+    'DeltaFSliding': sig_proc.DeltaFSliding,
     'Flatten': sig_proc.Flatten,
     'OutputScaler': sig_proc.OutputScaler,
     'LowPassFilter': sig_proc.LowPassFilter,
     'MedianFilter': sig_proc.MedianFilter,
+    'FastMedianFilter': sig_proc.FastMedianFilter,
     'Threshold': sig_proc.Threshold,
     'Dummy': dummy_decoder.MeanValueTaker,
     'FakeController': movement_controller.FakeController,
@@ -28,27 +36,294 @@ known_pipeline_stages = {
     'SvmClassifier': svm_decoder.SvmClassifier,
     'GatedSvmClassifier': svm_decoder.GatedSvmClassifier,
     'FlowMotionCorrection': motion_correction.FlowMotionCorrection,
+    'RoiExtractor': roi_extraction.RoiExtractor,
     'Autopilot': autopilot_decoder.AutopilotDecoder,
 }
 
+# The floating point type that a pipeline's stages compute in
+PRECISION_FLOAT64 = 'float64'
+PRECISION_FLOAT32 = 'float32'
+DEFAULT_PRECISION = PRECISION_FLOAT64
+# Weight of the newest frame in each stage's running cost estimate
+STAGE_COST_SMOOTHING = 0.1
+SIDECAR_EXTENSION = '.bin'
+
+
+def sidecar_path(json_file):
+    # decoder-2022.json -> decoder-2022.bin
+    return os.path.splitext(json_file)[0] + SIDECAR_EXTENSION
+
+
 class DecoderPipeline:
-    def __init__(self, pipeline, instrumented_stages=[]):
+    """
+    imaging_stages is the number of leading stages that may be run in the imaging
+    process instead (see StandaloneImager.load_preprocessing), which then publishes
+    the output of the last of them in place of the raw frame.
+
+    With fuse_linear_stages, runs of adjacent linear stages are executed as one
+    precomputed operator (see decoding/linear_fusion.py). pipeline_stages is
+    left as it is, so the decoder saves and instruments exactly as before.
+
+    Stages that support it (see sig_proc.py) write into output buffers that are
+    allocated once per input shape, either by prepare or on the first frame,
+    so decoding a frame doesn't allocate any new arrays in steady state.
+
+    With a precision of float32, frames are converted to float32 on the way in
+    and every stage that has a set_precision method is told to compute in it.
+    That halves the memory traffic of the image stages, at the cost of results
+    that differ from float64 by rounding error.
+
+    Every execution unit is timed on every frame, into stage_timings.
+
+    Instrumented outputs are kept in instrumentation_history, or streamed to
+    disk between start_instrumentation and finish_instrumentation.
+
+    segment_starts are the indices of stages where a PipelinedDecoder starts a
+    new segment (see pipelined_decoder.py). Fused runs never cross them.
+
+    With a frame_budget_s, each frame has a deadline (frame_budget_s after
+    decoding starts, unless decode is given one). Stages with a process_degraded
+    method, a cheaper approximation of process, are switched to it whenever the
+    usual cost of the stages still to run would take the frame past its deadline
+    (unless the stage's degrades method says it's no cheaper for that input).
+    last_frame_degraded and degraded_frames record when that happens.
+    """
+
+    def __init__(self, pipeline, instrumented_stages=[], imaging_stages=0, fuse_linear_stages=False,
+                 precision=DEFAULT_PRECISION, segment_starts=[], frame_budget_s=None):
+        assert(imaging_stages <= len(pipeline))
+        assert(precision in [PRECISION_FLOAT64, PRECISION_FLOAT32])
+        self.precision = precision
+        self.dtype = np.dtype(precision)
+        if precision != DEFAULT_PRECISION:
+            for stage in pipeline:
+                if hasattr(stage, 'set_precision'):
+                    stage.set_precision(self.dtype)
         self.pipeline_stages = pipeline
         self.instrumented_stages = instrumented_stages
+        self.imaging_stages = imaging_stages
         self.instrumentation_history = [[] for _ in range(len(self.instrumented_stages) + 1)]
+        self.instrumentation_writer = None
+        # (stage, index of its first pipeline stage, index of its last pipeline stage)
+        if fuse_linear_stages:
+            self.execution_units = linear_fusion.plan_execution(
+                pipeline, instrumented_stages, break_points=[imaging_stages] + list(segment_starts), dtype=self.dtype)
+        else:
+            self.execution_units = [(stage, i, i) for i, stage in enumerate(pipeline)]
+        # Per execution unit: the (shape, dtype) of input it was prepared for, and its output buffer
+        self.prepared_inputs = [None for _ in self.execution_units]
+        self.output_buffers = [None for _ in self.execution_units]
+        self.frame_buffer = None
+        self.stage_timings = StageTimings(
+            [self._unit_name(start, end) for _, start, end in self.execution_units])
+
+        self.frame_budget_s = frame_budget_s
+        # Running estimate of each execution unit's (non-degraded) cost
+        self.unit_costs_ns = [0.0 for _ in self.execution_units]
+        self.last_frame_degraded = False
+        self.degraded_frames = 0
+        self.degraded_counts = [0 for _ in self.execution_units]
+        # Whether each unit has a cheaper approximation for the input it was prepared for
+        self.unit_degradable = [hasattr(stage, 'process_degraded') for stage, _, _ in self.execution_units]
+
+    def _unit_name(self, start, end):
+        names = [type(s).__name__ for s in self.pipeline_stages[start:end + 1]]
+        return f"[{start}] " + "+".join(names)
+
+    def prepare(self, input_shape, input_dtype=np.float64, first_stage=0):
+        """
+        Allocates output buffers ahead of time for inputs of this shape and type.
+        Shapes are inferred stage by stage, up to the first stage that doesn't
+        support output buffers. Anything after that is prepared on the first frame.
+        """
+        signature = (tuple(input_shape), np.dtype(input_dtype))
+        for unit_idx, (stage, start, end) in enumerate(self.execution_units):
+            if start < first_stage:
+                continue
+            if not hasattr(stage, 'prepare'):
+                return
+            self._prepare_unit(unit_idx, stage, signature)
+            buffer = self.output_buffers[unit_idx]
+            if buffer is None:
+                return
+            signature = (buffer.shape, buffer.dtype)
+
+    def _prepare_unit(self, unit_idx, stage, signature):
+        output_layout = stage.prepare(*signature)
+        self.prepared_inputs[unit_idx] = signature
+        if hasattr(stage, 'degrades'):
+            self.unit_degradable[unit_idx] = stage.degrades(*signature)
+        if output_layout is None:
+            self.output_buffers[unit_idx] = None
+        else:
+            output_shape, output_dtype = output_layout
+            self.output_buffers[unit_idx] = np.zeros(output_shape, dtype=output_dtype)
+
+    def _prepare_for(self, unit_idx, stage, stage_input):
+        signature = (np.shape(stage_input), np.result_type(stage_input))
+        if signature != self.prepared_inputs[unit_idx]:
+            self._prepare_unit(unit_idx, stage, signature)
 
-    def decode(self, input):
-        next_stage_input = input
-        self.instrumentation_history[0].append(time.perf_counter())
+    def _can_degrade(self, unit_idx, stage, stage_input):
+        # Whether the stage is degradable can depend on the input it's prepared for
+        if hasattr(stage, 'prepare'):
+            self._prepare_for(unit_idx, stage, stage_input)
+        return self.unit_degradable[unit_idx]
+
+    def _process(self, unit_idx, stage, stage_input, degraded=False):
+        process = stage.process_degraded if degraded else stage.process
+        if not hasattr(stage, 'prepare'):
+            return process(stage_input)
+        self._prepare_for(unit_idx, stage, stage_input)
+        buffer = self.output_buffers[unit_idx]
+        if buffer is None:
+            return process(stage_input)
+        return process(stage_input, out=buffer)
+
+    def decode(self, input, first_stage=0, end_stage=None, deadline_ns=None, row=None):
+        """
+        first_stage is the number of stages that have already been applied to the input.
+        deadline_ns (in perf_counter_ns time) overrides the deadline set by frame_budget_s.
+        The outputs of skipped stages aren't available for instrumentation, except for
+        the last one (the input itself).
+        If end_stage is given, decoding stops before that stage (a segment start), and
+        the rest can be run with decode_segment.
+        If row is a list, instrumented outputs are copied into it as (stream, value)
+        rather than recorded, to be recorded later with record_row.
+        Note: the result may be one of the pipeline's buffers, so it's only valid
+        until the next call to decode. Copy it to keep it.
+        """
+        assert(first_stage <= len(self.pipeline_stages))
+        if deadline_ns is None and self.frame_budget_s is not None:
+            deadline_ns = time.perf_counter_ns() + int(self.frame_budget_s * 1e9)
+        self.last_frame_degraded = False
+        next_stage_input = self._convert_frame(input, first_stage, reuse_buffer=True)
+        if self.instrumented_stages:
+            self._record(0, time.perf_counter(), row)
         stages_recorded = 1
-        for i, step in enumerate(self.pipeline_stages):
-            next_stage_input = step.process(next_stage_input)
-            if i in self.instrumented_stages:
-                self.instrumentation_history[stages_recorded].append(next_stage_input)
+        for i in range(first_stage):
+            if i not in self.instrumented_stages:
+                continue
+            if i == first_stage - 1:
+                self._record(stages_recorded, next_stage_input, row)
+            stages_recorded += 1
+        result = self._run_units(next_stage_input, first_stage, end_stage, stages_recorded, deadline_ns, row)
+        if self.last_frame_degraded:
+            self.degraded_frames += 1
+        return result
+
+    def decode_segment(self, input, first_stage, end_stage=None, row=None):
+        """
+        Runs the stages from first_stage up to end_stage (or the end) on the output
+        of an earlier segment. Both must be segment starts. row is as for decode.
+        """
+        stages_recorded = 1 + len([i for i in self.instrumented_stages if i < first_stage])
+        return self._run_units(input, first_stage, end_stage, stages_recorded, row=row)
+
+    def _run_units(self, next_stage_input, first_stage, end_stage, stages_recorded, deadline_ns=None, row=None):
+        for unit_idx, (stage, start, end) in enumerate(self.execution_units):
+            if end < first_stage:
+                continue
+            if end_stage is not None and start >= end_stage:
+                break
+            if start < first_stage:
+                # Only part of a fused run was applied already, so finish it stage by stage
+                unit_start_ns = time.perf_counter_ns()
+                for i in range(first_stage, end + 1):
+                    next_stage_input = self.pipeline_stages[i].process(next_stage_input)
+                    if i in self.instrumented_stages:
+                        self._record(stages_recorded, next_stage_input, row)
+                        stages_recorded += 1
+                self.stage_timings.record(unit_idx, time.perf_counter_ns() - unit_start_ns)
+                continue
+            unit_start_ns = time.perf_counter_ns()
+            degraded = deadline_ns is not None and \
+                self._deadline_at_risk(unit_idx, unit_start_ns, deadline_ns) and \
+                self._can_degrade(unit_idx, stage, next_stage_input)
+            next_stage_input = self._process(unit_idx, stage, next_stage_input, degraded)
+            unit_duration_ns = time.perf_counter_ns() - unit_start_ns
+            self.stage_timings.record(unit_idx, unit_duration_ns)
+            if degraded:
+                self.last_frame_degraded = True
+                self.degraded_counts[unit_idx] += 1
+            elif self.unit_costs_ns[unit_idx] == 0.0:
+                self.unit_costs_ns[unit_idx] = float(unit_duration_ns)
+            else:
+                self.unit_costs_ns[unit_idx] += STAGE_COST_SMOOTHING * \
+                    (unit_duration_ns - self.unit_costs_ns[unit_idx])
+            # Fused runs never extend past an instrumented stage
+            if end in self.instrumented_stages:
+                self._record(stages_recorded, next_stage_input, row)
                 stages_recorded += 1
 
         return next_stage_input
 
+    def _deadline_at_risk(self, unit_idx, now_ns, deadline_ns):
+        # Whether running this and all the following units as usual would overrun
+        expected_ns = now_ns
+        for cost_ns in self.unit_costs_ns[unit_idx:]:
+            expected_ns += cost_ns
+        return expected_ns > deadline_ns
+
+    def _record(self, stream_idx, value, row=None):
+        if row is not None:
+            # The buffers are reused for the next frame before the row is recorded
+            row.append((stream_idx, np.copy(value) if isinstance(value, np.ndarray) else value))
+            return
+        if self.instrumentation_writer is not None:
+            self.instrumentation_writer.record(stream_idx, value)
+            return
+        # Outputs are copied because the buffers are reused on the next frame,
+        # and the input may be a view into shared memory.
+        if isinstance(value, np.ndarray):
+            value = np.copy(value)
+        self.instrumentation_history[stream_idx].append(value)
+
+    def record_row(self, row):
+        """
+        Records the instrumented outputs that decode (and decode_segment) copied into row.
+        """
+        for stream_idx, value in row:
+            self._record(stream_idx, value)
+
+    def decode_batch(self, stack, batch_size=None):
+        """
+        Decodes a stack of frames (along the first axis) and returns the stacked
+        results, exactly as if each frame had been passed to decode in turn.
+        The stack runs through the same execution units as decode, fused or not.
+        Units with a process_batch method run on the whole stack at once, while
+        stateful stages are run frame by frame. Set batch_size to bound the memory
+        used by intermediate stacks. Nothing is recorded for instrumentation.
+        """
+        if batch_size is not None and len(stack) > batch_size:
+            return np.concatenate([self.decode_batch(stack[i:i + batch_size])
+                                   for i in range(0, len(stack), batch_size)])
+        next_stage_input = self._convert_frame(np.asarray(stack))
+        for step, _, _ in self.execution_units:
+            if hasattr(step, 'process_batch'):
+                next_stage_input = step.process_batch(next_stage_input)
+            else:
+                next_stage_input = np.array(
+                    [step.process(frame) for frame in next_stage_input])
+        return next_stage_input
+
+    def _convert_frame(self, frame, first_stage=0, reuse_buffer=False):
+        # Frames may arrive in a compact transport type (e.g. uint16 counts, or
+        # float32), or partly processed in float32 by the imaging process.
+        # Stages that can reduce them directly do the conversion themselves,
+        # otherwise convert here so that every stage computes in the pipeline's
+        # precision, whatever the transport.
+        if not isinstance(frame, np.ndarray) or frame.dtype == self.dtype:
+            return frame
+        if first_stage == 0 and self.pipeline_stages and getattr(self.pipeline_stages[0], 'converts_compact_frames', False):
+            return frame
+        if not reuse_buffer:
+            return frame.astype(self.dtype)
+        if self.frame_buffer is None or self.frame_buffer.shape != frame.shape:
+            self.frame_buffer = np.zeros(frame.shape, dtype=self.dtype)
+        np.copyto(self.frame_buffer, frame)
+        return self.frame_buffer
+
     def make_stage(json_obj):
         name = json_obj['name']
         params = json_obj['params']
@@ -57,22 +332,65 @@ class DecoderPipeline:
             return
         return known_pipeline_stages[name].from_json(params)
 
-    def from_json(json_file):
+    def from_json(json_file, segment_starts=[]):
         with open(json_file, 'r') as file:
             top_level = json.load(file)
+        if 'sidecar' in top_level:
+            # The sidecar is named relative to the JSON, so the two can be moved together
+            sidecar_file = os.path.join(os.path.dirname(json_file), top_level['sidecar'])
+            with serial.reading_sidecar(sidecar_file):
+                pipeline = [DecoderPipeline.make_stage(t) for t in top_level['json_stages']]
+        else:
             pipeline = [DecoderPipeline.make_stage(t) for t in top_level['json_stages']]
-            instrumented_stages = [int(i) for i in top_level['instrumentation']]
-        return DecoderPipeline(pipeline, instrumented_stages)
+        instrumented_stages = [int(i) for i in top_level['instrumentation']]
+        imaging_stages = int(top_level.get('imaging_stages', 0))
+        precision = top_level.get('precision', DEFAULT_PRECISION)
+        frame_budget_s = top_level.get('frame_budget_s', None)
+        return DecoderPipeline(pipeline, instrumented_stages, imaging_stages, fuse_linear_stages=True,
+                               precision=precision, segment_starts=segment_starts,
+                               frame_budget_s=frame_budget_s)
 
-    def to_json(self, out_file):
+    def to_json(self, out_file, sidecar=False):
+        """
+        By default, pickled stage state (reference images, trained models, ...)
+        is base64 encoded in the JSON itself. With sidecar, it goes into a binary
+        file next to out_file instead (see sidecar_path), which loads much faster.
+        The sidecar is memory-mapped while a decoder loaded from it is in use,
+        so (on Windows) it can't be overwritten until that process is done with it.
+        """
+        top_level = {'instrumentation': self.instrumented_stages, 'imaging_stages': self.imaging_stages,
+                     'precision': self.precision, 'frame_budget_s': self.frame_budget_s}
+        if sidecar:
+            sidecar_file = sidecar_path(out_file)
+            with serial.writing_sidecar(sidecar_file):
+                top_level['json_stages'] = [p.to_json() for p in self.pipeline_stages]
+            top_level['sidecar'] = os.path.basename(sidecar_file)
+        else:
+            top_level['json_stages'] = [p.to_json() for p in self.pipeline_stages]
         with open(out_file, 'w') as f:
-            json_stages = [p.to_json() for p in self.pipeline_stages]
-            json.dump({'json_stages' : json_stages, 'instrumentation': self.instrumented_stages}, f)
+            json.dump(top_level, f)
         logging.info(f"Wrote decoder to: {out_file}")
 
     def clear_instrumentation(self):
         self.instrumentation_history = [[] for _ in range(len(self.instrumented_stages) + 1)]
 
+    def start_instrumentation(self, out_prefix):
+        """
+        Streams instrumented outputs to out_prefix-timestamps.npy and
+        out_prefix-stage<index>.npy until finish_instrumentation is called.
+        """
+        if not self.instrumented_stages:
+            return
+        self.finish_instrumentation()
+        self.instrumentation_writer = InstrumentationWriter(
+            out_prefix, self.instrumented_stages)
+
+    def finish_instrumentation(self):
+        if self.instrumentation_writer is None:
+            return
+        self.instrumentation_writer.close()
+        self.instrumentation_writer = None
+
     def write_instrumented_stages(self, out_file):
         if not self.instrumented_stages:
             return
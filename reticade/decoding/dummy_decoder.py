@@ -5,6 +5,8 @@ class MeanValueTaker:
     This stage takes the mean of the raw input.
     It's a testing device, not for use in real pipelines.
     """
+    converts_compact_frames = True
+
     def __init__(self):
         pass
 
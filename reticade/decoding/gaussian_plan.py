@@ -0,0 +1,147 @@
+import inspect
+import numpy as np
+from scipy.fft import next_fast_len
+from scipy.ndimage import correlate1d
+
+"""
+Gaussian filtering for a fixed image shape and type, set up once and then
+applied to every frame. Matches skimage.filters.gaussian (with mode='nearest')
+on float images, but skips its per-call input checks and kernel construction.
+
+A plan filters with a weighted sum of Gaussians, so a difference of Gaussians
+is one plan. Small kernels are applied directly as 1D passes along each axis.
+When the kernels are wide enough that it's cheaper, the whole sum is applied in
+one pass in the frequency domain instead, on a frame padded like mode='nearest'.
+"""
+
+# Rough costs, per pixel, in units of one tap of a 1D kernel: the overhead of
+# each 1D pass (which dominates for small kernels on large frames, where the
+# pass down the columns is limited by memory), and an FFT per point and per
+# doubling of its size. Measured with scipy.ndimage and numpy.fft.
+DIRECT_PASS_OVERHEAD = 20
+FFT_COST_RATIO = 3.0
+
+# numpy >= 2.0 can transform into an existing array
+_FFT_TAKES_OUT = 'out' in inspect.signature(np.fft.rfft).parameters
+
+
+def gaussian_kernel(sigma, truncate):
+    # The same weights as scipy.ndimage.gaussian_filter, which skimage uses
+    radius = int(truncate * sigma + 0.5)
+    if sigma <= 0 or radius == 0:
+        return np.ones(1)
+    x = np.arange(-radius, radius + 1)
+    weights = np.exp(-0.5 / (sigma * sigma) * x * x)
+    return weights / weights.sum()
+
+
+def _costs(kernels, shape):
+    # (cost of filtering directly, cost in the frequency domain, padded shape for the FFT)
+    radius = max([len(kernel) // 2 for _, kernel in kernels])
+    height, width = shape[-2:]
+    fft_shape = (next_fast_len(height + 2 * radius, real=True),
+                 next_fast_len(width + 2 * radius, real=True))
+    fft_points = fft_shape[0] * fft_shape[1]
+    direct_cost = sum([2 * (len(kernel) + DIRECT_PASS_OVERHEAD)
+                       for _, kernel in kernels]) * height * width
+    return direct_cost, FFT_COST_RATIO * fft_points * np.log2(fft_points), fft_shape
+
+
+def filtering_cost(terms, truncate, shape):
+    """
+    The rough cost (in the units above) of filtering one frame with the plan
+    GaussianPlan would pick for these terms.
+    """
+    kernels = [(weight, gaussian_kernel(sigma, truncate)) for weight, sigma in terms]
+    direct_cost, fft_cost, _ = _costs(kernels, shape)
+    if _FFT_TAKES_OUT and max([len(kernel) for _, kernel in kernels]) > 1:
+        return min(direct_cost, fft_cost)
+    return direct_cost
+
+
+class GaussianPlan:
+    """
+    Computes sum(weight * gaussian(image, sigma)) for (weight, sigma) in terms,
+    over the last two axes of images with this shape (so a stack of frames is
+    filtered frame by frame). Results are written into out, which must have
+    this shape and type. use_fft picks how the plan filters, or leave it as None
+    to pick whichever should be cheaper. cost is the estimated cost per frame
+    of the way it filters.
+    """
+
+    def __init__(self, terms, truncate, shape, dtype, use_fft=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.kernels = [(weight, gaussian_kernel(sigma, truncate)) for weight, sigma in terms]
+        self.radius = max([len(kernel) // 2 for _, kernel in self.kernels])
+        direct_cost, fft_cost, self.fft_shape = _costs(self.kernels, self.shape)
+        if use_fft is None:
+            # Without out=, every frame would allocate its spectrum and inverse
+            # (see _apply_fft), so older numpy always filters directly
+            use_fft = _FFT_TAKES_OUT and self.radius > 0 and fft_cost < direct_cost
+        self.use_fft = bool(use_fft)
+        self.cost = fft_cost if self.use_fft else direct_cost
+        if self.use_fft:
+            self._prepare_fft()
+        else:
+            self.row_pass = np.zeros(self.shape, dtype=self.dtype)
+            self.term = np.zeros(self.shape, dtype=self.dtype) if len(self.kernels) > 1 else None
+
+    def _prepare_fft(self):
+        # Every kernel is centred in one of the widest kernel's length
+        full_width = 2 * self.radius + 1
+        transfer = 0
+        for weight, kernel in self.kernels:
+            centred = np.zeros(full_width)
+            offset = self.radius - len(kernel) // 2
+            centred[offset:offset + len(kernel)] = kernel
+            transfer = transfer + weight * np.outer(np.fft.fft(centred, n=self.fft_shape[0]),
+                                                    np.fft.rfft(centred, n=self.fft_shape[1]))
+        self.transfer = transfer
+        # Transforms are always in double precision: numpy's single precision
+        # forward transforms allocate temporaries, and aren't much faster.
+        # Only the top left corner is written per frame: the rest stays zero, and
+        # the cropped output never reaches it.
+        self.padded = np.zeros(self.shape[:-2] + self.fft_shape)
+        self.spectrum = np.zeros(self.shape[:-2] + self.transfer.shape, dtype=np.complex128)
+        self.filtered = np.zeros(self.padded.shape)
+
+    def apply(self, image, out):
+        if self.use_fft:
+            return self._apply_fft(image, out)
+        for i, (weight, kernel) in enumerate(self.kernels):
+            result = out if i == 0 else self.term
+            correlate1d(image, kernel, axis=-2, output=self.row_pass, mode='nearest')
+            correlate1d(self.row_pass, kernel, axis=-1, output=result, mode='nearest')
+            if weight != 1:
+                np.multiply(result, weight, out=result)
+            if i > 0:
+                np.add(out, result, out=out)
+        return out
+
+    def _apply_fft(self, image, out):
+        r = self.radius
+        height, width = self.shape[-2:]
+        padded = self.padded
+        # Repeat the edge pixels outwards, as mode='nearest' does
+        padded[..., r:r + height, r:r + width] = image
+        padded[..., :r, r:r + width] = image[..., :1, :]
+        padded[..., r + height:height + 2 * r, r:r + width] = image[..., -1:, :]
+        padded[..., :height + 2 * r, :r] = padded[..., :height + 2 * r, r:r + 1]
+        padded[..., :height + 2 * r, r + width:width + 2 * r] = \
+            padded[..., :height + 2 * r, r + width - 1:r + width]
+
+        if _FFT_TAKES_OUT:
+            np.fft.rfft(padded, axis=-1, out=self.spectrum)
+            np.fft.fft(self.spectrum, axis=-2, out=self.spectrum)
+            np.multiply(self.spectrum, self.transfer, out=self.spectrum)
+            np.fft.ifft(self.spectrum, axis=-2, out=self.spectrum)
+            np.fft.irfft(self.spectrum, n=self.fft_shape[1], axis=-1, out=self.filtered)
+            filtered = self.filtered
+        else:
+            # Only reached when asked for explicitly: this allocates on every frame
+            spectrum = np.fft.rfft2(padded) * self.transfer
+            filtered = np.fft.irfft2(spectrum, s=self.fft_shape)
+        # Each output pixel is centred 2r along from the kernel's start
+        np.copyto(out, filtered[..., 2 * r:2 * r + height, 2 * r:2 * r + width], casting='same_kind')
+        return out
@@ -0,0 +1,431 @@
+import logging
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+from sklearn.svm import LinearSVC
+from reticade.decoding import sig_proc
+from reticade.decoding import svm_decoder
+from reticade.decoding.gaussian_plan import filtering_cost
+
+"""
+Runs of adjacent linear stages (e.g. Downsampler -> LowPassFilter, or
+Downsampler -> Flatten -> SvmClassifier) can be folded into one precomputed
+operator, which is far cheaper than running the stages one after another.
+
+Every spatial stage here is separable, so a run is described by a short list
+of terms (coefficient, R, C) acting on a frame x as sum(coefficient * R @ x @ C.T),
+where R and C are per-axis matrices (None meaning the identity). A leading
+Downsampler is kept as a block mean, which is cheaper than its matrix form.
+A run ending in a linear SVM collapses into a single weight map, so the
+classifier's decision becomes one dot product with the run's input.
+
+The per-axis matrices are dense, though, so fusing filters on a large frame
+(without a Downsampler shrinking it first) can cost more than filtering it
+stage by stage. Runs are only fused when that's expected to be cheaper.
+
+Note: the map can't be moved in front of a Threshold (or any other non-linear
+stage), so in the standard pipelines it's applied to the thresholded frame.
+"""
+
+# Fused results must match the unfused stages to within this tolerance
+FUSION_RTOL = 1e-6
+FUSION_ATOL = 1e-9  # Scaled by the largest reference value
+# Looser, for operators that compute in float32
+FUSION_RTOL_FLOAT32 = 1e-4
+FUSION_ATOL_FLOAT32 = 1e-5
+VALIDATION_SEED = 0
+# The cost of a multiply-add in a matrix product, in units of one tap of a 1D
+# filter (as in gaussian_plan). Measured with numpy's BLAS and scipy.ndimage.
+MATMUL_COST_RATIO = 0.2
+
+
+def is_fusable_classifier(stage):
+    return isinstance(stage, svm_decoder.SvmClassifier) and isinstance(stage.underlying_decoder, LinearSVC)
+
+
+def is_linear(stage):
+    return isinstance(stage, (sig_proc.Downsampler, sig_proc.LowPassFilter, sig_proc.DoGFilter,
+                              sig_proc.OutputScaler, sig_proc.Flatten)) or is_fusable_classifier(stage)
+
+
+def plan_execution(pipeline, instrumented_stages=[], break_points=[], dtype=np.float64):
+    """
+    Groups a pipeline into execution units of (stage, first index, last index),
+    replacing runs of linear stages with FusedLinearStages that compute in dtype.
+    A run never extends past an instrumented stage (whose output has to be
+    recorded), or across a break point (the index of the first stage of a new run).
+    """
+    units = []
+    i = 0
+    while i < len(pipeline):
+        if not is_linear(pipeline[i]):
+            units.append((pipeline[i], i, i))
+            i += 1
+            continue
+        end = i
+        while not _ends_run(pipeline, end, instrumented_stages, break_points):
+            end += 1
+        run = pipeline[i:end + 1]
+        if len(run) > 1 or is_fusable_classifier(run[-1]):
+            units.append((FusedLinearStage(run, dtype), i, end))
+        else:
+            units.append((run[0], i, i))
+        i = end + 1
+    return units
+
+
+def _ends_run(pipeline, i, instrumented_stages, break_points):
+    if i + 1 == len(pipeline) or i in instrumented_stages or i + 1 in break_points:
+        return True
+    stage = pipeline[i]
+    next_stage = pipeline[i + 1]
+    if not is_linear(next_stage) or is_fusable_classifier(stage):
+        return True
+    # Only the classifier can follow a Flatten
+    return isinstance(stage, sig_proc.Flatten) and not is_fusable_classifier(next_stage)
+
+
+def _gaussian_matrix(size, sigma, truncate):
+    # Column j is the filter's response to an impulse at j
+    return gaussian_filter1d(np.eye(size), sigma, axis=0, mode='nearest', truncate=truncate)
+
+
+def _downsample_matrix(size, factor):
+    # Matches downscale_local_mean, which pads ragged edges with zeros
+    matrix = np.zeros((-(-size // factor), size))
+    for i in range(matrix.shape[0]):
+        matrix[i, i * factor:(i + 1) * factor] = 1.0 / factor
+    return matrix
+
+
+def _compose(outer, inner):
+    if outer is None:
+        return inner
+    if inner is None:
+        return outer
+    return outer @ inner
+
+
+def _stage_terms(stage, shape):
+    """
+    Returns the output shape of the stage and its (coefficient, R, C) terms.
+    """
+    if isinstance(stage, sig_proc.OutputScaler):
+        return shape, [(stage.scale, None, None)]
+    if len(shape) != 2:
+        raise ValueError(f"{type(stage).__name__} needs a 2D input, not {shape}")
+    height, width = shape
+    if isinstance(stage, sig_proc.Downsampler):
+        rows = _downsample_matrix(height, stage.downscale_dimensions[0])
+        cols = _downsample_matrix(width, stage.downscale_dimensions[1])
+        return (rows.shape[0], cols.shape[0]), [(1.0, rows, cols)]
+    if isinstance(stage, sig_proc.LowPassFilter):
+        return shape, [(1.0, _gaussian_matrix(height, stage.sigma, sig_proc.GAUSSIAN_TRUNCATE),
+                        _gaussian_matrix(width, stage.sigma, sig_proc.GAUSSIAN_TRUNCATE))]
+    if isinstance(stage, sig_proc.DoGFilter):
+        return shape, [(1.0, _gaussian_matrix(height, stage.low_sigma, stage.truncate),
+                        _gaussian_matrix(width, stage.low_sigma, stage.truncate)),
+                       (-1.0, _gaussian_matrix(height, stage.high_sigma, stage.truncate),
+                        _gaussian_matrix(width, stage.high_sigma, stage.truncate))]
+    raise ValueError(f"{type(stage).__name__} isn't a linear stage")
+
+
+def unfused_cost(stages, shape):
+    """
+    The rough cost of running the stages one by one on an input of this shape,
+    in the same units as LinearOperator.cost.
+    """
+    cost = 0.0
+    for stage in stages:
+        pixels = float(np.prod(shape))
+        if isinstance(stage, sig_proc.Downsampler):
+            cost += pixels
+            shape = tuple([-(-size // factor) for size, factor in zip(shape, stage.downscale_dimensions)])
+        elif isinstance(stage, sig_proc.LowPassFilter):
+            cost += filtering_cost([(1.0, stage.sigma)], sig_proc.GAUSSIAN_TRUNCATE, shape)
+        elif isinstance(stage, sig_proc.DoGFilter):
+            cost += filtering_cost([(1.0, stage.low_sigma), (-1.0, stage.high_sigma)], stage.truncate, shape)
+        elif isinstance(stage, sig_proc.OutputScaler):
+            cost += pixels
+    return cost
+
+
+class LinearOperator:
+    """
+    The precomputed form of a run of linear stages, for one input shape.
+    The operator is built in float64 and then converted to dtype.
+    """
+
+    def __init__(self, stages, input_shape, dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        self.block = None
+        shape = input_shape
+        first_stage = 0
+        if isinstance(stages[0], sig_proc.Downsampler) and len(shape) == 2 and \
+                shape[0] % stages[0].downscale_dimensions[0] == 0 and shape[1] % stages[0].downscale_dimensions[1] == 0:
+            self.block = tuple(stages[0].downscale_dimensions)
+            shape = (shape[0] // self.block[0], shape[1] // self.block[1])
+            first_stage = 1
+        self.block_shape = shape
+
+        self.terms = [(1.0, None, None)]
+        self.flatten = False
+        self.weights = None
+        for stage in stages[first_stage:]:
+            if isinstance(stage, sig_proc.Flatten):
+                self.flatten = True
+            elif is_fusable_classifier(stage):
+                self._fold_classifier(stage.underlying_decoder, shape)
+            elif self.flatten:
+                raise ValueError("Only a classifier can follow Flatten")
+            else:
+                shape, stage_terms = _stage_terms(stage, shape)
+                self.terms = [(c_outer * c_inner, _compose(r_outer, r_inner), _compose(k_outer, k_inner))
+                              for c_inner, r_inner, k_inner in self.terms
+                              for c_outer, r_outer, k_outer in stage_terms]
+        self.output_shape = shape
+        self.output_size = (int(np.prod(shape)),) if self.flatten else shape
+        self.cost = self._cost(input_shape)
+        self.terms = [(c, None if rows is None else rows.astype(self.dtype), None if cols is None else cols.astype(self.dtype))
+                      for c, rows, cols in self.terms]
+        self._allocate_scratch(input_shape)
+
+    def _fold_classifier(self, classifier, shape):
+        # The decision for class k is <coef_k, y> + intercept_k, with y the output
+        # of the run so far. Pulling coef_k back through each term (R^T coef_k C)
+        # gives a weight map on the run's input instead.
+        coef = classifier.coef_
+        if coef.shape[1] != np.prod(shape):
+            raise ValueError(
+                f"Classifier expects {coef.shape[1]} features but the run produces {shape}")
+        weights = np.zeros((np.prod(self.block_shape), coef.shape[0]))
+        for k in range(coef.shape[0]):
+            weight_map = np.zeros(self.block_shape)
+            coef_map = coef[k].reshape(shape)
+            for c, rows, cols in self.terms:
+                pulled_back = coef_map if rows is None else rows.T @ coef_map
+                pulled_back = pulled_back if cols is None else pulled_back @ cols
+                weight_map += c * pulled_back
+            weights[:, k] = weight_map.ravel()
+        self.weights = weights.astype(self.dtype)
+        self.intercept = classifier.intercept_.astype(self.dtype)
+        self.classes = classifier.classes_
+
+    def _cost(self, input_shape):
+        # Per frame, in the units of unfused_cost
+        cost = float(np.prod(input_shape)) if self.block is not None else 0.0
+        if self.weights is not None:
+            return cost + MATMUL_COST_RATIO * np.prod(self.block_shape) * self.weights.shape[1]
+        for _, rows, cols in self.terms:
+            if rows is not None or cols is not None:
+                # Only 2D inputs have per-axis matrices
+                height, width = self.block_shape
+                out_rows = height if rows is None else rows.shape[0]
+                if rows is not None:
+                    cost += MATMUL_COST_RATIO * out_rows * height * width
+                if cols is not None:
+                    cost += MATMUL_COST_RATIO * out_rows * width * cols.shape[0]
+            cost += float(np.prod(self.output_shape))
+        return cost
+
+    def _allocate_scratch(self, input_shape):
+        # Everything evaluate needs is allocated here, once per input shape
+        self.input_buffer = None
+        if self.block is not None:
+            self.row_sums = np.zeros((self.block_shape[0], input_shape[1]), dtype=self.dtype)
+            self.row_scratch = np.zeros(self.row_sums.shape, dtype=self.dtype)
+            self.block_sums = np.zeros(self.block_shape, dtype=self.dtype)
+        if self.weights is not None:
+            self.scores = np.zeros(self.weights.shape[1], dtype=self.dtype)
+            return
+        self.row_products = [None if rows is None or cols is None else np.zeros((rows.shape[0], self.block_shape[1]), dtype=self.dtype)
+                             for _, rows, cols in self.terms]
+        self.term_buffer = np.zeros(self.output_shape, dtype=self.dtype)
+
+    def _block_mean(self, raw_input):
+        # Summing one axis at a time is much faster than reducing over both at once.
+        # Rows are copied into the operator's type before adding, since reducing
+        # compact (e.g. float32) frames straight into it goes through temporary buffers.
+        height, width = self.block_shape
+        np.copyto(self.row_sums, raw_input[0::self.block[0]], casting='same_kind')
+        for row in range(1, self.block[0]):
+            np.copyto(self.row_scratch, raw_input[row::self.block[0]], casting='same_kind')
+            np.add(self.row_sums, self.row_scratch, out=self.row_sums)
+        np.sum(self.row_sums.reshape((height, width, self.block[1])),
+               axis=2, out=self.block_sums)
+        np.multiply(self.block_sums, 1.0 / (self.block[0] * self.block[1]), out=self.block_sums)
+        return self.block_sums
+
+    def _as_dtype(self, raw_input):
+        if isinstance(raw_input, np.ndarray) and raw_input.dtype == self.dtype:
+            return raw_input
+        if self.input_buffer is None:
+            self.input_buffer = np.zeros(np.shape(raw_input), dtype=self.dtype)
+        np.copyto(self.input_buffer, raw_input)
+        return self.input_buffer
+
+    def evaluate(self, raw_input, out=None):
+        """
+        The output of the run (written into out, if given), or the classifier's
+        decision scores if it ends in one. Scores are only valid until the next call.
+        """
+        if self.block is not None:
+            x = self._block_mean(raw_input)
+        else:
+            x = self._as_dtype(raw_input)
+        if self.weights is not None:
+            np.dot(x.ravel(), self.weights, out=self.scores)
+            return np.add(self.scores, self.intercept, out=self.scores)
+
+        if out is None:
+            out = np.zeros(self.output_size, dtype=self.dtype)
+        result = out.reshape(self.output_shape)
+        for idx, (c, rows, cols) in enumerate(self.terms):
+            target = result if idx == 0 else self.term_buffer
+            if rows is None and cols is None:
+                np.copyto(target, x)
+            elif rows is None:
+                np.matmul(x, cols.T, out=target)
+            elif cols is None:
+                np.matmul(rows, x, out=target)
+            else:
+                np.matmul(rows, x, out=self.row_products[idx])
+                np.matmul(self.row_products[idx], cols.T, out=target)
+            if c != 1.0:
+                np.multiply(target, c, out=target)
+            if idx > 0:
+                np.add(result, target, out=result)
+        return out
+
+    def apply(self, raw_input, out=None):
+        result = self.evaluate(raw_input, out)
+        if self.weights is None:
+            return result
+        # Same decision rule as LinearSVC.predict
+        if self.weights.shape[1] == 1:
+            return self.classes[int(result[0] > 0)]
+        return self.classes[np.argmax(result)]
+
+
+class FusedLinearStage:
+    """
+    Runs a sequence of linear stages as one LinearOperator. Operators are built
+    for each input shape on first use, and only used once they've been checked
+    against the unfused stages (on the first frame and on a random probe).
+    If that check fails, or the operator wouldn't be any cheaper than the
+    stages, the stages are run one by one as usual.
+    """
+
+    def __init__(self, stages, dtype=np.float64):
+        self.stages = stages
+        self.dtype = np.dtype(dtype)
+        self.converts_compact_frames = getattr(
+            stages[0], 'converts_compact_frames', False)
+        # Input shape -> LinearOperator, or None if fusion isn't valid for that shape
+        self.operators = {}
+        # Output buffers for each stage but the last, when running them unfused
+        # (prepared like the pipeline prepares its own stages)
+        self.unfused_signature = None
+        self.unfused_buffers = None
+
+    def process(self, raw_input, out=None):
+        shape = np.shape(raw_input)
+        if shape not in self.operators:
+            self.operators[shape] = self._build_operator(raw_input)
+        operator = self.operators[shape]
+        if operator is None:
+            return self._process_unfused(raw_input, out)
+        return operator.apply(raw_input, out)
+
+    def process_batch(self, raw_inputs):
+        # Frame by frame through the same operator, so a batch matches its frames exactly
+        shape = raw_inputs.shape[1:]
+        if shape not in self.operators:
+            self.operators[shape] = self._build_operator(raw_inputs[0])
+        operator = self.operators[shape]
+        if operator is None:
+            result = raw_inputs
+            for stage in self.stages:
+                if hasattr(stage, 'process_batch'):
+                    result = stage.process_batch(result)
+                else:
+                    result = np.array([stage.process(frame) for frame in result])
+            return result
+        return np.array([operator.apply(frame) for frame in raw_inputs])
+
+    def prepare(self, input_shape, input_dtype):
+        # There's no frame yet, so the operator is only checked against a random probe
+        if input_shape not in self.operators:
+            self.operators[input_shape] = self._build_operator(
+                np.zeros(input_shape, dtype=input_dtype))
+        operator = self.operators[input_shape]
+        if operator is None:
+            return self._prepare_unfused(input_shape, input_dtype)
+        if operator.weights is not None:
+            return None
+        return operator.output_size, self.dtype
+
+    def _prepare_unfused(self, input_shape, input_dtype):
+        self.unfused_signature = (tuple(input_shape), np.dtype(input_dtype))
+        self.unfused_buffers = None
+        layouts = []
+        signature = self.unfused_signature
+        for stage in self.stages:
+            layout = stage.prepare(*signature) if hasattr(stage, 'prepare') else None
+            if layout is None:
+                return None
+            layouts.append(layout)
+            signature = (tuple(layout[0]), np.dtype(layout[1]))
+        self.unfused_buffers = [np.zeros(shape, dtype=dtype) for shape, dtype in layouts[:-1]]
+        return layouts[-1]
+
+    def _process_unfused(self, raw_input, out=None):
+        buffers = self.unfused_buffers
+        if out is None or buffers is None or \
+                self.unfused_signature != (np.shape(raw_input), np.result_type(raw_input)):
+            result = raw_input
+            for stage in self.stages:
+                result = stage.process(result)
+            return result
+        result = raw_input
+        for stage, buffer in zip(self.stages, buffers + [out]):
+            result = stage.process(result, out=buffer)
+        return result
+
+    def _reference(self, raw_input):
+        # What the unfused stages produce (decision scores, for a classifier)
+        result = raw_input
+        for stage in self.stages:
+            if is_fusable_classifier(stage):
+                return stage.underlying_decoder.decision_function(result.reshape(1, -1))[0]
+            result = stage.process(result)
+        return result
+
+    def _build_operator(self, frame):
+        names = [type(s).__name__ for s in self.stages]
+        try:
+            operator = LinearOperator(self.stages, np.shape(frame), self.dtype)
+        except ValueError as err:
+            logging.warn(f"Can't fuse {names}, running them unfused. Details: {err}")
+            return None
+        if operator.weights is None and operator.cost >= unfused_cost(self.stages, np.shape(frame)):
+            logging.info(
+                f"Running {names} unfused for {np.shape(frame)} inputs, since fusing them wouldn't be cheaper")
+            return None
+
+        rng = np.random.default_rng(VALIDATION_SEED)
+        probe = rng.uniform(0, max(1.0, float(np.max(np.abs(frame)))),
+                            size=np.shape(frame)).astype(self.dtype)
+        rtol, atol = (FUSION_RTOL, FUSION_ATOL) if self.dtype == np.float64 else (
+            FUSION_RTOL_FLOAT32, FUSION_ATOL_FLOAT32)
+        for test_input in [frame, probe]:
+            fused = operator.evaluate(test_input)
+            reference = self._reference(test_input)
+            scale = max(1.0, float(np.max(np.abs(reference))))
+            fused = np.ravel(fused)
+            reference = np.ravel(reference)
+            if fused.shape != reference.shape or not np.allclose(fused, reference, rtol=rtol, atol=atol * scale):
+                logging.warn(
+                    f"Fused {names} doesn't match the unfused stages, running them unfused.")
+                return None
+        logging.info(f"Fused {names} for {np.shape(frame)} inputs")
+        return operator
@@ -0,0 +1,231 @@
+import numpy as np
+from scipy.ndimage import uniform_filter1d
+
+"""
+Median filters over a square window, for a fixed image shape and type, set up
+once and then applied to every frame. Edges are handled like mode='nearest'.
+
+Small windows (3x3 and 5x5) are exact, and use sorting networks on whole
+shifted copies of the frame, so every step is a single numpy min or max:
+  1. Each column of the window is sorted, once per frame rather than per pixel,
+     since neighbouring windows share columns.
+  2. Each rank of those sorted columns is sorted across the window. The result
+     is sorted along both axes, which rules out most of its entries as the median
+     without comparing them any further.
+  3. The median is selected from the few entries left.
+Only the comparisons that can affect the median are kept.
+
+Larger windows are histogram-based: the frame is quantised into levels between
+its minimum and maximum, and for each level a box filter counts how many pixels
+in each window are at or below it. That costs the same whatever the window size,
+but the result is only as precise as a level (exact for integer frames that span
+no more than that many values).
+"""
+
+LARGEST_NETWORK_SIZE = 5
+DEFAULT_LEVELS = 32
+
+
+def sorting_network(n):
+    """
+    Batcher's odd-even merge sort for n wires, as (i, j) compare-exchanges that
+    leave the smaller value on i.
+    """
+    size = 1
+    while size < n:
+        size *= 2
+    pairs = []
+    p = 1
+    while p < size:
+        k = p
+        while k >= 1:
+            for j in range(k % p, size - k, 2 * k):
+                for i in range(min(k, size - j - k)):
+                    if (i + j) // (2 * p) == (i + j + k) // (2 * p):
+                        pairs.append((i + j, i + j + k))
+            k //= 2
+        p *= 2
+    # Missing wires behave like +inf at the top, so comparisons with them do nothing
+    return [(i, j) for i, j in pairs if j < n]
+
+
+def _prune(network, needed_outputs):
+    """
+    Returns [(i, j, keep_min, keep_max)] for the comparisons that can affect needed_outputs.
+    """
+    needed = set(needed_outputs)
+    pruned = []
+    for i, j in reversed(network):
+        keep_min, keep_max = i in needed, j in needed
+        if keep_min or keep_max:
+            pruned.append((i, j, keep_min, keep_max))
+            needed.update([i, j])
+    return list(reversed(pruned))
+
+
+class _Program:
+    """
+    A pruned network compiled to a list of numpy calls on preallocated buffers.
+    inputs are arrays (typically views) that the program reads but never writes.
+    """
+
+    def __init__(self, network, inputs, needed_outputs):
+        self.values = list(inputs)
+        num_inputs = len(inputs)
+        shape, dtype = inputs[0].shape, inputs[0].dtype
+        free = []
+
+        def allocate():
+            if free:
+                return free.pop()
+            self.values.append(np.zeros(shape, dtype=dtype))
+            return len(self.values) - 1
+
+        def release(location, *keep):
+            if location >= num_inputs and location not in keep:
+                free.append(location)
+
+        wires = list(range(num_inputs))
+        self.operations = []
+        for i, j, keep_min, keep_max in _prune(network, needed_outputs):
+            a, b = wires[i], wires[j]
+            if keep_min and keep_max:
+                low = allocate()
+                high = a if a >= num_inputs else (b if b >= num_inputs else allocate())
+                self.operations.append((np.minimum, a, b, low))
+                self.operations.append((np.maximum, a, b, high))
+                release(a, high)
+                release(b, high)
+                wires[i], wires[j] = low, high
+            else:
+                out = a if a >= num_inputs else (b if b >= num_inputs else allocate())
+                self.operations.append((np.minimum if keep_min else np.maximum, a, b, out))
+                release(a, out)
+                release(b, out)
+                wires[i if keep_min else j] = out
+        self.outputs = [self.values[wires[w]] for w in needed_outputs]
+
+    def run(self):
+        values = self.values
+        for function, a, b, out in self.operations:
+            function(values[a], values[b], out=values[out])
+        return self.outputs
+
+
+class MedianPlan:
+    def __init__(self, size, shape, dtype, levels=DEFAULT_LEVELS):
+        assert(size % 2 == 1)
+        self.size = size
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.levels = levels
+        self.radius = size // 2
+        height, width = self.shape
+        self.padded = np.zeros((height + 2 * self.radius, width + 2 * self.radius), dtype=self.dtype)
+        if size <= LARGEST_NETWORK_SIZE:
+            self._prepare_networks()
+        else:
+            self._prepare_histogram()
+
+    def _prepare_networks(self):
+        k = self.size
+        height, width = self.shape
+        # Window column c at rank r (after sorting columns) is wire r * k + c
+        column_inputs = [self.padded[row:row + height, :] for row in range(k)]
+        self.sort_columns = _Program(sorting_network(k), column_inputs, list(range(k)))
+        ranks = self.sort_columns.outputs
+
+        # Entries that at least half the window is known to be below, or above
+        count = k * k
+        middle = count // 2
+        candidates = []
+        num_below = 0
+        for rank in range(k):
+            for column in range(k):
+                if (rank + 1) * (column + 1) - 1 > middle:
+                    continue
+                if count - (k - rank) * (k - column) < middle:
+                    num_below += 1
+                    continue
+                candidates.append(rank * k + column)
+        network = []
+        for rank in range(k):
+            network += [(rank * k + i, rank * k + j) for i, j in sorting_network(k)]
+        # Sort the candidates among themselves, keeping only the one in the middle
+        network += [(candidates[i], candidates[j]) for i, j in sorting_network(len(candidates))]
+
+        # Shifting the flattened ranks keeps every operand contiguous (numpy copies
+        # strided ones into temporaries). Output pixel (y, x) lands at y * padded_width + x;
+        # the values that wrap around between rows only land in the padding columns.
+        padded_width = width + 2 * self.radius
+        length = height * padded_width - 2 * self.radius
+        window_inputs = [ranks[rank].reshape(-1)[column:column + length]
+                         for rank in range(k) for column in range(k)]
+        self.select_median = _Program(network, window_inputs, [candidates[middle - num_below]])
+        median = self.select_median.outputs[0]
+        self.median = np.lib.stride_tricks.as_strided(
+            median, shape=self.shape, strides=(padded_width * median.itemsize, median.itemsize))
+
+    def _prepare_histogram(self):
+        # Every operation is between arrays of one type, since mixing types makes
+        # numpy allocate temporaries to cast through
+        scaled_dtype = self.dtype if np.issubdtype(self.dtype, np.floating) else np.float64
+        self.scaled = np.zeros(self.shape, dtype=scaled_dtype)
+        self.quantised = np.zeros(self.shape, dtype=np.int32)
+        self.mask = np.zeros(self.shape, dtype=bool)
+        self.at_or_below = np.zeros(self.shape, dtype=np.float32)
+        self.column_counts = np.zeros(self.shape, dtype=np.float32)
+        self.window_counts = np.zeros(self.shape, dtype=np.float32)
+        self.levels_below = np.zeros(self.shape, dtype=np.int32)
+        # Window counts are box filter means, so compare them with the median's share
+        self.median_fraction = (self.size * self.size // 2 + 0.5) / (self.size * self.size)
+
+    def apply(self, image, out):
+        if self.size > LARGEST_NETWORK_SIZE:
+            return self._apply_histogram(image, out)
+        r = self.radius
+        height, width = self.shape
+        padded = self.padded
+        padded[r:r + height, r:r + width] = image
+        padded[:r, r:r + width] = image[:1, :]
+        padded[r + height:, r:r + width] = image[-1:, :]
+        padded[:, :r] = padded[:, r:r + 1]
+        padded[:, r + width:] = padded[:, r + width - 1:r + width]
+        self.sort_columns.run()
+        self.select_median.run()
+        np.copyto(out, self.median)
+        return out
+
+    def _apply_histogram(self, image, out):
+        low, high = image.min(), image.max()
+        if high == low:
+            out[...] = low
+            return out
+        if np.issubdtype(self.dtype, np.integer):
+            step = max(1, -(-(int(high) - int(low) + 1) // self.levels))
+        else:
+            step = (high - low) / self.levels
+        scaled = self.scaled
+        np.copyto(scaled, image, casting='unsafe')
+        np.subtract(scaled, low, out=scaled)
+        np.floor_divide(scaled, step, out=scaled)
+        np.minimum(scaled, self.levels - 1, out=scaled)
+        np.copyto(self.quantised, scaled, casting='unsafe')
+
+        self.levels_below[...] = 0
+        for level in range(int(self.quantised.max())):
+            np.less_equal(self.quantised, level, out=self.mask)
+            np.copyto(self.at_or_below, self.mask)
+            uniform_filter1d(self.at_or_below, self.size, axis=0, output=self.column_counts, mode='nearest')
+            uniform_filter1d(self.column_counts, self.size, axis=1, output=self.window_counts, mode='nearest')
+            np.less(self.window_counts, self.median_fraction, out=self.mask)
+            if not self.mask.any():
+                # Every median is at or below this level
+                break
+            np.add(self.levels_below, 1, out=self.levels_below, where=self.mask)
+        # The middle of the median's level (its exact value, for integer steps of one)
+        offset = (step // 2) if np.issubdtype(self.dtype, np.integer) else step / 2
+        np.copyto(out, self.levels_below, casting='unsafe')
+        np.multiply(out, step, out=out, casting='unsafe')
+        np.add(out, low + offset, out=out, casting='unsafe')
+        return out
@@ -14,9 +14,29 @@ class FlowMotionCorrection:
 
         self.reference_image = reference_image
         self.movement_mesh = np.meshgrid(np.arange(reference_image.shape[0]), np.arange(reference_image.shape[1]), indexing='ij')
+        self.flow_reference = reference_image
+        # The last flow field estimated, which degraded frames reuse
+        self.last_flow = None
+
+    def set_precision(self, dtype):
+        # The flow is always estimated in float32 (skimage's default), but the
+        # warp follows the type of the coordinates. Converting the reference
+        # here also saves optical_flow_ilk converting it on every frame.
+        self.flow_reference = self.reference_image.astype(dtype)
+        self.movement_mesh = [m.astype(dtype) for m in self.movement_mesh]
 
     def process(self, raw_input):
-        v, u = optical_flow_ilk(self.reference_image, raw_input, num_warp=self.num_warp, radius=self.radius)
+        self.last_flow = optical_flow_ilk(self.flow_reference, raw_input, num_warp=self.num_warp, radius=self.radius)
+        return self._warp(raw_input, self.last_flow)
+
+    def process_degraded(self, raw_input):
+        # Estimating the flow is most of the cost, and motion changes slowly between frames
+        if self.last_flow is None:
+            return self.process(raw_input)
+        return self._warp(raw_input, self.last_flow)
+
+    def _warp(self, raw_input, flow):
+        v, u = flow
         return warp(raw_input, np.array([self.movement_mesh[0] + v, self.movement_mesh[1] + u]), mode='edge')
 
     def from_json(json_params):
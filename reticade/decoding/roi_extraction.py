@@ -0,0 +1,106 @@
+import numpy as np
+from scipy import sparse
+from scipy.ndimage import find_objects, distance_transform_edt
+import reticade.util.serialization as serial
+
+"""
+Per-cell fluorescence traces from a frame, rather than a grid of pixels.
+
+Cells are given as a label image (0 for background, and a distinct positive
+label for each cell's footprint). Each cell's trace is the mean of its footprint
+minus a fraction of the mean of the surrounding neuropil: a ring around the
+cell, a little way out from it, that excludes every cell's pixels. Both means
+are linear in the frame, so all the traces come from a single sparse
+matrix-vector product per frame.
+"""
+
+# Suite2p's defaults
+DEFAULT_NEUROPIL_COEFFICIENT = 0.7
+DEFAULT_NEUROPIL_GAP = 2
+DEFAULT_NEUROPIL_WIDTH = 5
+
+
+def neuropil_rings(roi_mask, gap, width):
+    """
+    Returns [(label, ring pixel indices)] for each cell in roi_mask, where a
+    ring holds the pixels more than gap and at most gap + width from the cell.
+    """
+    any_cell = roi_mask > 0
+    reach = gap + width
+    rings = []
+    for index, region in enumerate(find_objects(roi_mask)):
+        if region is None:
+            continue
+        label = index + 1
+        # Only the cell's bounding box (grown by the ring) can hold its ring
+        window = tuple(slice(max(0, s.start - reach), min(n, s.stop + reach))
+                       for s, n in zip(region, roi_mask.shape))
+        distance = distance_transform_edt(roi_mask[window] != label)
+        in_ring = (distance > gap) & (distance <= reach) & ~any_cell[window]
+        rows, columns = np.nonzero(in_ring)
+        rings.append((label, np.ravel_multi_index(
+            (rows + window[0].start, columns + window[1].start), roi_mask.shape)))
+    return rings
+
+
+class RoiExtractor:
+    """
+    Takes a frame with the same shape as roi_mask and returns one trace per
+    cell, in order of label.
+    """
+
+    def __init__(self, roi_mask, neuropil_coefficient=DEFAULT_NEUROPIL_COEFFICIENT,
+                 neuropil_gap=DEFAULT_NEUROPIL_GAP, neuropil_width=DEFAULT_NEUROPIL_WIDTH):
+        # The smallest type that holds the labels, since the mask is saved with the decoder
+        self.roi_mask = roi_mask.astype(np.min_scalar_type(max(int(roi_mask.max()), 1)))
+        self.neuropil_coefficient = neuropil_coefficient
+        self.neuropil_gap = neuropil_gap
+        self.neuropil_width = neuropil_width
+        self.weights = self._build_weights().tocsr()
+
+    def _build_weights(self):
+        pixel_labels = self.roi_mask.reshape(-1)
+        # Each label's pixels are a contiguous run of this ordering
+        order = np.argsort(pixel_labels, kind='stable')
+        labels, starts, counts = np.unique(pixel_labels[order], return_index=True, return_counts=True)
+        rings = dict(neuropil_rings(self.roi_mask, self.neuropil_gap, self.neuropil_width))
+        rows, columns, values = [], [], []
+        cells = [(label, start, count) for label, start, count in zip(labels, starts, counts) if label > 0]
+        for row, (label, start, count) in enumerate(cells):
+            rows.append(np.full(count, row))
+            columns.append(order[start:start + count])
+            values.append(np.full(count, 1.0 / count))
+            ring = rings[label]
+            if len(ring) > 0:
+                rows.append(np.full(len(ring), row))
+                columns.append(ring)
+                values.append(np.full(len(ring), -self.neuropil_coefficient / len(ring)))
+        self.num_cells = len(cells)
+        if not cells:
+            return sparse.coo_matrix((0, pixel_labels.size))
+        return sparse.coo_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(columns))),
+                                 shape=(self.num_cells, pixel_labels.size))
+
+    def set_precision(self, dtype):
+        # scipy would otherwise convert every frame to the matrix's type
+        self.weights = self.weights.astype(dtype)
+
+    def process(self, raw_input):
+        return self.weights @ raw_input.reshape(-1)
+
+    def process_batch(self, raw_inputs):
+        flattened = raw_inputs.reshape(raw_inputs.shape[0], -1)
+        return np.ascontiguousarray((self.weights @ flattened.T).T)
+
+    def from_json(json_params):
+        roi_mask = serial.obj_from_picklestring(json_params['roi_mask'])
+        return RoiExtractor(roi_mask, float(json_params['neuropil_coefficient']),
+                            int(json_params['neuropil_gap']), int(json_params['neuropil_width']))
+
+    def to_json(self):
+        return {'name': 'RoiExtractor',
+                'params': {
+                    'roi_mask': serial.obj_to_picklestring(self.roi_mask),
+                    'neuropil_coefficient': self.neuropil_coefficient,
+                    'neuropil_gap': self.neuropil_gap,
+                    'neuropil_width': self.neuropil_width}}
@@ -4,14 +4,144 @@ from skimage.filters import difference_of_gaussians
 from skimage.filters import median
 from skimage.filters import gaussian
 import reticade.util.serialization as serial
+from reticade.decoding.gaussian_plan import GaussianPlan
+from reticade.decoding.median_plan import MedianPlan, DEFAULT_LEVELS
+
+"""
+Stages that define prepare(input_shape, input_dtype) also accept an output
+buffer: process(raw_input, out=buffer). prepare returns the (shape, dtype)
+of the buffer to allocate for inputs of that shape and type, or None if the
+stage allocates its own output. The pipeline calls prepare once per input
+shape, then reuses the same buffer for every frame.
+
+Stages that define set_precision(dtype) hold state or produce a fixed type,
+and are told by the pipeline if it runs in a precision other than float64.
+The rest compute in the type of their input.
+
+Stages that define process_degraded have a cheaper approximation, which the
+pipeline switches to when a frame is at risk of missing its deadline. If it's
+only cheaper for some inputs, degrades(input_shape, input_dtype) says whether
+it is for those, and the pipeline checks it whenever it prepares the stage.
+"""
+
+# Standard deviations of the kernel kept by a DoG filter that's short of time
+DEGRADED_TRUNCATE = 2.0
+# skimage.filters.gaussian's default
+GAUSSIAN_TRUNCATE = 4.0
+# How far DeltaFSliding's percentile baseline moves per frame, in units of the
+# pixel's typical deviation from its mean, divided by the slow window's length
+PERCENTILE_STEP_SCALE = 10.0
+
+
+def _float_dtype(input_dtype):
+    # The type skimage's filters produce for this input type
+    if np.issubdtype(input_dtype, np.floating) and np.dtype(input_dtype).itemsize <= 4:
+        return np.dtype(np.float32)
+    return np.dtype(np.float64)
+
+
+def _image_sigma(sigma, ndim):
+    # A zero sigma leaves the frame axis of a stack unfiltered
+    return (0,) * (ndim - 2) + (sigma, sigma)
+
+
+def _gaussian_plan(plans, terms, truncate, shape, dtype, use_fft=None):
+    # Plans are kept per frame shape, type and truncation, since each stage sees few
+    # of them. Stacks reuse their frames' plan, so batches of any length share one.
+    frame_shape = tuple(shape[-2:])
+    key = (frame_shape, np.dtype(dtype), truncate, use_fft)
+    if key not in plans:
+        plans[key] = GaussianPlan(terms, truncate, frame_shape, dtype, use_fft)
+    return plans[key]
+
+
+def _apply_plan(plan, raw_input, out):
+    if raw_input.ndim == 2:
+        return plan.apply(raw_input, out)
+    frames = raw_input.reshape((-1,) + raw_input.shape[-2:])
+    for frame, frame_out in zip(frames, out.reshape(frames.shape)):
+        plan.apply(frame, frame_out)
+    return out
 
 
 class Downsampler:
+    # Averaging compact (uint16/float32) frames straight into the pipeline's
+    # precision means the full-resolution frame never needs converting.
+    converts_compact_frames = True
+
     def __init__(self, downscale_dimensions):
         self.downscale_dimensions = downscale_dimensions
-
-    def process(self, raw_input):
-        return downscale_local_mean(raw_input, self.downscale_dimensions)
+        self.dtype = np.float64
+        # Buffers for exact divisors, allocated per input shape
+        self.column_sums = None
+        self.scratch = None
+
+    def set_precision(self, dtype):
+        self.dtype = dtype
+        self.column_sums = None
+
+    def process(self, raw_input, out=None):
+        if not self._divides(raw_input.shape):
+            return self._padded_mean(raw_input, out)
+        if self.column_sums is None or self.column_sums.shape != self._column_sums_shape(raw_input.shape):
+            self._allocate_column_sums(raw_input.shape)
+        return self._block_mean(raw_input, out, self.column_sums, self.scratch)
+
+    def prepare(self, input_shape, input_dtype):
+        output_shape = tuple([-(-size // factor) for size, factor
+                              in zip(input_shape, self.downscale_dimensions)])
+        if self._divides(input_shape):
+            self._allocate_column_sums(input_shape)
+        return output_shape, self.dtype
+
+    def process_batch(self, raw_inputs):
+        # Frames are stacked along the first axis, which isn't downscaled
+        if not self._divides(raw_inputs.shape):
+            return self._padded_mean(raw_inputs, None)
+        shape = self._column_sums_shape(raw_inputs.shape)
+        return self._block_mean(raw_inputs, None, np.zeros(shape, dtype=self.dtype),
+                                np.zeros(shape, dtype=self.dtype))
+
+    def _divides(self, shape):
+        rows, columns = self.downscale_dimensions
+        return shape[-2] % rows == 0 and shape[-1] % columns == 0
+
+    def _column_sums_shape(self, shape):
+        return tuple(shape[:-1]) + (shape[-1] // self.downscale_dimensions[1],)
+
+    def _allocate_column_sums(self, input_shape):
+        shape = self._column_sums_shape(input_shape)
+        self.column_sums = np.zeros(shape, dtype=self.dtype)
+        self.scratch = np.zeros(shape, dtype=self.dtype)
+
+    def _block_mean(self, raw_input, out, column_sums, scratch):
+        # Sums each block's columns and then its rows, several times faster than
+        # skimage's block views for small factors. Strided slices are copied into
+        # scratch before adding, since ufuncs on them go through temporary buffers.
+        rows, columns = self.downscale_dimensions
+        if out is None:
+            out = np.zeros(column_sums.shape[:-2] + (column_sums.shape[-2] // rows,
+                                                     column_sums.shape[-1]), dtype=self.dtype)
+        np.copyto(column_sums, raw_input[..., 0::columns], casting='same_kind')
+        for column in range(1, columns):
+            np.copyto(scratch, raw_input[..., column::columns], casting='same_kind')
+            np.add(column_sums, scratch, out=column_sums)
+        np.copyto(out, column_sums[..., 0::rows, :])
+        row_scratch = scratch[..., :out.shape[-2], :]
+        for row in range(1, rows):
+            np.copyto(row_scratch, column_sums[..., row::rows, :])
+            np.add(out, row_scratch, out=out)
+        return np.divide(out, rows * columns, out=out)
+
+    def _padded_mean(self, raw_input, out):
+        # Sizes that don't divide exactly are padded with zeros, as skimage does
+        factors = (1,) * (raw_input.ndim - 2) + tuple(self.downscale_dimensions)
+        # Converted first, so that compact float32 frames are averaged at full precision
+        result = downscale_local_mean(raw_input.astype(self.dtype, copy=False), factors)
+        if out is None:
+            return result
+        np.copyto(out, result)
+        return out
 
     def from_json(json_params):
         dimensions = (int(json_params['x_dim']), int(json_params['y_dim']))
@@ -24,36 +154,106 @@ class Downsampler:
 
 
 class DoGFilter:
-    def __init__(self, low_sigma, high_sigma, truncate=3.0):
+    def __init__(self, low_sigma, high_sigma, truncate=3.0, degraded_truncate=DEGRADED_TRUNCATE):
         self.low_sigma = low_sigma
         self.high_sigma = high_sigma
         # How many standard deviations to include:
         # Low number: choppy filter that's fast to run.
         self.truncate = truncate
-
-    def process(self, raw_input):
-        return difference_of_gaussians(raw_input, self.low_sigma, self.high_sigma, truncate=self.truncate)
+        # Used instead when the pipeline is short of time
+        self.degraded_truncate = min(truncate, degraded_truncate)
+        self.plans = {}
+
+    def process(self, raw_input, out=None):
+        return self._filter(raw_input, False, out)
+
+    def process_degraded(self, raw_input, out=None):
+        return self._filter(raw_input, True, out)
+
+    def _plan(self, shape, dtype, degraded):
+        terms = [(1.0, self.low_sigma), (-1.0, self.high_sigma)]
+        plan = _gaussian_plan(self.plans, terms, self.truncate, shape, dtype)
+        if not degraded:
+            return plan
+        # A shorter kernel only saves time when filtering directly, since an FFT
+        # costs the same whatever the kernel's width. If even the shorter direct
+        # filter wouldn't beat the usual plan, there's nothing cheaper to fall back on.
+        degraded_plan = _gaussian_plan(self.plans, terms, self.degraded_truncate, shape, dtype, use_fft=False)
+        return degraded_plan if degraded_plan.cost < plan.cost else plan
+
+    def _filter(self, raw_input, degraded, out):
+        if not np.issubdtype(raw_input.dtype, np.floating):
+            # skimage rescales integer images, so leave those to it
+            truncate = self.degraded_truncate if degraded else self.truncate
+            return difference_of_gaussians(raw_input, _image_sigma(self.low_sigma, raw_input.ndim),
+                                           _image_sigma(self.high_sigma, raw_input.ndim), truncate=truncate)
+        output_dtype = _float_dtype(raw_input.dtype)
+        plan = self._plan(raw_input.shape, output_dtype, degraded)
+        if out is None:
+            out = np.empty(raw_input.shape, dtype=output_dtype)
+        return _apply_plan(plan, raw_input, out)
+
+    def prepare(self, input_shape, input_dtype):
+        # Set up both plans now, rather than when the frame is already short of time
+        output_dtype = _float_dtype(input_dtype)
+        if np.issubdtype(input_dtype, np.floating):
+            self._plan(input_shape, output_dtype, degraded=True)
+        return input_shape, output_dtype
+
+    def degrades(self, input_shape, input_dtype):
+        if not np.issubdtype(input_dtype, np.floating):
+            return True
+        output_dtype = _float_dtype(input_dtype)
+        plan = self._plan(input_shape, output_dtype, degraded=False)
+        return self._plan(input_shape, output_dtype, degraded=True) is not plan
+
+    def process_batch(self, raw_inputs):
+        # Stacks are filtered frame by frame, with the frames' plan
+        return self._filter(raw_inputs, False, None)
 
     def from_json(json_params):
         low_sigma = float(json_params['low_sigma'])
         high_sigma = float(json_params['high_sigma'])
         truncate = float(json_params['truncate'])
-        return DoGFilter(low_sigma, high_sigma, truncate)
+        degraded_truncate = float(json_params.get('degraded_truncate', DEGRADED_TRUNCATE))
+        return DoGFilter(low_sigma, high_sigma, truncate, degraded_truncate)
 
     def to_json(self):
         return {'name': 'DoGFilter',
                 'params': {
                     'low_sigma': self.low_sigma,
                     'high_sigma': self.high_sigma,
-                    'truncate': self.truncate}}
+                    'truncate': self.truncate,
+                    'degraded_truncate': self.degraded_truncate}}
 
 
 class LowPassFilter:
     def __init__(self, sigma):
         self.sigma = sigma
-
-    def process(self, raw_input):
-        return gaussian(raw_input, self.sigma)
+        self.plans = {}
+
+    def process(self, raw_input, out=None):
+        if not np.issubdtype(raw_input.dtype, np.floating):
+            # skimage rescales integer images, so leave those to it. Its output
+            # argument was renamed between releases, so copy into out instead.
+            result = gaussian(raw_input, _image_sigma(self.sigma, raw_input.ndim))
+            if out is None:
+                return result
+            np.copyto(out, result)
+            return out
+        output_dtype = _float_dtype(raw_input.dtype)
+        plan = _gaussian_plan(self.plans, [(1.0, self.sigma)], GAUSSIAN_TRUNCATE,
+                              raw_input.shape, output_dtype)
+        if out is None:
+            out = np.empty(raw_input.shape, dtype=output_dtype)
+        return _apply_plan(plan, raw_input, out)
+
+    def prepare(self, input_shape, input_dtype):
+        return input_shape, _float_dtype(input_dtype)
+
+    def process_batch(self, raw_inputs):
+        # Stacks are filtered frame by frame, with the frames' plan
+        return self.process(raw_inputs)
 
     def from_json(json_params):
         sigma = float(json_params['sigma'])
@@ -65,6 +265,7 @@ class LowPassFilter:
                     'sigma': self.sigma}}
 
 # Note(charlie): this filter is slow (per-pixel sort and rank)
+# Note: FastMedianFilter is a much quicker alternative for small windows
 
 
 class MedianFilter:
@@ -82,6 +283,55 @@ class MedianFilter:
                 'params': {}}
 
 
+class FastMedianFilter:
+    """
+    Median over a size x size window, with edges handled like mode='nearest'.
+    Exact for 3x3 and 5x5 windows. Larger windows are approximated to within
+    half of one of levels evenly spaced steps over each frame's range (see
+    median_plan).
+    """
+
+    def __init__(self, size=3, levels=DEFAULT_LEVELS):
+        assert(size % 2 == 1)
+        self.size = size
+        self.levels = levels
+        self.plans = {}
+
+    def process(self, raw_input, out=None):
+        if out is None:
+            out = np.empty(raw_input.shape, dtype=raw_input.dtype)
+        if raw_input.ndim > 2:
+            for frame, frame_out in zip(raw_input, out):
+                self.process(frame, out=frame_out)
+            return out
+        return self._plan(raw_input.shape, raw_input.dtype).apply(raw_input, out)
+
+    def _plan(self, shape, dtype):
+        key = (tuple(shape), np.dtype(dtype))
+        if key not in self.plans:
+            self.plans[key] = MedianPlan(self.size, shape, dtype, self.levels)
+        return self.plans[key]
+
+    def prepare(self, input_shape, input_dtype):
+        if len(input_shape) == 2:
+            self._plan(input_shape, input_dtype)
+        return input_shape, np.dtype(input_dtype)
+
+    def process_batch(self, raw_inputs):
+        return self.process(raw_inputs)
+
+    def from_json(json_params):
+        size = int(json_params['size'])
+        levels = int(json_params['levels'])
+        return FastMedianFilter(size, levels)
+
+    def to_json(self):
+        return {'name': 'FastMedianFilter',
+                'params': {
+                    'size': self.size,
+                    'levels': self.levels}}
+
+
 class DeltaFFilter:
     def __init__(self, fast_alpha, slow_alpha, dimensions, initial_state=None):
         assert(fast_alpha > slow_alpha)
@@ -90,12 +340,21 @@ class DeltaFFilter:
         self.fast_history = np.zeros(dimensions)
         self.slow_history = np.zeros(dimensions)
         self.reference_image = None
+        self.dtype = np.float64
         if initial_state is not None:
             self.fast_history = initial_state
             self.slow_history = initial_state
             self.reference_image = initial_state
 
-    def process(self, raw_input):
+    def set_precision(self, dtype):
+        # The reference image is kept as it is, so that it saves at full precision
+        self.dtype = dtype
+        self.fast_history = self.fast_history.astype(dtype)
+        self.slow_history = self.slow_history.astype(dtype)
+
+    def process(self, raw_input, out=None):
+        if out is not None:
+            return self._process_in_place(raw_input, out)
         self.fast_history = raw_input * self.fast_alpha + \
             (1 - self.fast_alpha) * self.fast_history
         self.slow_history = raw_input * self.slow_alpha + \
@@ -104,6 +363,32 @@ class DeltaFFilter:
         # Note(charlie): using divide instead of true divide so that division by zero results in zero silently
         return np.divide(difference, self.slow_history)
 
+    def _process_in_place(self, raw_input, out):
+        # The same arithmetic as above, in the same order, so results are identical
+        for history, alpha in [(self.fast_history, self.fast_alpha), (self.slow_history, self.slow_alpha)]:
+            if self.compact_weighted_input is None:
+                np.multiply(raw_input, alpha, out=self.weighted_input)
+            else:
+                # Compact inputs are scaled in their own type first, as above
+                np.multiply(raw_input, alpha, out=self.compact_weighted_input)
+                np.copyto(self.weighted_input, self.compact_weighted_input)
+            np.multiply(history, 1 - alpha, out=history)
+            np.add(self.weighted_input, history, out=history)
+        np.subtract(self.fast_history, self.slow_history, out=out)
+        return np.divide(out, self.slow_history, out=out)
+
+    def prepare(self, input_shape, input_dtype):
+        # The histories are updated in place from now on, so they mustn't
+        # share memory with each other or with the reference image.
+        self.fast_history = np.array(self.fast_history, dtype=self.dtype)
+        self.slow_history = np.array(self.slow_history, dtype=self.dtype)
+        self.weighted_input = np.zeros(input_shape, dtype=self.dtype)
+        self.compact_weighted_input = None
+        if np.result_type(input_dtype, self.fast_alpha) != self.dtype:
+            self.compact_weighted_input = np.zeros(
+                input_shape, dtype=np.result_type(input_dtype, self.fast_alpha))
+        return input_shape, self.dtype
+
     def from_json(json_params):
         fast_alpha = float(json_params['fast_alpha'])
         slow_alpha = float(json_params['slow_alpha'])
@@ -127,40 +412,138 @@ class DeltaFFilter:
 
 
 class DeltaFSliding:
-    def __init__(self, fast_samples, slow_samples, dimensions):
-        # Todo: experiment with this
+    """
+    dF/F over sliding windows: the mean of the last fast_samples frames, relative
+    to a baseline F0 from the last slow_samples frames. F0 is the mean of those
+    frames or, with baseline_percentile (e.g. 10), a running estimate of that
+    low percentile of each pixel, which transients pull up far less than the mean.
+
+    The window means are kept as running sums over ring buffers, so a frame costs
+    the same however long the windows are. The percentile is tracked by nudging
+    F0 up or down towards each new frame, in steps scaled to how much the pixel
+    varies, so it forgets old frames gradually rather than at the window edge.
+    """
+
+    def __init__(self, fast_samples, slow_samples, dimensions, baseline_percentile=None):
         self.num_samples = 0
+        self.dtype = np.float64
+        self.baseline_percentile = baseline_percentile
         self.fast_history = np.zeros(
             (fast_samples, dimensions[0], dimensions[1]))
         self.slow_history = np.zeros(
             (slow_samples, dimensions[0], dimensions[1]))
-
-    def process(self, raw_input):
-        self.fast_history[self.num_samples %
-                          self.fast_history.shape[0], :, :] = raw_input
-        self.slow_history[self.num_samples %
-                          self.slow_history.shape[0], :, :] = raw_input
+        # Sums are kept in double precision whatever the frames are in
+        self.fast_sum = np.zeros(dimensions)
+        self.slow_sum = np.zeros(dimensions)
+        # Sums of just the frames added since each window last wrapped around. At the
+        # next wrap they cover the whole window, and replace the running sums, so
+        # rounding errors from subtracting old frames never build up.
+        self.fresh_fast_sum = np.zeros(dimensions)
+        self.fresh_slow_sum = np.zeros(dimensions)
+        self.fast_mean = np.zeros(dimensions)
+        self.slow_mean = np.zeros(dimensions)
+        self.scratch = np.zeros(dimensions)
+        if baseline_percentile is not None:
+            self.baseline = np.zeros(dimensions)
+            # Running mean absolute deviation from the slow mean, per pixel
+            self.spread = np.zeros(dimensions)
+            self.below_baseline = np.zeros(dimensions, dtype=bool)
+
+    def set_precision(self, dtype):
+        self.dtype = dtype
+        self.fast_history = self.fast_history.astype(dtype)
+        self.slow_history = self.slow_history.astype(dtype)
+
+    def process(self, raw_input, out=None):
+        if out is None:
+            out = np.zeros(raw_input.shape, dtype=self.dtype)
+        for history, running_sum, fresh_sum, mean in [
+                (self.fast_history, self.fast_sum, self.fresh_fast_sum, self.fast_mean),
+                (self.slow_history, self.slow_sum, self.fresh_slow_sum, self.slow_mean)]:
+            window = history.shape[0]
+            slot = self.num_samples % window
+            np.subtract(running_sum, history[slot], out=running_sum)
+            history[slot] = raw_input
+            np.add(running_sum, history[slot], out=running_sum)
+            np.add(fresh_sum, history[slot], out=fresh_sum)
+            if slot == window - 1:
+                running_sum[...] = fresh_sum
+                fresh_sum[...] = 0
+            # Until the window fills, this is the mean of the frames seen so far
+            np.divide(running_sum, min(self.num_samples + 1, window), out=mean)
         self.num_samples += 1
 
-        fast_mean = np.mean(self.fast_history, axis=0)
-        slow_mean = np.mean(self.slow_history, axis=0)
-        if self.num_samples < self.fast_history.shape[0]:
-            fast_mean *= self.fast_history.shape[0] / self.num_samples
-        if self.num_samples < self.slow_history.shape[0]:
-            slow_mean *= self.slow_history.shape[0] / self.num_samples
-
-        difference = fast_mean - slow_mean
+        baseline = self.slow_mean
+        if self.baseline_percentile is not None:
+            self._track_percentile(raw_input)
+            baseline = self.baseline
+        np.subtract(self.fast_mean, baseline, out=self.scratch)
         # Note(charlie): using divide instead of true divide so that division by zero results in zero silently
-        return np.divide(difference, slow_mean)
+        np.divide(self.scratch, baseline, out=self.scratch)
+        np.copyto(out, self.scratch, casting='same_kind')
+        return out
+
+    def _track_percentile(self, raw_input):
+        if self.num_samples == 1:
+            self.baseline[...] = raw_input
+        weight = 1 / min(self.num_samples, self.slow_history.shape[0])
+        np.subtract(raw_input, self.slow_mean, out=self.scratch)
+        np.abs(self.scratch, out=self.scratch)
+        np.subtract(self.scratch, self.spread, out=self.scratch)
+        np.multiply(self.scratch, weight, out=self.scratch)
+        np.add(self.spread, self.scratch, out=self.spread)
+        # Up by q steps when the frame is above F0, down by (1 - q) when below,
+        # which balances out when a fraction q of frames are below it
+        np.less(raw_input, self.baseline, out=self.below_baseline)
+        np.subtract(self.baseline_percentile / 100, self.below_baseline, out=self.scratch)
+        np.multiply(self.scratch, self.spread, out=self.scratch)
+        np.multiply(self.scratch, PERCENTILE_STEP_SCALE * weight, out=self.scratch)
+        np.add(self.baseline, self.scratch, out=self.baseline)
+
+    def prepare(self, input_shape, input_dtype):
+        return input_shape, self.dtype
+
+    def from_json(json_params):
+        fast_samples = int(json_params['fast_samples'])
+        slow_samples = int(json_params['slow_samples'])
+        x_dim = int(json_params['x_dim'])
+        y_dim = int(json_params['y_dim'])
+        baseline_percentile = json_params.get('baseline_percentile', None)
+        if baseline_percentile is not None:
+            baseline_percentile = float(baseline_percentile)
+        return DeltaFSliding(fast_samples, slow_samples, (x_dim, y_dim), baseline_percentile)
+
+    def to_json(self):
+        return {'name': 'DeltaFSliding',
+                'params': {
+                    'fast_samples': self.fast_history.shape[0],
+                    'slow_samples': self.slow_history.shape[0],
+                    'x_dim': self.fast_history.shape[1],
+                    'y_dim': self.fast_history.shape[2],
+                    'baseline_percentile': self.baseline_percentile}}
 
 
 class Threshold:
     def __init__(self, level):
         self.level = level
 
-    def process(self, raw_input):
-        result = (raw_input > self.level) * raw_input
-        return result
+    def process(self, raw_input, out=None):
+        if out is None:
+            result = (raw_input > self.level) * raw_input
+            return result
+        # Mixing a boolean mask with floats would need a cast buffer, so build a
+        # 0/1 step of the same type instead. NaNs propagate just as they do above.
+        np.subtract(raw_input, self.level, out=out)
+        np.heaviside(out, 0, out=out)
+        return np.multiply(out, raw_input, out=out)
+
+    def prepare(self, input_shape, input_dtype):
+        if not np.issubdtype(input_dtype, np.floating):
+            return None
+        return input_shape, np.dtype(input_dtype)
+
+    def process_batch(self, raw_inputs):
+        return self.process(raw_inputs)
 
     def from_json(json_params):
         level = float(json_params['level'])
@@ -176,8 +559,17 @@ class Flatten:
     def __init__(self):
         pass
 
-    def process(self, raw_input):
-        return raw_input.flatten()
+    def process(self, raw_input, out=None):
+        if out is None:
+            return raw_input.flatten()
+        out.reshape(raw_input.shape)[...] = raw_input
+        return out
+
+    def prepare(self, input_shape, input_dtype):
+        return (int(np.prod(input_shape)),), input_dtype
+
+    def process_batch(self, raw_inputs):
+        return raw_inputs.reshape(raw_inputs.shape[0], -1).copy()
 
     def from_json(json_params):
         return Flatten()
@@ -191,8 +583,16 @@ class OutputScaler:
         self.scale = scale
         pass
 
-    def process(self, raw_input):
-        return raw_input * self.scale
+    def process(self, raw_input, out=None):
+        if out is None:
+            return raw_input * self.scale
+        return np.multiply(raw_input, self.scale, out=out)
+
+    def prepare(self, input_shape, input_dtype):
+        return input_shape, np.result_type(input_dtype, self.scale)
+
+    def process_batch(self, raw_inputs):
+        return self.process(raw_inputs)
 
     def from_json(json_params):
         return OutputScaler(float(json_params['scale']))
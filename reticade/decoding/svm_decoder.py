@@ -60,7 +60,10 @@ class GatedSvmClassifier:
         # Note(charlie): explicitly reshape to indicate that this is a single sample
         result_proba = self.underlying_decoder.predict_proba(
             raw_input.reshape(1, -1))[0]
-        if result_proba < self.threshold[0]:
+        # Training and loading give a number, but a one-item list also works
+        threshold = self.threshold[0] if np.ndim(self.threshold) else self.threshold
+        # Gate on how sure the classifier is of the class it picks
+        if result_proba.max() < threshold:
             return 0
         decoded_result = self.underlying_decoder.predict(
             raw_input.reshape(1, -1))[0]
@@ -0,0 +1,109 @@
+import numpy as np
+
+# Note(charlie): this subtraction of 8192 is at the suggestion of the
+# PrairieView engineer to duplicate their behaviour. It needs validating.
+PRAIRIEVIEW_SAMPLE_OFFSET = 8192
+
+
+class RawFrameAssembler:
+    """
+    Assembles frames from PrairieView's raw data stream: chunks of interleaved
+    int16 samples (several per pixel) with every other line scanned backwards.
+
+    All the buffers are allocated up front. Each frame is offset and clamped in
+    place, summed over samples in integer arithmetic, and written (unrastered)
+    straight into the destination, e.g. a slot in the imaging frame ring.
+    """
+
+    def __init__(self, image_size, samples_per_pixel):
+        self.image_size = image_size
+        self.samples_per_pixel = samples_per_pixel
+        self.num_samples_per_frame = image_size[0] * \
+            image_size[1] * samples_per_pixel
+        self.data_layout = (image_size[0], image_size[1], samples_per_pixel)
+
+        # One frame being filled, one complete frame waiting to be assembled
+        self.frame_storage = np.zeros(
+            (2, self.num_samples_per_frame), dtype=np.int16)
+        self.pending_idx = 0
+        self.mem_offset = 0
+        self.completed_frame = None
+        # Counts every frame seen in the stream, including those skipped over
+        self.frames_completed = 0
+
+        # Samples are at most 32767 - offset, so int32 can't overflow for any sensible sample count
+        self.sum_over_samples = np.zeros(image_size, dtype=np.int32)
+        # Views that undo the bidirectional scan: odd rows are read back to front
+        self.even_rows = self.sum_over_samples[0::2]
+        self.odd_rows = self.sum_over_samples[1::2]
+
+    def reset(self):
+        self.pending_idx = 0
+        self.mem_offset = 0
+        self.completed_frame = None
+        self.frames_completed = 0
+
+    def add_samples(self, samples):
+        """
+        Consumes a chunk of raw samples, and returns whether it completed a frame.
+        If a chunk completes more than one frame, only the newest is kept.
+        The chunk may be modified in place by a later call to assemble_into.
+        """
+        num_samples = len(samples)
+        samples_per_frame = self.num_samples_per_frame
+        total_samples = self.mem_offset + num_samples
+        if total_samples < samples_per_frame:
+            self.frame_storage[self.pending_idx,
+                               self.mem_offset:total_samples] = samples
+            self.mem_offset = total_samples
+            return False
+
+        # Position in the chunk where the newest complete frame ends
+        newest_frame_end = (total_samples // samples_per_frame) * \
+            samples_per_frame - self.mem_offset
+        newest_frame_start = newest_frame_end - samples_per_frame
+        self.frames_completed += total_samples // samples_per_frame
+        if newest_frame_start >= 0:
+            # The whole frame is in this chunk, so use it where it is
+            self.completed_frame = samples[newest_frame_start:newest_frame_end]
+        else:
+            pending = self.frame_storage[self.pending_idx]
+            pending[self.mem_offset:] = samples[:newest_frame_end]
+            self.completed_frame = pending
+            self.pending_idx = (self.pending_idx + 1) % 2
+
+        self.mem_offset = num_samples - newest_frame_end
+        self.frame_storage[self.pending_idx,
+                           :self.mem_offset] = samples[newest_frame_end:]
+        return True
+
+    def assemble_into(self, destination):
+        """
+        Writes the mean over samples of the newest complete frame into destination,
+        rounding down if destination has an integer type.
+        """
+        assert(self.completed_frame is not None)
+        assert(destination.shape == tuple(self.image_size))
+        reshaped = self.completed_frame.reshape(self.data_layout)
+        # Clamping before subtracting means we can stay in int16 without wrapping around
+        np.maximum(reshaped, PRAIRIEVIEW_SAMPLE_OFFSET, out=reshaped)
+        np.subtract(reshaped, PRAIRIEVIEW_SAMPLE_OFFSET, out=reshaped)
+
+        # Summing one sample at a time is far faster than reducing over the
+        # (short, innermost) samples axis, and the strided views fold in the unrastering.
+        even_samples = reshaped[0::2]
+        odd_samples = reshaped[1::2, ::-1]
+        self.even_rows[:] = even_samples[:, :, 0]
+        self.odd_rows[:] = odd_samples[:, :, 0]
+        for s in range(1, self.samples_per_pixel):
+            np.add(self.even_rows, even_samples[:, :, s], out=self.even_rows)
+            np.add(self.odd_rows, odd_samples[:, :, s], out=self.odd_rows)
+
+        if np.issubdtype(destination.dtype, np.integer):
+            np.floor_divide(self.sum_over_samples, self.samples_per_pixel,
+                            out=destination, casting='unsafe')
+        else:
+            np.divide(self.sum_over_samples, self.samples_per_pixel,
+                      out=destination, casting='same_kind')
+        self.completed_frame = None
+        return destination
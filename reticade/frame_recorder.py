@@ -0,0 +1,114 @@
+import numpy as np
+import logging
+import queue
+import threading
+
+DEFAULT_NUM_BUFFERS = 16
+
+
+def timestamps_path(out_file):
+    return out_file[:-len('.npy')] + '-timestamps.npy'
+
+
+def load_recording(out_file):
+    """
+    Returns (frames, timestamps) for the recorded rows, with the frames memory-mapped.
+    """
+    frames = np.load(out_file, mmap_mode='r')
+    timestamps = np.load(timestamps_path(out_file))
+    num_recorded = np.count_nonzero(timestamps[:, 0])
+    return frames[:num_recorded], timestamps[:num_recorded]
+
+
+class FrameRecorder:
+    """
+    Appends frames to a preallocated, memory-mapped .npy file on a background
+    thread, alongside a second file holding each frame's sequence number and
+    acquisition time (rows of [sequence number, perf_counter_ns]).
+
+    record() never blocks: frames are copied into one of a fixed pool of
+    buffers and handed to the writer. If the writer falls behind and the pool
+    runs dry, the frame is dropped and counted instead.
+
+    Rows that were never written have a sequence number of zero.
+    Use load_recording to read back only the frames that were recorded.
+    """
+
+    def __init__(self, out_file, image_size, max_frames, dtype=np.float32, num_buffers=DEFAULT_NUM_BUFFERS):
+        assert(out_file.endswith('.npy'))
+        self.out_file = out_file
+        self.max_frames = max_frames
+        self.frames = np.lib.format.open_memmap(
+            out_file, mode='w+', dtype=dtype, shape=(max_frames, image_size[0], image_size[1]))
+        self.timestamps = np.lib.format.open_memmap(
+            timestamps_path(out_file), mode='w+', dtype=np.int64, shape=(max_frames, 2))
+
+        self.buffers = np.zeros(
+            (num_buffers, image_size[0], image_size[1]), dtype=dtype)
+        self.free_buffers = queue.SimpleQueue()
+        for i in range(num_buffers):
+            self.free_buffers.put(i)
+        self.pending = queue.SimpleQueue()
+
+        self.frames_queued = 0
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.frames_dropped_since_report = 0
+        self.writer = threading.Thread(target=self._write_frames)
+        self.writer.start()
+        logging.info(
+            f"Recording up to {max_frames} frames to {out_file}")
+
+    def record(self, frame, sequence_number, timestamp_ns):
+        """
+        Queues a copy of the frame to be written. Returns False if the frame was dropped.
+        """
+        if self.frames_queued >= self.max_frames:
+            self._drop_frame()
+            return False
+        try:
+            buffer_idx = self.free_buffers.get_nowait()
+        except queue.Empty:
+            # Back-pressure: the disk isn't keeping up
+            self._drop_frame()
+            return False
+        self.buffers[buffer_idx] = frame
+        self.pending.put(
+            (buffer_idx, self.frames_queued, sequence_number, timestamp_ns))
+        self.frames_queued += 1
+        return True
+
+    def _drop_frame(self):
+        self.frames_dropped += 1
+        self.frames_dropped_since_report += 1
+
+    def _write_frames(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            buffer_idx, row, sequence_number, timestamp_ns = item
+            self._write_frame(self.buffers[buffer_idx], row, sequence_number, timestamp_ns)
+            self.free_buffers.put(buffer_idx)
+
+    def _write_frame(self, frame, row, sequence_number, timestamp_ns):
+        self.frames[row] = frame
+        self.timestamps[row, 0] = sequence_number
+        self.timestamps[row, 1] = timestamp_ns
+        self.frames_written += 1
+
+    def report_back_pressure(self):
+        if self.frames_dropped_since_report > 0:
+            logging.warn(
+                f"Recorder fell behind and dropped {self.frames_dropped_since_report} frames ({self.pending.qsize()} waiting to be written)")
+        self.frames_dropped_since_report = 0
+
+    def close(self):
+        self.pending.put(None)
+        self.writer.join()
+        self.frames.flush()
+        self.timestamps.flush()
+        logging.info(
+            f"Recorded {self.frames_written} frames to {self.out_file}. Dropped: {self.frames_dropped}")
+        del self.frames
+        del self.timestamps
@@ -1,37 +1,356 @@
 import numpy as np
+import time
+import select
+import socket
+import struct
+import logging
+import threading
 from multiprocessing import shared_memory
 
 IMAGING_LINK_MEMSHARE_NAME = "reticade-memshare"
+DEFAULT_NUM_FRAME_SLOTS = 4
+
+# The producer sends a tiny datagram here whenever it publishes a frame, so that
+# the harness can sleep until a frame arrives instead of ticking on a timer.
+FRAME_NOTIFY_ADDR = ("127.0.0.1", 7779)
+FRAME_NOTIFY_PAYLOAD = '<q'  # The sequence number of the published frame
+# Only used if the notification socket couldn't be opened
+FALLBACK_POLL_INTERVAL_S = 0.001
+
+# Frames cross the process boundary in a compact type. Conversion to the
+# float64 the decoder works in is left to the first pipeline stage.
+TRANSPORT_UINT16 = 'uint16'  # Raw counts, averaged over samples and rounded down
+TRANSPORT_FLOAT32 = 'float32'
+TRANSPORT_FLOAT64 = 'float64'
+transport_dtypes = {
+    TRANSPORT_UINT16: np.uint16,
+    TRANSPORT_FLOAT32: np.float32,
+    TRANSPORT_FLOAT64: np.float64,
+}
+transport_dtype_codes = {TRANSPORT_UINT16: 1,
+                         TRANSPORT_FLOAT32: 2, TRANSPORT_FLOAT64: 3}
+DEFAULT_TRANSPORT = TRANSPORT_FLOAT32
+
+# Layout of the shared memory block:
+# [ring header][one header per slot][frame slot 0][frame slot 1]...
+# All header fields are int64.
+RING_HEADER_ITEMS = 8
+RING_LATEST_SEQUENCE = 0  # Sequence number of the newest complete frame (0 until the first frame)
+RING_NUM_SLOTS = 1
+RING_HEIGHT = 2
+RING_WIDTH = 3
+RING_LATEST_SLOT = 4  # Slot holding the newest complete frame
+RING_HELD_SLOT = 5  # Slot the reader is currently using (-1 if none), never written by the producer
+RING_DTYPE_CODE = 6  # See transport_dtype_codes
+
+SLOT_HEADER_ITEMS = 8
+SLOT_WRITE_COUNTER = 0  # Odd while the producer is writing into the slot
+SLOT_SEQUENCE = 1
+SLOT_TIMESTAMP_NS = 2  # time.perf_counter_ns() at acquisition
+# Frames may be smaller than the slots (e.g. after downsampling in the imaging
+# process), in which case they fill the start of the slot.
+SLOT_HEIGHT = 3
+SLOT_WIDTH = 4
+SLOT_STAGES_APPLIED = 5  # How many decoder stages the producer has already run
+
+HEADER_ITEM_BYTES = 8
+
+_fence_lock = threading.Lock()
+
+
+def _memory_fence():
+    # The hold handshake is a store on one side followed by a load of what the
+    # other side stores, which the CPU may reorder without a full fence between
+    # them. Python has no fence of its own, but taking a lock runs an interlocked
+    # instruction, which is one on x86 (where the imaging rig runs).
+    with _fence_lock:
+        pass
+
+
+def _ring_layout(memory_block, num_slots, image_size, transport):
+    ring_header = np.ndarray(
+        RING_HEADER_ITEMS, dtype=np.int64, buffer=memory_block.buf)
+    slot_headers_offset = RING_HEADER_ITEMS * HEADER_ITEM_BYTES
+    slot_headers = np.ndarray((num_slots, SLOT_HEADER_ITEMS), dtype=np.int64,
+                              buffer=memory_block.buf, offset=slot_headers_offset)
+    slots_offset = slot_headers_offset + \
+        num_slots * SLOT_HEADER_ITEMS * HEADER_ITEM_BYTES
+    slots = np.ndarray((num_slots, image_size[0], image_size[1]), dtype=transport_dtypes[transport],
+                       buffer=memory_block.buf, offset=slots_offset)
+    return ring_header, slot_headers, slots
+
+
+def _slot_view(slots, slot, frame_shape):
+    if frame_shape == slots.shape[1:]:
+        return slots[slot]
+    num_pixels = frame_shape[0] * frame_shape[1]
+    assert(num_pixels <= slots[slot].size)
+    return slots[slot].reshape(-1)[:num_pixels].reshape(frame_shape)
+
+
+def ring_memsize(image_size, num_slots, transport):
+    header_bytes = (RING_HEADER_ITEMS + num_slots *
+                    SLOT_HEADER_ITEMS) * HEADER_ITEM_BYTES
+    bytes_per_pixel = np.dtype(transport_dtypes[transport]).itemsize
+    return header_bytes + num_slots * image_size[0] * image_size[1] * bytes_per_pixel
+
+
+class FrameRingWriter:
+    """
+    FrameRingWriter is the producer side of the imaging shared memory.
+    Frames are written into a ring of slots, each guarded by a seqlock
+    (a counter that is odd while the slot is being written), and only
+    become visible to the reader once they are completely written.
+    The slot held by the reader and the newest slot are never overwritten,
+    so at least three slots are needed.
+    """
+
+    def __init__(self, image_size, num_slots=DEFAULT_NUM_FRAME_SLOTS, transport=DEFAULT_TRANSPORT,
+                 name=IMAGING_LINK_MEMSHARE_NAME, notify_addr=FRAME_NOTIFY_ADDR):
+        assert(len(image_size) == 2)
+        assert(num_slots >= 3)
+        assert(transport in transport_dtypes)
+        self.image_size = image_size
+        self.num_slots = num_slots
+        self.transport = transport
+        self.memory_block = shared_memory.SharedMemory(
+            name=name, create=True, size=ring_memsize(image_size, num_slots, transport))
+        self.ring_header, self.slot_headers, self.slots = _ring_layout(
+            self.memory_block, num_slots, image_size, transport)
+        # Force-fill on creation so the reader never sees garbage in memory
+        self.ring_header.fill(0)
+        self.slot_headers.fill(0)
+        self.slots.fill(0)
+        self.ring_header[RING_NUM_SLOTS] = num_slots
+        self.ring_header[RING_HEIGHT] = image_size[0]
+        self.ring_header[RING_WIDTH] = image_size[1]
+        self.ring_header[RING_HELD_SLOT] = -1
+        self.ring_header[RING_DTYPE_CODE] = transport_dtype_codes[transport]
+        self.slot_headers[:, SLOT_HEIGHT] = image_size[0]
+        self.slot_headers[:, SLOT_WIDTH] = image_size[1]
+        self.sequence_number = 0
+        self.latest_slot = 0
+        self.pending_slot = None
+        self.pending_shape = None
+
+        self.notify_addr = notify_addr
+        self.notify_socket = None
+        if notify_addr is not None:
+            self.notify_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.notify_socket.setblocking(False)
+
+    def begin_frame(self, frame_shape=None):
+        """
+        Claims the next slot and returns it for writing. The frame isn't
+        visible to the reader until publish_frame is called.
+        A frame_shape smaller than the slots returns a view into the start of the slot.
+        """
+        assert(self.pending_slot is None)
+        while True:
+            slot = self._next_free_slot()
+            self.slot_headers[slot, SLOT_WRITE_COUNTER] += 1
+            _memory_fence()
+            if self.ring_header[RING_HELD_SLOT] != slot:
+                break
+            # The reader took hold of this slot while we were claiming it, so
+            # back off without touching the contents and pick another one.
+            self.slot_headers[slot, SLOT_WRITE_COUNTER] += 1
+        self.pending_slot = slot
+        self.pending_shape = tuple(
+            frame_shape) if frame_shape is not None else self.slots.shape[1:]
+        return _slot_view(self.slots, slot, self.pending_shape)
+
+    def _next_free_slot(self):
+        held_slot = self.ring_header[RING_HELD_SLOT]
+        for i in range(1, self.num_slots):
+            slot = (self.latest_slot + i) % self.num_slots
+            if slot != held_slot:
+                return slot
+
+    def publish_frame(self, timestamp_ns=None, stages_applied=0):
+        assert(self.pending_slot is not None)
+        if timestamp_ns is None:
+            timestamp_ns = time.perf_counter_ns()
+        slot = self.pending_slot
+        self.sequence_number += 1
+        self.slot_headers[slot, SLOT_SEQUENCE] = self.sequence_number
+        self.slot_headers[slot, SLOT_TIMESTAMP_NS] = timestamp_ns
+        self.slot_headers[slot, SLOT_HEIGHT] = self.pending_shape[0]
+        self.slot_headers[slot, SLOT_WIDTH] = self.pending_shape[1]
+        self.slot_headers[slot, SLOT_STAGES_APPLIED] = stages_applied
+        self.slot_headers[slot, SLOT_WRITE_COUNTER] += 1
+        self.ring_header[RING_LATEST_SLOT] = slot
+        self.ring_header[RING_LATEST_SEQUENCE] = self.sequence_number
+        self.latest_slot = slot
+        self.pending_slot = None
+        self._notify(self.sequence_number)
+        return self.sequence_number
+
+    def _notify(self, sequence_number):
+        if self.notify_socket is None:
+            return
+        try:
+            self.notify_socket.sendto(struct.pack(
+                FRAME_NOTIFY_PAYLOAD, sequence_number), self.notify_addr)
+        except socket.error:
+            # Nobody is listening (or the buffer is full). The reader can
+            # always fall back to the sequence number in the ring header.
+            pass
+
+    def write_frame(self, frame, timestamp_ns=None, stages_applied=0):
+        self.begin_frame(frame.shape)[:, :] = frame
+        return self.publish_frame(timestamp_ns, stages_applied)
+
+    def get_sharedmem_name(self):
+        return self.memory_block.name
+
+    def close(self):
+        if self.notify_socket is not None:
+            self.notify_socket.close()
+        self.memory_block.close()
+
+    def unlink(self):
+        self.memory_block.unlink()
+
 
 class ImagingLink:
     """
-    ImagingLink sets up a shared memory buffer for the standalone PrairieView
-    polling tool to write into.
+    ImagingLink attaches to the shared memory ring that the standalone
+    PrairieView polling tool writes into, and reads the newest complete
+    frame from it without taking any locks.
+
+    Frames are handed over without copying: get_current_frame returns a
+    read-only view of a slot that the producer won't touch until the frame
+    is released (explicitly, or by asking for the next frame).
+    There must only be one ImagingLink reading from the ring.
     """
 
-    def __init__(self, image_size):
+    def __init__(self, image_size, notify_addr=FRAME_NOTIFY_ADDR):
         assert(len(image_size) == 2)
-        bytes_per_pixel = 8  # 64 bit float
-        memsize_bytes = image_size[0] * \
-            image_size[1] * bytes_per_pixel
         self.memory_block = shared_memory.SharedMemory(
-            name=IMAGING_LINK_MEMSHARE_NAME, create=False, size=memsize_bytes)
-        self.shared_array = np.ndarray(
-            (image_size[0], image_size[1]), dtype=np.float64, buffer=self.memory_block.buf)
-        # Force-fill the array on creation so it's not populated by garbage in memory
-        self.shared_array.fill(0)
+            name=IMAGING_LINK_MEMSHARE_NAME, create=False)
+        ring_header = np.ndarray(
+            RING_HEADER_ITEMS, dtype=np.int64, buffer=self.memory_block.buf)
+        self.num_slots = int(ring_header[RING_NUM_SLOTS])
+        ring_size = (int(ring_header[RING_HEIGHT]),
+                     int(ring_header[RING_WIDTH]))
+        assert(ring_size == tuple(image_size))
+        dtype_code = int(ring_header[RING_DTYPE_CODE])
+        self.transport = next(
+            t for t, code in transport_dtype_codes.items() if code == dtype_code)
+        self.ring_header, self.slot_headers, self.slots = _ring_layout(
+            self.memory_block, self.num_slots, image_size, self.transport)
+        self.slots.flags.writeable = False
+        # Read-only views of each slot, keyed by (slot, frame shape)
+        self.frame_views = {}
+
+        self.last_sequence_number = 0
+        self.last_timestamp_ns = 0
+        self.last_stages_applied = 0
+        self.frames_dropped = 0
+        self.frames_repeated = 0
+
+        self.notify_socket = None
+        if notify_addr is not None:
+            self._open_notify_socket(notify_addr)
+
+    def _open_notify_socket(self, notify_addr):
+        notify_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            notify_socket.bind(notify_addr)
+        except socket.error as err:
+            logging.warn(
+                f"Couldn't listen for frame notifications on {notify_addr}, falling back to polling. Details: {err}")
+            notify_socket.close()
+            return
+        notify_socket.setblocking(False)
+        self.notify_socket = notify_socket
+
+    def has_new_frame(self):
+        return int(self.ring_header[RING_LATEST_SEQUENCE]) != self.last_sequence_number
+
+    def wait_for_frame(self, timeout_s):
+        """
+        Blocks until a frame newer than the last one read has been published,
+        or until the timeout expires. Returns whether a new frame is ready.
+        """
+        deadline = time.perf_counter() + timeout_s
+        while not self.has_new_frame():
+            remaining_s = deadline - time.perf_counter()
+            if remaining_s <= 0:
+                return False
+            if self.notify_socket is None:
+                time.sleep(min(remaining_s, FALLBACK_POLL_INTERVAL_S))
+                continue
+            ready, _, _ = select.select(
+                [self.notify_socket], [], [], remaining_s)
+            if ready:
+                self._drain_notifications()
+        return True
+
+    def _drain_notifications(self):
+        # The notifications only serve to wake us up: the ring header
+        # is the source of truth for what's been published.
+        try:
+            while True:
+                self.notify_socket.recv(64)
+        except socket.error:
+            pass
 
     def get_current_frame(self):
-        # In addition to converting this to a float (so the processing pipeline
-        # isn't constrained by the uint type), this is also a copy -- which means 
-        # that the decoder can ingest it without worrying about concurrent access.
-        return np.copy(self.shared_array)
+        self.release_frame()
+        while True:
+            slot = int(self.ring_header[RING_LATEST_SLOT])
+            # Mark the slot as held *before* checking that it isn't being written:
+            # a producer that claims it after this point will see the hold and back off.
+            self.ring_header[RING_HELD_SLOT] = slot
+            _memory_fence()
+            write_counter = int(self.slot_headers[slot, SLOT_WRITE_COUNTER])
+            if write_counter % 2 == 1:
+                continue
+            sequence_number = int(self.slot_headers[slot, SLOT_SEQUENCE])
+            timestamp_ns = int(self.slot_headers[slot, SLOT_TIMESTAMP_NS])
+            stages_applied = int(self.slot_headers[slot, SLOT_STAGES_APPLIED])
+            frame_shape = (int(self.slot_headers[slot, SLOT_HEIGHT]),
+                           int(self.slot_headers[slot, SLOT_WIDTH]))
+            frame = self._frame_view(slot, frame_shape)
+            # A producer that claimed the slot before it saw the hold changes the
+            # counter (even if it then backed off), so the headers may be stale
+            _memory_fence()
+            if int(self.slot_headers[slot, SLOT_WRITE_COUNTER]) == write_counter and \
+                    int(self.slot_headers[slot, SLOT_SEQUENCE]) == sequence_number:
+                break
+
+        self._record_sequence(sequence_number, timestamp_ns)
+        self.last_stages_applied = stages_applied
+        # Note: this is a view, not a copy. It stays valid until release_frame.
+        return frame
+
+    def _frame_view(self, slot, frame_shape):
+        key = (slot, frame_shape)
+        if key not in self.frame_views:
+            self.frame_views[key] = _slot_view(self.slots, slot, frame_shape)
+        return self.frame_views[key]
+
+    def release_frame(self):
+        self.ring_header[RING_HELD_SLOT] = -1
+
+    def _record_sequence(self, sequence_number, timestamp_ns):
+        if sequence_number == self.last_sequence_number:
+            if sequence_number > 0:
+                self.frames_repeated += 1
+        elif sequence_number > self.last_sequence_number + 1:
+            self.frames_dropped += sequence_number - self.last_sequence_number - 1
+        self.last_sequence_number = sequence_number
+        self.last_timestamp_ns = timestamp_ns
 
     def get_sharedmem_addr(self):
-        return hex(id(self.shared_array))
+        return hex(id(self.slots))
 
     def get_sharedmem_name(self):
         return self.memory_block.name
 
     def close(self):
+        if self.notify_socket is not None:
+            self.notify_socket.close()
         self.memory_block.unlink()
@@ -0,0 +1,171 @@
+import numpy as np
+import glob
+import logging
+import queue
+import threading
+
+# Rows per chunk. Instrumented outputs are small (feature vectors and scalars),
+# so a chunk is at most a few MB even for a full-resolution frame vector.
+CHUNK_ROWS = 256
+# Chunks kept for reuse per stream. More are allocated if the disk falls behind,
+# up to the limit, beyond which frames are dropped (and counted) instead.
+CHUNKS_PER_STREAM = 4
+MAX_CHUNKS_PER_STREAM = 16
+
+
+def stream_path(out_prefix, stage_idx=None):
+    """
+    The file holding one stage's outputs (or the decode timestamps, if stage_idx is None).
+    """
+    if stage_idx is None:
+        return out_prefix + '-timestamps.npy'
+    return out_prefix + f'-stage{stage_idx}.npy'
+
+
+def _load_stream(path):
+    chunks = []
+    with open(path, 'rb') as file:
+        while file.peek(1):
+            chunks.append(np.load(file))
+    if not chunks:
+        return np.zeros(0)
+    return np.concatenate(chunks)
+
+
+def load_instrumentation(out_prefix):
+    """
+    Returns (timestamps, {stage index: outputs}) for a run written by InstrumentationWriter.
+    """
+    timestamps = _load_stream(stream_path(out_prefix))
+    stage_outputs = {}
+    prefix = out_prefix + '-stage'
+    for path in glob.glob(glob.escape(prefix) + '*.npy'):
+        stage_idx = path[len(prefix):-len('.npy')]
+        if stage_idx.isdigit():
+            stage_outputs[int(stage_idx)] = _load_stream(path)
+    return timestamps, stage_outputs
+
+
+class InstrumentationWriter:
+    """
+    Streams a decoder's instrumented outputs to disk as they're produced, so that
+    long runs use a fixed amount of memory and there's nothing left to write
+    when they finish.
+
+    Each stream (the decode timestamps, and each instrumented stage) is copied
+    row by row into a chunk. Full chunks are appended to that stream's .npy file
+    (as consecutive arrays) by a background thread, and the chunk is then reused.
+    If the writer falls behind, more chunks are allocated, up to max_chunks per
+    stream. Past that, whole frames are dropped (every stream's row for that decode,
+    starting with its timestamp), so the streams always stay aligned.
+    Use load_instrumentation to read them.
+    """
+
+    def __init__(self, out_prefix, instrumented_stages, chunk_rows=CHUNK_ROWS, max_chunks=MAX_CHUNKS_PER_STREAM):
+        self.out_prefix = out_prefix
+        self.chunk_rows = chunk_rows
+        self.max_chunks = max_chunks
+        paths = [stream_path(out_prefix)] + \
+            [stream_path(out_prefix, i) for i in instrumented_stages]
+        self.files = [open(path, 'wb') for path in paths]
+        # Per stream: the chunk being filled, how many rows it holds, and the chunks free for reuse
+        self.chunks = [None for _ in paths]
+        self.rows_filled = [0 for _ in paths]
+        self.free_chunks = [queue.SimpleQueue() for _ in paths]
+        # Chunks in existence per stream, which the writer thread lowers as it discards them
+        self.chunks_allocated = [0 for _ in paths]
+        self.peak_chunks = [0 for _ in paths]
+        self.allocation_lock = threading.Lock()
+        # Whether the frame being recorded (since the last timestamp) is being dropped
+        self.dropping_frame = False
+        self.frames_dropped = 0
+
+        self.pending = queue.SimpleQueue()
+        self.rows_written = 0
+        # A daemon, so a run that fails before close doesn't keep the interpreter alive
+        self.writer = threading.Thread(target=self._write_chunks, daemon=True)
+        self.writer.start()
+        logging.info(f"Streaming decoder instrumentation to {out_prefix}-*.npy")
+
+    def record(self, stream_idx, value):
+        # Each decode records its timestamp (stream 0) first, then its stages
+        if stream_idx == 0:
+            self.dropping_frame = not self._has_room()
+            if self.dropping_frame:
+                self.frames_dropped += 1
+        if self.dropping_frame:
+            return
+        chunk = self.chunks[stream_idx]
+        if chunk is None:
+            chunk = self._take_chunk(stream_idx, value)
+        row = self.rows_filled[stream_idx]
+        chunk[row] = value
+        self.rows_filled[stream_idx] = row + 1
+        if row + 1 == self.chunk_rows:
+            self._flush(stream_idx)
+
+    def _has_room(self):
+        # Streams fill and flush together, so either all of them have a chunk in use or none do
+        for stream_idx in range(len(self.chunks)):
+            if self.chunks[stream_idx] is None and self.free_chunks[stream_idx].empty() and \
+                    self.chunks_allocated[stream_idx] >= self.max_chunks:
+                return False
+        return True
+
+    def _take_chunk(self, stream_idx, value):
+        try:
+            chunk = self.free_chunks[stream_idx].get_nowait()
+        except queue.Empty:
+            chunk = None
+        row_shape, row_dtype = np.shape(value), np.result_type(value)
+        if chunk is None or chunk.shape[1:] != row_shape or chunk.dtype != row_dtype:
+            with self.allocation_lock:
+                if chunk is not None:
+                    # The stage's output changed shape, so the old chunk is no use
+                    self.chunks_allocated[stream_idx] -= 1
+                self.chunks_allocated[stream_idx] += 1
+                self.peak_chunks[stream_idx] = max(
+                    self.peak_chunks[stream_idx], self.chunks_allocated[stream_idx])
+            chunk = np.zeros((self.chunk_rows,) + row_shape, dtype=row_dtype)
+        self.chunks[stream_idx] = chunk
+        self.rows_filled[stream_idx] = 0
+        return chunk
+
+    def _flush(self, stream_idx):
+        if self.chunks[stream_idx] is None:
+            return
+        self.pending.put(
+            (stream_idx, self.chunks[stream_idx], self.rows_filled[stream_idx]))
+        self.chunks[stream_idx] = None
+
+    def _write_chunks(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            stream_idx, chunk, num_rows = item
+            np.save(self.files[stream_idx], chunk[:num_rows])
+            self.rows_written += num_rows
+            if self.free_chunks[stream_idx].qsize() < CHUNKS_PER_STREAM:
+                self.free_chunks[stream_idx].put(chunk)
+            else:
+                with self.allocation_lock:
+                    self.chunks_allocated[stream_idx] -= 1
+
+    def close(self):
+        for stream_idx in range(len(self.files)):
+            self._flush(stream_idx)
+        self.pending.put(None)
+        self.writer.join()
+        for file in self.files:
+            file.close()
+        extra_chunks = sum([max(0, n - CHUNKS_PER_STREAM) for n in self.peak_chunks])
+        if extra_chunks > 0:
+            # Back-pressure: the disk wasn't keeping up
+            logging.warn(
+                f"Instrumentation writer fell behind and needed {extra_chunks} extra chunks")
+        if self.frames_dropped > 0:
+            logging.warn(
+                f"Instrumentation writer fell behind and dropped {self.frames_dropped} frames")
+        logging.info(
+            f"Wrote {self.rows_written} rows of instrumented debugger stages to {self.out_prefix}-*.npy")
@@ -2,6 +2,7 @@ import reticade.coordinator
 import reticade.imaging_link
 import reticade.udp_controller_link
 import reticade.decoder_harness
+import reticade.pipelined_decoder
 import reticade.decoding.dummy_decoder
 import logging
 import matplotlib.pyplot as plt
@@ -28,10 +29,15 @@ DEFAULT_LINK_IP = "131.111.32.44"
 
 
 class Harness:
-    def __init__(self, tick_interval_s=1/30, enable_labview_debug=False):
+    def __init__(self, tick_interval_s=1/30, enable_labview_debug=False, tick_on_frames=True, frame_timeout_s=None):
         self.coordinator = reticade.coordinator.Coordinator()
         self.tick_interval_s = tick_interval_s
         self.frame_report_interval_s = 5.0
+        # When the imaging link can notify us of new frames, tick as soon as each one
+        # arrives. If none arrives within the timeout, tick anyway, so that decoders
+        # that don't need frames (e.g. autopilot) keep running.
+        self.tick_on_frames = tick_on_frames
+        self.frame_timeout_s = tick_interval_s if frame_timeout_s is None else frame_timeout_s
         if platform.system() == 'Windows':
             self.is_windows = True
         elif platform.system() == 'Darwin':
@@ -95,9 +101,19 @@ class Harness:
                 logging.info(f"Last received payload: {self.shared_labview_data[0]}")
             time.sleep(0.5)
 
-    def load_decoder(self, path_to_decoder):
-        decoder = reticade.decoder_harness.DecoderPipeline.from_json(
-            path_to_decoder)
+    def load_decoder(self, path_to_decoder, segment_starts=None):
+        """
+        To decode consecutive frames in parallel, pass the indices of the stages that
+        start each new segment (see pipelined_decoder.py), e.g. segment_starts=[3].
+        """
+        if not segment_starts:
+            decoder = reticade.decoder_harness.DecoderPipeline.from_json(
+                path_to_decoder)
+        else:
+            pipeline = reticade.decoder_harness.DecoderPipeline.from_json(
+                path_to_decoder, segment_starts=segment_starts)
+            decoder = reticade.pipelined_decoder.PipelinedDecoder(
+                pipeline, segment_starts)
         self.coordinator.set_decoder(decoder)
         logging.info(f"Loaded decoder from {path_to_decoder}")
 
@@ -106,20 +122,73 @@ class Harness:
         logging.info(
             f"Last {len(frame_times)} frame processing times (ms) [min, avg, max]: {(min(frame_times) * 1000):.2f}, {(np.mean(frame_times) * 1000):.2f}, {(worst_frame_time * 1000):.2f}")
 
+        slowest_stage = self.coordinator.slowest_recent_stage()
         if worst_frame_time > self.tick_interval_s:
             logging.warn(
                 f"At least one frame took longer than {(self.tick_interval_s * 1000):.2f} ms to process.")
+            if slowest_stage is not None:
+                stage_name, stage_time = slowest_stage
+                logging.warn(
+                    f"Slowest decoder stage since the last report: {stage_name} at {(stage_time * 1000):.2f} ms")
+        self.coordinator.log_stage_timings()
         frame_times.clear()
+        self._print_imaging_sequence_stats()
+
+    def _print_imaging_sequence_stats(self):
+        imaging = self.coordinator.imaging
+        if not isinstance(imaging, reticade.imaging_link.ImagingLink):
+            return
+        logging.info(
+            f"Imaging frames so far: latest sequence number {imaging.last_sequence_number}, {imaging.frames_dropped} dropped, {imaging.frames_repeated} decoded more than once")
 
     def run(self, stop_after_seconds=10):
         self._pre_run_check()
-        if self.is_windows:
-            self._run_windows(stop_after_seconds)
-        else:
-            self._run_unix(stop_after_seconds)
+        self.coordinator.reset_latency()
         datestring = datetime.now().strftime("%Y-%m-%d-%H%M%S")
-        out_file = 'output-' + datestring + '.npy'
-        self.coordinator.dump_instrumentation_data(out_file)
+        self.coordinator.start_instrumentation('output-' + datestring)
+        try:
+            if self.tick_on_frames and self.coordinator.can_wait_for_frames():
+                self._run_on_frames(stop_after_seconds)
+            elif self.is_windows:
+                self._run_windows(stop_after_seconds)
+            else:
+                self._run_unix(stop_after_seconds)
+        finally:
+            # Keeps what was recorded, and stops the writer thread, even if a tick fails
+            self.coordinator.finish_instrumentation()
+        self.coordinator.log_latency_summary()
+        self.coordinator.dump_latency_data('latency-' + datestring + '.npy')
+        self.coordinator.dump_stage_timings('stage-timings-' + datestring + '.npz')
+
+    def _run_on_frames(self, stop_after_seconds):
+        start_time = time.perf_counter()
+        end_time = start_time + stop_after_seconds
+        last_reported_time = start_time
+        frame_times = []
+        timeouts_in_interval = 0
+
+        while end_time > time.perf_counter():
+            timeout_s = min(self.frame_timeout_s, max(
+                0, end_time - time.perf_counter()))
+            if not self.coordinator.wait_for_frame(timeout_s):
+                timeouts_in_interval += 1
+
+            frame_start_time = time.perf_counter()
+            self.coordinator.tick()
+            frame_end_time = time.perf_counter()
+            frame_times.append(frame_end_time - frame_start_time)
+
+            if frame_end_time > last_reported_time + self.frame_report_interval_s:
+                rate = len(frame_times) / \
+                    (frame_end_time - last_reported_time)
+                last_reported_time = frame_end_time
+                logging.info(
+                    f"Rate: {rate:.2f} Hz. Ticks without a new frame after {(self.frame_timeout_s * 1000):.2f} ms: {timeouts_in_interval}")
+                timeouts_in_interval = 0
+                self._print_frame_times(frame_times)
+
+        logging.info(
+            f"Finished after {(time.perf_counter() - start_time):.3f} seconds")
 
     def _run_unix(self, stop_after_seconds):
         start_time = time.perf_counter()
@@ -0,0 +1,206 @@
+import numpy as np
+import logging
+import threading
+import time
+from reticade.util.stage_timing import StageTimings
+
+"""
+Runs a decoder as a pipeline of segments, each on its own worker thread, so
+that consecutive frames are decoded on several cores at once. The heavy stages
+(skimage's filters, optical flow and warping) spend most of their time in
+compiled code that releases the GIL, so the segments genuinely overlap.
+
+The price is latency: decode returns the newest command that has come out of
+the last segment, which is for an earlier frame than the one just submitted.
+"""
+
+# How long decode waits for the very first result before checking on the workers
+FIRST_RESULT_POLL_S = 0.1
+
+
+class HandoffSlot:
+    """
+    Passes values from one thread to another, newest first: if the consumer hasn't
+    taken the last value by the time the next is put, the last value is dropped.
+    Arrays are copied into one of three buffers, so neither side ever waits for
+    the other to finish with one, and nothing is allocated once the buffers exist.
+    A value returned by take stays valid until the next call to take.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.buffers = [None, None, None]
+        # Each value travels with a tag (e.g. the time it was submitted)
+        self.tags = [None, None, None]
+        # Indices into buffers: written by the producer, waiting, read by the consumer
+        self.back, self.middle, self.front = 0, 1, 2
+        self.fresh = False
+        self.closed = False
+        self.values_dropped = 0
+
+    def put(self, value, tag=None):
+        back = self.back
+        buffer = self.buffers[back]
+        if isinstance(value, np.ndarray):
+            if buffer is None or not isinstance(buffer, np.ndarray) or buffer.shape != value.shape or buffer.dtype != value.dtype:
+                buffer = np.empty_like(value)
+                self.buffers[back] = buffer
+            np.copyto(buffer, value)
+        else:
+            self.buffers[back] = value
+        self.tags[back] = tag
+        with self.condition:
+            self.back, self.middle = self.middle, self.back
+            if self.fresh:
+                self.values_dropped += 1
+            self.fresh = True
+            self.condition.notify()
+
+    def take(self, timeout_s=None):
+        """
+        Waits for a value that hasn't been taken yet, and returns (value, tag).
+        Returns None if the slot is closed, or if the timeout passes.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.fresh or self.closed, timeout_s):
+                return None
+            if not self.fresh:
+                return None
+            self.front, self.middle = self.middle, self.front
+            self.fresh = False
+            return self.buffers[self.front], self.tags[self.front]
+
+    def take_latest(self):
+        """
+        Like take, but returns the last value taken instead of waiting if there's
+        nothing new (or None if there's never been a value).
+        """
+        with self.condition:
+            if self.fresh:
+                self.front, self.middle = self.middle, self.front
+                self.fresh = False
+            if self.tags[self.front] is None:
+                return None
+            return self.buffers[self.front], self.tags[self.front]
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class PipelinedDecoder:
+    """
+    Splits a DecoderPipeline into segments at segment_starts (stage indices) and
+    runs each segment on a dedicated thread. Adjacent segments are connected by
+    HandoffSlots, so a slow segment drops stale frames rather than building a queue.
+    The pipeline must have been created with the same segment_starts, so that no
+    fused run of stages crosses a segment boundary.
+
+    Behaves like the DecoderPipeline for the coordinator, except that decode
+    returns the newest available command rather than the one for this frame.
+    segment_timings records how long each segment spent on each frame, and how
+    long frames took from submission to a result.
+
+    Instrumented outputs are collected into a row that travels with each frame,
+    and the row is only recorded once the frame leaves the last segment, so a
+    frame dropped between segments drops its whole row.
+    """
+
+    def __init__(self, pipeline, segment_starts):
+        segment_starts = sorted(segment_starts)
+        assert(all(0 < s < len(pipeline.pipeline_stages) for s in segment_starts))
+        self.pipeline = pipeline
+        self.imaging_stages = pipeline.imaging_stages
+        self.stage_timings = pipeline.stage_timings
+        self.boundaries = [0] + segment_starts + [None]
+        # Stages applied in the imaging process may already cover a whole segment
+        assert(self.boundaries[1] > self.imaging_stages)
+
+        num_segments = len(self.boundaries) - 1
+        names = [self._segment_name(i) for i in range(num_segments)]
+        self.segment_timings = StageTimings(names + ['submission to result'])
+        # slots[i] feeds segment i, and slots[-1] holds the results
+        self.slots = [HandoffSlot() for _ in range(num_segments + 1)]
+        self.error = None
+        # Rows are recorded from the last segment, while instrumentation is started
+        # and finished from the coordinator's thread
+        self.record_lock = threading.Lock()
+        self.workers = [threading.Thread(target=self._run_segment, args=(i,), daemon=True)
+                        for i in range(num_segments)]
+        for worker in self.workers:
+            worker.start()
+        logging.info(f"Running decoder in {num_segments} pipelined segments: {names}")
+
+    def _segment_name(self, segment_idx):
+        start = self.boundaries[segment_idx]
+        end = self.boundaries[segment_idx + 1]
+        end = len(self.pipeline.pipeline_stages) if end is None else end
+        return f"stages {start}-{end - 1}"
+
+    def _run_segment(self, segment_idx):
+        in_slot = self.slots[segment_idx]
+        out_slot = self.slots[segment_idx + 1]
+        end_stage = self.boundaries[segment_idx + 1]
+        try:
+            while True:
+                item = in_slot.take()
+                if item is None:
+                    return
+                value, (first_stage, submitted_ns, row) = item
+                start_ns = time.perf_counter_ns()
+                if segment_idx == 0:
+                    row = [] if self.pipeline.instrumented_stages else None
+                    result = self.pipeline.decode(value, first_stage, end_stage, row=row)
+                else:
+                    result = self.pipeline.decode_segment(
+                        value, self.boundaries[segment_idx], end_stage, row=row)
+                end_ns = time.perf_counter_ns()
+                self.segment_timings.record(segment_idx, end_ns - start_ns)
+                if end_stage is None:
+                    self.segment_timings.record(
+                        len(self.workers), end_ns - submitted_ns)
+                    if row is not None:
+                        with self.record_lock:
+                            self.pipeline.record_row(row)
+                        row = None
+                out_slot.put(result, (first_stage, submitted_ns, row))
+        except Exception as err:
+            logging.error(
+                f"Decoder segment {self._segment_name(segment_idx)} failed: {err}")
+            self.error = err
+            self.close()
+
+    def decode(self, input, first_stage=0):
+        """
+        Submits a frame to the first segment, and returns the newest result to have
+        left the last segment. Only the very first call waits for a result.
+        """
+        if self.error is not None:
+            raise self.error
+        self.slots[0].put(input, (first_stage, time.perf_counter_ns(), None))
+        latest = self.slots[-1].take_latest()
+        while latest is None and not self.slots[-1].closed:
+            latest = self.slots[-1].take(FIRST_RESULT_POLL_S)
+            if self.error is not None:
+                raise self.error
+        return None if latest is None else latest[0]
+
+    def frames_dropped(self):
+        # Frames that a segment was still busy for when the next one arrived
+        return sum([slot.values_dropped for slot in self.slots[:-1]])
+
+    def start_instrumentation(self, out_prefix):
+        with self.record_lock:
+            self.pipeline.start_instrumentation(out_prefix)
+
+    def finish_instrumentation(self):
+        with self.record_lock:
+            self.pipeline.finish_instrumentation()
+
+    def close(self):
+        for slot in self.slots:
+            slot.close()
+        for worker in self.workers:
+            if worker is not threading.current_thread():
+                worker.join()
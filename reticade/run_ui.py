@@ -65,6 +65,7 @@ def run_udp_receiver(flask_pipe, shared_dict):
 
 def run_imaging(flask_pipe, shared_dict):
     imaging = None
+    decoder_path = None
     import reticade.sapv_link
     while True:
         shared_dict['imaging_busy'] = False
@@ -77,7 +78,14 @@ def run_imaging(flask_pipe, shared_dict):
                 imaging = reticade.sapv_link.StandaloneImager()
             else:
                 imaging = reticade.sapv_link.TestImager()
+            if decoder_path is not None:
+                imaging.load_preprocessing(decoder_path)
             flask_pipe.send((ProcessMessage.ACK_CONNECT_PRAIRIEVIEW))
+        elif instruction_id == ProcessMessage.SEND_LOAD_DECODER:
+            decoder_path = f"decoders/{instruction[1]}"
+            if imaging is not None:
+                imaging.load_preprocessing(decoder_path)
+            flask_pipe.send((ProcessMessage.ACK_LOAD_DECODER))
         elif instruction_id == ProcessMessage.SEND_TEST_PRAIRIEVIEW:
             if imaging is None:
                 logging.error("Request to run liveview when imaging not configured")
@@ -4,8 +4,13 @@ import logging
 import os
 import ctypes
 import reticade.imaging_link
+import reticade.frame_assembly
+import reticade.frame_recorder
 import time
 import platform
+import queue
+import threading
+import tifffile
 if platform.system() == 'Windows':
     import win32com.client
 
@@ -13,13 +18,65 @@ logging.basicConfig(format='[%(asctime)s] [%(levelname)s] %(message)s',
                     datefmt='%H:%M:%S', level=logging.INFO)
 
 FRAME_RATE_REPORT_INTERVAL_S = 10
+# Used to size the recording file. Frames beyond this rate won't fit.
+RECORDING_MAX_FRAME_RATE_HZ = 60
+REPLAY_PREFETCH_FRAMES = 64
+# Sleep until this close to the next frame's due time, then spin
+REPLAY_SPIN_WINDOW_S = 0.002
+# How often the replay threads check on each other while waiting on the prefetch queue
+REPLAY_QUEUE_POLL_S = 0.1
+
+
+class ImagingPreprocessor:
+    """
+    Runs the leading stages of a decoder (its imaging_stages) in the imaging
+    process, and publishes their output in place of the raw frame. The harness
+    then picks up the pipeline where this left off, so the two processes work
+    as a two-stage pipeline and far less data crosses the shared memory.
+    """
+
+    def __init__(self, stages, dtype=np.float64):
+        self.stages = stages
+        # The decoder's precision, which integer frames are converted to
+        self.dtype = dtype
+
+    def from_decoder_json(path_to_decoder, transport):
+        """
+        Returns None if the decoder doesn't mark any stages to run in the imaging process.
+        """
+        import reticade.decoder_harness
+        decoder = reticade.decoder_harness.DecoderPipeline.from_json(
+            path_to_decoder)
+        if decoder.imaging_stages == 0:
+            logging.info(
+                f"{path_to_decoder} has no stages to run during imaging. Publishing raw frames.")
+            return None
+        if transport == reticade.imaging_link.TRANSPORT_UINT16:
+            logging.error(
+                "Preprocessed frames can't be shared as uint16. Publishing raw frames instead.")
+            return None
+        stages = decoder.pipeline_stages[:decoder.imaging_stages]
+        logging.info(
+            f"Running {len(stages)} decoder stages during imaging: {[type(s).__name__ for s in stages]}")
+        return ImagingPreprocessor(stages, decoder.dtype)
+
+    def publish(self, frame_ring, frame, timestamp_ns=None):
+        if frame.dtype.kind in 'ui' or self.dtype != np.float64:
+            frame = frame.astype(self.dtype, copy=False)
+        for stage in self.stages:
+            frame = stage.process(frame)
+        return frame_ring.write_frame(frame, timestamp_ns, stages_applied=len(self.stages))
 
 
 class StandaloneImager:
-    def __init__(self, image_size=(512, 512), max_frames_to_buffer=30):
+    def __init__(self, image_size=(512, 512), max_frames_to_buffer=30, transport=reticade.imaging_link.DEFAULT_TRANSPORT,
+                 prairie_link=None):
         self.image_size = image_size
         logging.info("Connecting to PrairieView via PrairieLink")
-        self.prairie_link = win32com.client.Dispatch("PrairieLink.Application")
+        # A stand-in for PrairieLink can be supplied for testing (see tests/tools/fake_prairie_link.py)
+        if prairie_link is None:
+            prairie_link = win32com.client.Dispatch("PrairieLink.Application")
+        self.prairie_link = prairie_link
         self.prairie_link.Connect()
         logging.info("Connection successful")
 
@@ -54,24 +111,30 @@ class StandaloneImager:
         Buffer = ctypes.c_char * memsize_bytes
         buf = Buffer.from_buffer(self.memory_block.buf)
         self.sharedmem_addr = ctypes.addressof(buf)
-        self.data_layout = (
-            image_size[0], image_size[1], self.pview_samples_per_pixel)
-        self.frame_storage = [np.ndarray(
-            self.num_samples_per_frame, dtype=np.int16) for _ in range(2)]
-        self.mem_offset = 0
-        self.frame_idx = 0
+        self.frame_assembler = reticade.frame_assembly.RawFrameAssembler(
+            image_size, self.pview_samples_per_pixel)
 
         # Configure some shared memory for the decoder
-        output_size = 8 * image_size[0] * image_size[1]
-        self.output_sharedmem = shared_memory.SharedMemory(name=reticade.imaging_link.IMAGING_LINK_MEMSHARE_NAME,
-                                                           create=True, size=output_size)
-        self.output_array = np.ndarray(
-            (image_size[0], image_size[1]), dtype=np.float64, buffer=self.output_sharedmem.buf)
+        self.frame_ring = reticade.imaging_link.FrameRingWriter(
+            image_size, transport=transport)
+        self.recorder = None
+        self.preprocessor = None
         self._reset_imaging_state()
         logging.info(
             "Standalone Link ready: reticade can now access shared memory")
 
-    def run_timeseries(self, duration_s):
+    def load_preprocessing(self, path_to_decoder):
+        self.preprocessor = ImagingPreprocessor.from_decoder_json(
+            path_to_decoder, self.frame_ring.transport)
+        if self.preprocessor is not None:
+            # The raw frame is assembled here first
+            self.raw_frame = np.zeros(self.image_size)
+
+    def run_timeseries(self, duration_s, record_to=None):
+        """
+        If record_to is a .npy path, every published frame is also written there
+        (with its sequence number and timestamp) by a background thread.
+        """
         self._pre_run()
         success = self.prairie_link.SendScriptCommands("-ts")
         if success:
@@ -81,7 +144,16 @@ class StandaloneImager:
             logging.error("Failed to start timeseries")
             return
 
-        self._run_for_time(duration_s)
+        if record_to:
+            max_frames = int(duration_s * RECORDING_MAX_FRAME_RATE_HZ) + 1
+            self.recorder = reticade.frame_recorder.FrameRecorder(
+                record_to, self.image_size, max_frames, dtype=self.frame_ring.slots.dtype)
+        try:
+            self._run_for_time(duration_s)
+        finally:
+            if self.recorder is not None:
+                self.recorder.close()
+                self.recorder = None
         self._post_run()
 
     def run_liveview(self, duration_s):
@@ -124,6 +196,8 @@ class StandaloneImager:
                 rate = interval_frames / window_length
                 logging.info(
                     f"Samples: {interval_frames} frames. Rate: {rate:.2f} Hz. Worst frame: {(worst_frame_time * 1000):.2f} ms.")
+                if self.recorder is not None:
+                    self.recorder.report_back_pressure()
 
                 interval_frames = 0
                 worst_frame_time = 0
@@ -179,62 +253,44 @@ class StandaloneImager:
             logging.info("GSDMA Buffer reinstated")
 
     def _reset_imaging_state(self):
-        self.mem_offset = 0
-        self.frame_idx = 0
-        # Force-fill the shared arrays so they're not populated by garbage in memory
+        self.frame_assembler.reset()
+        # Force-fill the shared array so it's not populated by garbage in memory.
+        # The frame ring is zeroed on creation and never reset, so that the
+        # harness sees sequence numbers increase across runs.
         self.shared_array.fill(0)
-        self.output_array.fill(0.0)
 
     def _get_current_frame(self):
         waiting_for_new_frame = True
         while waiting_for_new_frame:
             num_samples_written = self._send_prairieview_rrd()
-            samples_copied = 0
-            while (samples_copied < num_samples_written):
-                samples_to_read = min(num_samples_written - samples_copied,
-                                      self.num_samples_per_frame - self.mem_offset)
-
-                self.frame_storage[self.frame_idx][self.mem_offset:self.mem_offset +
-                                                   samples_to_read] = self.shared_array[samples_copied:samples_copied + samples_to_read]
-
-                if samples_to_read == self.num_samples_per_frame - self.mem_offset:
-                    # we've got a complete frame, so swap current frame and pending frame
-                    waiting_for_new_frame = False
-                    self.frame_idx = (self.frame_idx + 1) % 2
-
-                self.mem_offset = (
-                    self.mem_offset + samples_to_read) % self.num_samples_per_frame
-                samples_copied += samples_to_read
-
-        reshaped = self.frame_storage[(
-            self.frame_idx + 1) % 2].reshape(self.data_layout)
-
-        # Note(charlie): this subtraction of 8192 is at the suggestion of the
-        # PrairieView engineer to duplicate their behaviour. It needs validating.
-        reshaped = reshaped - 8192
-        reshaped[reshaped < 0] = 0
-        mean_over_samples = np.mean(reshaped, axis=2)
-        self._unraster_image(mean_over_samples)
-
-        self.output_array[:, :] = mean_over_samples
+            waiting_for_new_frame = not self.frame_assembler.add_samples(
+                self.shared_array[:num_samples_written])
+        acquisition_time_ns = time.perf_counter_ns()
+
+        if self.preprocessor is None:
+            # Assemble straight into the shared memory that the decoder reads from
+            frame = self.frame_assembler.assemble_into(
+                self.frame_ring.begin_frame())
+            sequence_number = self.frame_ring.publish_frame(acquisition_time_ns)
+        else:
+            frame = self.frame_assembler.assemble_into(self.raw_frame)
+            sequence_number = self.preprocessor.publish(
+                self.frame_ring, frame, acquisition_time_ns)
+        if self.recorder is not None:
+            # The copy happens here, before this slot can be claimed again
+            self.recorder.record(frame, sequence_number, acquisition_time_ns)
 
     def _send_prairieview_rrd(self):
         num_samples_written = self.prairie_link.ReadRawDataStream_3(
             self.pid, self.sharedmem_addr, self.num_samples_to_request)
         return num_samples_written
 
-    # Note: this will mutate an underlying image, it's indended for use
-    # on the post-mean image and *not* the shared underlying data
-    def _unraster_image(self, frame):
-        assert(frame.shape == self.image_size)
-        frame[1::2] = frame[1::2, ::-1]
-
     def close(self):
         self.prairie_link.Disconnect()
         self.memory_block.close()
         self.memory_block.unlink()
-        self.output_sharedmem.close()
-        self.output_sharedmem.unlink()
+        self.frame_ring.close()
+        self.frame_ring.unlink()
 
 
 """
@@ -242,15 +298,16 @@ This is a fake standalone imager useful for testing on computers
 that do not have PrairieView installed/available for communication.
 """
 class TestImager:
-    def __init__(self, image_size=(512, 512), max_frames_to_buffer=30):
-        output_size = 8 * image_size[0] * image_size[1]
-        self.output_sharedmem = shared_memory.SharedMemory(name=reticade.imaging_link.IMAGING_LINK_MEMSHARE_NAME,
-                                                           create=True, size=output_size)
-        self.output_array = np.ndarray(
-            (image_size[0], image_size[1]), dtype=np.float64, buffer=self.output_sharedmem.buf)
-        self.output_array.fill(0.0)
+    def __init__(self, image_size=(512, 512), max_frames_to_buffer=30, transport=reticade.imaging_link.DEFAULT_TRANSPORT):
+        self.frame_ring = reticade.imaging_link.FrameRingWriter(
+            image_size, transport=transport)
+        self.preprocessor = None
         time.sleep(3) # Simulate the lag on startup of PrairieView
 
+    def load_preprocessing(self, path_to_decoder):
+        self.preprocessor = ImagingPreprocessor.from_decoder_json(
+            path_to_decoder, self.frame_ring.transport)
+
     def run_timeseries(self, duration_s):
         self._run_with_dummy_data(duration_s)
 
@@ -261,13 +318,155 @@ class TestImager:
         start_time = time.perf_counter()
         refresh_interval_s = 0.033
         while time.perf_counter() < start_time + duration_s:
-            self.output_array.fill(0.0)
-            noise = np.random.normal(loc=2000, scale=1000, size=self.output_array.shape)
-            noise = np.clip(noise, 0, 4000)
-            self.output_array += noise
-            self.output_array[100:200, 200:300] += 2000
+            noise = np.random.normal(loc=2000, scale=1000, size=self.frame_ring.image_size)
+            output_array = np.clip(noise, 0, 4000)
+            output_array[100:200, 200:300] += 2000
+            if self.preprocessor is None:
+                self.frame_ring.write_frame(output_array)
+            else:
+                self.preprocessor.publish(self.frame_ring, output_array)
             time.sleep(refresh_interval_s)
 
     def close(self):
-        self.output_sharedmem.close()
-        self.output_sharedmem.unlink()
\ No newline at end of file
+        self.frame_ring.close()
+        self.frame_ring.unlink()
+
+
+"""
+This imager replays a recorded session (a .npy array of frames, a multi-page
+TIFF stack, or a folder of single-frame TIFFs) into the imaging shared memory
+at the original frame rate, or a multiple of it. Frames are read ahead on a
+background thread so that disk access doesn't hold up the stream.
+"""
+class ReplayImager:
+    def __init__(self, recording_path, frame_rate_hz=30.0, speedup=1.0, loop=True,
+                 transport=reticade.imaging_link.DEFAULT_TRANSPORT, prefetch_frames=REPLAY_PREFETCH_FRAMES):
+        self.recording_path = recording_path
+        self.frame_interval_s = 1.0 / (frame_rate_hz * speedup)
+        self.loop = loop
+        self.prefetch_frames = prefetch_frames
+        self.num_frames, self.image_size = self._open_recording(recording_path)
+        logging.info(
+            f"Replaying {self.num_frames} frames of size {self.image_size} from {recording_path} at {(1.0 / self.frame_interval_s):.2f} Hz")
+        self.frame_ring = reticade.imaging_link.FrameRingWriter(
+            self.image_size, transport=transport)
+        self.preprocessor = None
+        self.next_frame_idx = 0
+        self.underruns = 0
+
+    def load_preprocessing(self, path_to_decoder):
+        self.preprocessor = ImagingPreprocessor.from_decoder_json(
+            path_to_decoder, self.frame_ring.transport)
+
+    def _open_recording(self, recording_path):
+        self.tiff_stack = None
+        self.tiff_paths = None
+        self.npy_frames = None
+        if os.path.isdir(recording_path):
+            contents = sorted(os.listdir(recording_path))
+            self.tiff_paths = [os.path.join(recording_path, c) for c in contents
+                               if '.tif' in c and c[0] != '.']
+            first_frame = tifffile.imread(self.tiff_paths[0])
+            return len(self.tiff_paths), first_frame.shape
+        if recording_path.endswith('.npy'):
+            # Memory-mapped, so only the frames being prefetched are ever read from disk
+            self.npy_frames = np.load(recording_path, mmap_mode='r')
+            return self.npy_frames.shape[0], self.npy_frames.shape[1:]
+        self.tiff_stack = tifffile.TiffFile(recording_path)
+        return len(self.tiff_stack.pages), self.tiff_stack.pages[0].shape
+
+    def _read_frame(self, frame_idx):
+        if self.npy_frames is not None:
+            return np.array(self.npy_frames[frame_idx])
+        if self.tiff_paths is not None:
+            return tifffile.imread(self.tiff_paths[frame_idx])
+        return self.tiff_stack.pages[frame_idx].asarray()
+
+    def run_timeseries(self, duration_s):
+        self._run_replay(duration_s)
+
+    def run_liveview(self, duration_s):
+        self._run_replay(duration_s)
+
+    def _prefetch(self, frame_queue, stop_event):
+        frame_idx = self.next_frame_idx
+        while not stop_event.is_set():
+            if frame_idx >= self.num_frames:
+                if not self.loop:
+                    # Marks the end of the recording
+                    self._put_unless_stopped(frame_queue, None, stop_event)
+                    return
+                frame_idx = 0
+            frame = self._read_frame(frame_idx)
+            frame_idx += 1
+            self._put_unless_stopped(frame_queue, frame, stop_event)
+
+    def _put_unless_stopped(self, frame_queue, item, stop_event):
+        # Never blocks for good, so the replay can always stop (and join) this thread
+        while not stop_event.is_set():
+            try:
+                frame_queue.put(item, timeout=REPLAY_QUEUE_POLL_S)
+                return
+            except queue.Full:
+                continue
+
+    def _get_prefetched(self, frame_queue, prefetcher):
+        # Returns None at the end of the recording, or if the prefetcher has died
+        while True:
+            try:
+                return frame_queue.get(timeout=REPLAY_QUEUE_POLL_S)
+            except queue.Empty:
+                if not prefetcher.is_alive() and frame_queue.empty():
+                    logging.error("Frame prefetching stopped before the end of the recording")
+                    return None
+
+    def _run_replay(self, duration_s):
+        frame_queue = queue.Queue(maxsize=self.prefetch_frames)
+        stop_event = threading.Event()
+        prefetcher = threading.Thread(
+            target=self._prefetch, args=(frame_queue, stop_event))
+        prefetcher.start()
+
+        frames_published = 0
+        start_time = time.perf_counter()
+        end_time = start_time + duration_s
+        next_frame_time = start_time
+        try:
+            while next_frame_time < end_time:
+                try:
+                    frame = frame_queue.get_nowait()
+                except queue.Empty:
+                    # Disk couldn't keep up: the stream stalls until the next frame is read
+                    self.underruns += 1
+                    frame = self._get_prefetched(frame_queue, prefetcher)
+                if frame is None:
+                    logging.info("Reached the end of the recording")
+                    break
+
+                remaining_s = next_frame_time - time.perf_counter()
+                if remaining_s > REPLAY_SPIN_WINDOW_S:
+                    time.sleep(remaining_s - REPLAY_SPIN_WINDOW_S)
+                while time.perf_counter() < next_frame_time:
+                    continue
+
+                if self.preprocessor is None:
+                    self.frame_ring.write_frame(frame)
+                else:
+                    self.preprocessor.publish(self.frame_ring, frame)
+                frames_published += 1
+                self.next_frame_idx = (self.next_frame_idx + 1) % self.num_frames
+                next_frame_time = max(
+                    next_frame_time + self.frame_interval_s, time.perf_counter())
+        finally:
+            stop_event.set()
+            prefetcher.join()
+
+        true_runtime = time.perf_counter() - start_time
+        logging.info(
+            f"Replayed {frames_published} frames in {true_runtime:.2f} s. Mean rate: {(frames_published / true_runtime):.2f} Hz. Prefetch underruns: {self.underruns}")
+
+    def close(self):
+        if self.tiff_stack is not None:
+            self.tiff_stack.close()
+        self.frame_ring.close()
+        self.frame_ring.unlink()
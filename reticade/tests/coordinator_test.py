@@ -1,11 +1,19 @@
 import pytest
 import time
+import tracemalloc
 import struct
+import numpy as np
 from reticade.tests.tools.tcp_controller_link import ControllerLink
 from reticade.coordinator import Coordinator
 from reticade.decoder_harness import DecoderPipeline
 from reticade.decoding.dummy_decoder import MeanValueTaker
+from reticade.decoding.sig_proc import Downsampler, LowPassFilter, DeltaFFilter, DoGFilter, Threshold, Flatten, OutputScaler
+from reticade.decoding.svm_decoder import SvmClassifier
+from reticade.decoding.movement_controller import ClassMovementController
+from reticade.decoding import gaussian_plan
+from sklearn.svm import LinearSVC
 from reticade.imaging_link import ImagingLink
+from reticade.util.stage_timing import StageTimings, load_stage_timings
 from reticade.tests.image_link_test import TEST_IMAGE_DIMS
 from reticade.tests.tools.fake_labview import FakeLabview
 from reticade.tests.tools.fake_prairie_view import FakeStandalone
@@ -52,3 +60,170 @@ def test_end_to_end():
     decoded_received = [int(struct.unpack('>d', x)[0]) for x in labview_received]
     assert(TEST_VALUES == decoded_received)
     coordinator.close()
+
+
+def test_latency_accounting():
+    coordinator = Coordinator()
+    fake_prairie_view = FakeStandalone()
+    fake_prairie_view.open_sharedmem(TEST_IMAGE_DIMS)
+    coordinator.set_imaging(ImagingLink(TEST_IMAGE_DIMS))
+    coordinator.set_decoder(DecoderPipeline([MeanValueTaker()]))
+
+    # Publish one frame before the first tick, then two frames between ticks
+    fake_prairie_view.write_sharedmem_contents(0)
+    coordinator.tick()
+    for value in range(1, 7):
+        fake_prairie_view.write_sharedmem_contents(value)
+        if value % 2 == 0:
+            coordinator.tick()
+    coordinator.tick()
+
+    summary = coordinator.latency.summary()
+    assert(summary['ticks'] == 5)
+    assert(summary['skipped_sequence_numbers'] == 3)
+    assert(summary['repeated_sequence_numbers'] == 1)
+    p50, p99, worst = summary['frame_age']
+    assert(0 <= p50 <= p99 <= worst)
+    np.testing.assert_array_equal([1, 3, 5, 7, 7], coordinator.latency.as_array()[:, 0])
+
+    fake_prairie_view.close()
+    coordinator.close()
+
+
+def test_stage_timings(tmp_path):
+    coordinator = Coordinator()
+    fake_prairie_view = FakeStandalone()
+    fake_prairie_view.open_sharedmem(TEST_IMAGE_DIMS)
+    coordinator.set_imaging(ImagingLink(TEST_IMAGE_DIMS))
+    coordinator.set_decoder(DecoderPipeline([Downsampler((4, 4)), MeanValueTaker()]))
+    for value in range(5):
+        fake_prairie_view.write_sharedmem_contents(value)
+        coordinator.tick()
+
+    timings = coordinator.decoder.stage_timings
+    assert(list(timings.summary().keys()) == ['[0] Downsampler', '[1] MeanValueTaker'])
+    assert(timings.counts.sum(axis=1).tolist() == [5, 5])
+    p50, p99, worst = timings.summary()['[0] Downsampler']
+    assert(0 < p50 <= p99 <= worst)
+    stage_name, stage_time = coordinator.slowest_recent_stage()
+    assert(stage_name == '[0] Downsampler' and stage_time == worst)
+    assert(coordinator.slowest_recent_stage() is None)
+
+    out_file = str(tmp_path / "stage-timings.npz")
+    coordinator.dump_stage_timings(out_file)
+    edges, counts = load_stage_timings(out_file)['[1] MeanValueTaker']
+    assert(counts.sum() == 5 and len(edges) == len(counts))
+    coordinator.reset_latency()
+    assert(timings.counts.sum() == 0)
+
+    fake_prairie_view.close()
+    coordinator.close()
+
+
+def test_stage_timing_percentiles_are_within_a_bucket():
+    timings = StageTimings(['stage'])
+    for duration_ms in range(1, 101):
+        timings.record(0, duration_ms * 1000000)
+    p50, p99, worst = timings.summary()['stage']
+    assert(0.050 <= p50 < 0.050 * 1.2)
+    assert(0.099 <= p99 <= 0.100)
+    assert(worst == 0.100)
+
+
+def test_decoder_skips_stages_applied_during_imaging():
+    coordinator = Coordinator()
+    fake_prairie_view = FakeStandalone()
+    fake_prairie_view.open_sharedmem(TEST_IMAGE_DIMS)
+    coordinator.set_imaging(ImagingLink(TEST_IMAGE_DIMS))
+    decoder = DecoderPipeline([Downsampler((4, 4)), MeanValueTaker()],
+                              instrumented_stages=[0], imaging_stages=1)
+    coordinator.set_decoder(decoder)
+
+    reduced_frame = np.full((128, 128), 5.0)
+    fake_prairie_view.frame_ring.write_frame(reduced_frame, stages_applied=1)
+    coordinator.tick()
+    # The published frame stands in for the output of the skipped stage
+    np.testing.assert_array_equal(reduced_frame, decoder.instrumentation_history[1][0])
+    # Raw frames still go through the whole pipeline
+    fake_prairie_view.write_sharedmem_contents(3)
+    coordinator.tick()
+    assert(decoder.instrumentation_history[1][1].shape == (128, 128))
+    assert(coordinator.warned_preprocessing_mismatch)
+
+    fake_prairie_view.close()
+    coordinator.close()
+
+
+def fit_linear_classifier(rng, num_features, num_classes=4):
+    features = rng.normal(size=(100, num_features))
+    return SvmClassifier(LinearSVC(dual=False, max_iter=2000).fit(
+        features, rng.integers(0, num_classes, size=100)))
+
+
+def steady_state_tick_allocation(tmp_path, stages, frame_dims, instrumented_stages=[]):
+    # Decoders are run as from_json builds them, with linear stages fused
+    decoder_path = str(tmp_path / "decoder.json")
+    DecoderPipeline(stages, instrumented_stages=instrumented_stages).to_json(decoder_path)
+
+    coordinator = Coordinator()
+    fake_prairie_view = FakeStandalone()
+    fake_prairie_view.open_sharedmem(frame_dims)
+    coordinator.set_imaging(ImagingLink(frame_dims))
+    coordinator.set_decoder(DecoderPipeline.from_json(decoder_path))
+    if instrumented_stages:
+        # As in a real run, where instrumented outputs are streamed to disk
+        coordinator.start_instrumentation(str(tmp_path / "output"))
+    for value in range(5):
+        fake_prairie_view.write_sharedmem_contents(value)
+        coordinator.tick()
+
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    for value in range(5, 55):
+        fake_prairie_view.write_sharedmem_contents(value)
+        coordinator.tick()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    fake_prairie_view.close()
+    coordinator.close()
+    return peak - baseline
+
+
+# Without numpy >= 2.0's out= for FFTs, Gaussian plans filter directly instead
+@pytest.fixture(params=[True, False], ids=['fft_out', 'no_fft_out'])
+def fft_takes_out(request, monkeypatch):
+    if request.param and not gaussian_plan._FFT_TAKES_OUT:
+        pytest.skip("numpy's FFTs can't write into existing arrays before numpy 2.0")
+    monkeypatch.setattr(gaussian_plan, '_FFT_TAKES_OUT', request.param)
+    return request.param
+
+
+def test_tick_does_not_allocate_frames_in_steady_state(tmp_path, fft_takes_out):
+    frame_dims = (256, 256)
+    downsampled_dims = (128, 128)
+    rng = np.random.default_rng(0)
+    reference_image = np.ones(downsampled_dims)
+    # Each filter sits between non-linear stages, so that none of them are fused
+    stages = [Downsampler((2, 2)), DeltaFFilter(0.3, 0.001, downsampled_dims, initial_state=reference_image),
+              LowPassFilter(1.2), Threshold(0), DoGFilter(0.5, 2.5), Threshold(0), Flatten(),
+              fit_linear_classifier(rng, downsampled_dims[0] * downsampled_dims[1]), OutputScaler(0.5)]
+    # A single 128x128 float32 frame is 64 kB. Small Python objects are fine.
+    assert(steady_state_tick_allocation(tmp_path, stages, frame_dims) < 16 * 1024)
+
+
+def test_trained_layout_does_not_allocate_frames_in_steady_state(tmp_path, fft_takes_out):
+    # train_decoder's layout, fused and instrumented as it's loaded. Motion correction
+    # is left out: skimage's optical flow and warp allocate their results on every
+    # frame, which is a known exception to preallocation.
+    frame_dims = (512, 512)
+    downsampled_dims = (128, 128)
+    rng = np.random.default_rng(0)
+    reference_image = np.ones(downsampled_dims)
+    stages = [Downsampler((4, 4)), LowPassFilter(1.2),
+              DeltaFFilter(0.3, 0.001, downsampled_dims, initial_state=reference_image),
+              DoGFilter(0.5, 2.5), Threshold(0), Downsampler((4, 4)), Flatten(),
+              fit_linear_classifier(rng, 32 * 32, num_classes=10),
+              ClassMovementController([25, 38, 40, 30, 20, 15, 4, 30, 40, 25], 80), OutputScaler(1.0 / 50)]
+    allocated = steady_state_tick_allocation(tmp_path, stages, frame_dims, instrumented_stages=[6, 7, 8])
+    assert(allocated < 16 * 1024)
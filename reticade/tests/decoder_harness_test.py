@@ -0,0 +1,300 @@
+import pytest
+import time
+import threading
+import numpy as np
+from reticade.decoder_harness import DecoderPipeline
+from reticade.instrumentation_writer import CHUNKS_PER_STREAM, InstrumentationWriter, load_instrumentation
+from reticade.decoding import sig_proc
+from reticade.decoding.dummy_decoder import MeanValueTaker
+from reticade.decoding.motion_correction import FlowMotionCorrection
+from reticade.decoding.svm_decoder import GatedSvmClassifier, SvmClassifier
+from sklearn.svm import LinearSVC
+from skimage.transform import downscale_local_mean
+
+
+@pytest.mark.parametrize("first_stage", [sig_proc.LowPassFilter(1.2), sig_proc.Downsampler((2, 2)),
+                                         sig_proc.Downsampler((3, 3))])
+def test_float32_frames_decode_in_float64(first_stage):
+    frame = np.random.default_rng(0).uniform(0, 4000, size=(64, 64)).astype(np.float32)
+    pipeline = DecoderPipeline([first_stage, sig_proc.Flatten()], fuse_linear_stages=False)
+    result = pipeline.decode(frame)
+    assert(result.dtype == np.float64)
+    np.testing.assert_array_equal(pipeline.decode(frame.astype(np.float64)), result)
+
+
+def test_compact_frames_converted_before_float_stages():
+    frame = np.arange(64 * 64, dtype=np.uint16).reshape((64, 64))
+    pipeline = DecoderPipeline([sig_proc.LowPassFilter(1.2), MeanValueTaker()])
+    reference = DecoderPipeline([sig_proc.LowPassFilter(1.2), MeanValueTaker()])
+    np.testing.assert_allclose(reference.decode(frame.astype(np.float64)), pipeline.decode(frame))
+
+
+def test_downsampler_converts_compact_frames():
+    frame = np.arange(64 * 64, dtype=np.uint16).reshape((64, 64))
+    downsampler = sig_proc.Downsampler((4, 4))
+    pipeline = DecoderPipeline([downsampler])
+    result = pipeline.decode(frame)
+    assert(result.dtype == np.float64)
+    np.testing.assert_allclose(downsampler.process(frame.astype(np.float64)), result)
+
+
+@pytest.mark.parametrize("shape", [(64, 48), (66, 49), (3, 64, 48), (3, 66, 49)])
+def test_downsampler_matches_skimage(shape):
+    # Exact divisors take the fast path, and ragged sizes are padded with zeros as before
+    frames = np.random.default_rng(0).uniform(0, 4000, size=shape)
+    downsampler = sig_proc.Downsampler((4, 4))
+    factors = (1,) * (len(shape) - 2) + (4, 4)
+    expected = downscale_local_mean(frames, factors)
+    result = downsampler.process_batch(frames) if len(shape) == 3 else downsampler.process(frames)
+    np.testing.assert_allclose(expected, result, rtol=1e-12)
+
+
+def make_offline_pipeline(reference_image):
+    return DecoderPipeline([
+        sig_proc.Downsampler((2, 2)),
+        sig_proc.LowPassFilter(1.2),
+        FlowMotionCorrection(reference_image),
+        sig_proc.DeltaFFilter(0.3, 0.001, reference_image.shape,
+                              initial_state=np.copy(reference_image)),
+        sig_proc.DoGFilter(0.5, 2.5),
+        sig_proc.Threshold(0),
+        sig_proc.Downsampler((4, 4)),
+        sig_proc.Flatten(),
+        sig_proc.OutputScaler(0.5)])
+
+
+def test_decode_batch_matches_per_frame_decode():
+    rng = np.random.default_rng(0)
+    stack = rng.integers(0, 4000, size=(12, 128, 128), dtype=np.uint16)
+    reference_image = sig_proc.LowPassFilter(1.2).process(
+        sig_proc.Downsampler((2, 2)).process(stack[0]))
+    per_frame = make_offline_pipeline(reference_image)
+    batched = make_offline_pipeline(reference_image)
+    # decode reuses its output buffers, so each result has to be copied
+    expected = np.array([np.copy(per_frame.decode(frame)) for frame in stack])
+    np.testing.assert_array_equal(expected, batched.decode_batch(stack, batch_size=5))
+
+
+def make_classifier_pipeline(reference_image, classifier):
+    return [sig_proc.Downsampler((2, 2)),
+            sig_proc.LowPassFilter(1.2),
+            sig_proc.DeltaFFilter(0.3, 0.001, reference_image.shape,
+                                  initial_state=np.copy(reference_image)),
+            sig_proc.DoGFilter(0.5, 2.5),
+            sig_proc.Threshold(0),
+            sig_proc.Flatten(),
+            classifier]
+
+
+def test_float32_precision_keeps_svm_decisions(tmp_path):
+    rng = np.random.default_rng(0)
+    # Each class lights up its own patch of the frame
+    labels = rng.integers(0, 4, size=120)
+    stack = rng.normal(1000, 50, size=(len(labels), 64, 64))
+    for i, label in enumerate(labels):
+        stack[i, label * 16:(label + 1) * 16, 16:48] += 400
+    stack = stack.astype(np.uint16)
+    reference_image = np.full((32, 32), 1000.0)
+
+    features = DecoderPipeline(make_classifier_pipeline(
+        reference_image, sig_proc.Flatten())).decode_batch(stack)
+    classifier = SvmClassifier(LinearSVC(dual=False).fit(features, labels))
+    decoder_path = str(tmp_path / "decoder.json")
+    DecoderPipeline(make_classifier_pipeline(reference_image, classifier),
+                    precision='float32').to_json(decoder_path)
+
+    single_precision = DecoderPipeline.from_json(decoder_path)
+    assert(single_precision.precision == 'float32')
+    double_precision = DecoderPipeline(make_classifier_pipeline(reference_image, classifier))
+    for frame in stack:
+        assert(double_precision.decode(frame) == single_precision.decode(frame))
+    intermediate = DecoderPipeline(make_classifier_pipeline(
+        reference_image, sig_proc.Flatten()), precision='float32').decode(stack[0])
+    assert(intermediate.dtype == np.float32)
+
+
+def test_streamed_instrumentation_matches_in_memory_history(tmp_path):
+    rng = np.random.default_rng(0)
+    frames = rng.uniform(0, 100, size=(11, 32, 32))
+    stages = [sig_proc.LowPassFilter(1.2), sig_proc.Flatten(), MeanValueTaker()]
+    in_memory = DecoderPipeline(stages, instrumented_stages=[1, 2])
+    streamed = DecoderPipeline(stages, instrumented_stages=[1, 2])
+    out_prefix = str(tmp_path / "output")
+    # Small chunks, so that the run spans several of them and ends part way through one
+    streamed.instrumentation_writer = InstrumentationWriter(out_prefix, [1, 2], chunk_rows=4)
+    for frame in frames:
+        in_memory.decode(frame)
+        streamed.decode(frame)
+    streamed.finish_instrumentation()
+
+    assert(all(len(history) == 0 for history in streamed.instrumentation_history))
+    timestamps, stage_outputs = load_instrumentation(out_prefix)
+    assert(timestamps.shape == (len(frames),) and np.all(np.diff(timestamps) > 0))
+    assert(sorted(stage_outputs.keys()) == [1, 2])
+    np.testing.assert_array_equal(np.array(in_memory.instrumentation_history[1]), stage_outputs[1])
+    np.testing.assert_array_equal(np.array(in_memory.instrumentation_history[2]), stage_outputs[2])
+
+
+class StalledWriter(InstrumentationWriter):
+    # Writes nothing until the disk is ready
+    def __init__(self, *args, **kwargs):
+        self.disk_ready = threading.Event()
+        super().__init__(*args, **kwargs)
+
+    def _write_chunks(self):
+        self.disk_ready.wait()
+        super()._write_chunks()
+
+
+def test_stalled_instrumentation_drops_whole_frames(tmp_path):
+    out_prefix = str(tmp_path / "output")
+    writer = StalledWriter(out_prefix, [3], chunk_rows=4, max_chunks=2)
+    for i in range(30):
+        writer.record(0, float(i + 1))
+        writer.record(1, np.full(5, i))
+    writer.disk_ready.set()
+    writer.close()
+
+    # Memory stays within two chunks per stream, and the streams stay aligned
+    assert(writer.chunks_allocated == [2, 2])
+    assert(writer.frames_dropped == 22)
+    timestamps, stage_outputs = load_instrumentation(out_prefix)
+    np.testing.assert_array_equal(np.arange(1, 9), timestamps)
+    np.testing.assert_array_equal(np.repeat(np.arange(8)[:, None], 5, axis=1), stage_outputs[3])
+
+
+def test_instrumentation_frees_chunks_once_the_disk_catches_up(tmp_path):
+    out_prefix = str(tmp_path / "output")
+    writer = StalledWriter(out_prefix, [3], chunk_rows=4)
+    for i in range(40):
+        writer.record(0, float(i + 1))
+        writer.record(1, np.full(5, i))
+    writer.disk_ready.set()
+    writer.close()
+
+    # Chunks beyond the ones kept for reuse are let go, so a later backlog can allocate them again
+    assert(writer.peak_chunks == [10, 10])
+    assert(writer.chunks_allocated == [CHUNKS_PER_STREAM, CHUNKS_PER_STREAM])
+    assert(writer.frames_dropped == 0)
+    timestamps, _ = load_instrumentation(out_prefix)
+    np.testing.assert_array_equal(np.arange(1, 41), timestamps)
+
+
+class SlowStage:
+    def __init__(self, duration_s):
+        self.duration_s = duration_s
+
+    def process(self, raw_input):
+        time.sleep(self.duration_s)
+        return raw_input
+
+    def process_degraded(self, raw_input):
+        return raw_input
+
+
+def test_stages_degrade_when_deadline_at_risk():
+    frame = np.ones((8, 8))
+    pipeline = DecoderPipeline([SlowStage(0.02), MeanValueTaker()], frame_budget_s=0.01)
+    # Nothing is known about the stage's cost until it has run once
+    pipeline.decode(frame)
+    assert(not pipeline.last_frame_degraded)
+    for _ in range(3):
+        assert(pipeline.decode(frame) == 1.0)
+        assert(pipeline.last_frame_degraded)
+    assert(pipeline.degraded_frames == 3)
+    assert(pipeline.degraded_counts == [3, 0])
+
+    # A deadline passed to decode overrides the budget
+    pipeline.decode(frame, deadline_ns=time.perf_counter_ns() + 10**9)
+    assert(not pipeline.last_frame_degraded)
+    unbudgeted = DecoderPipeline([SlowStage(0.02), MeanValueTaker()])
+    unbudgeted.decode(frame)
+    unbudgeted.decode(frame)
+    assert(unbudgeted.degraded_frames == 0)
+
+
+def test_degraded_stages_approximate_full_stages():
+    rng = np.random.default_rng(0)
+    frame = rng.uniform(0, 100, size=(64, 64))
+    dog = sig_proc.DoGFilter(0.5, 2.5)
+    np.testing.assert_allclose(dog.process(frame), dog.process_degraded(frame), atol=1.0)
+    motion = FlowMotionCorrection(frame)
+    # Reusing the last flow gives the same result for the same frame
+    np.testing.assert_array_equal(motion.process(frame), motion.process_degraded(frame))
+
+
+@pytest.mark.parametrize("sidecar", [True, False])
+def test_decoder_round_trips_through_both_formats(tmp_path, sidecar):
+    rng = np.random.default_rng(0)
+    stack = rng.normal(1000, 50, size=(6, 64, 64))
+    reference_image = sig_proc.LowPassFilter(1.2).process(
+        sig_proc.Downsampler((2, 2)).process(stack.mean(axis=0)))
+    original = make_offline_pipeline(reference_image)
+    decoder_path = str(tmp_path / "decoder.json")
+    original.to_json(decoder_path, sidecar=sidecar)
+    assert((tmp_path / "decoder.bin").exists() == sidecar)
+
+    loaded = DecoderPipeline.from_json(decoder_path)
+    np.testing.assert_array_equal(reference_image, loaded.pipeline_stages[2].reference_image)
+    for frame in stack:
+        np.testing.assert_allclose(original.decode(frame), loaded.decode(frame))
+
+
+def test_loaded_decoder_saves_over_its_own_sidecar(tmp_path):
+    rng = np.random.default_rng(0)
+    stack = rng.normal(1000, 50, size=(3, 64, 64))
+    reference_image = sig_proc.LowPassFilter(1.2).process(
+        sig_proc.Downsampler((2, 2)).process(stack.mean(axis=0)))
+    decoder_path = str(tmp_path / "decoder.json")
+    make_offline_pipeline(reference_image).to_json(decoder_path, sidecar=True)
+
+    # Its reference image is still mapped from the file being replaced
+    loaded = DecoderPipeline.from_json(decoder_path)
+    loaded.to_json(decoder_path, sidecar=True)
+    np.testing.assert_array_equal(reference_image, loaded.pipeline_stages[2].reference_image)
+    reloaded = DecoderPipeline.from_json(decoder_path)
+    np.testing.assert_array_equal(reference_image, reloaded.pipeline_stages[2].reference_image)
+    assert([path.name for path in tmp_path.iterdir() if path.suffix == '.tmp'] == [])
+
+
+def test_gated_classifier_decodes_after_loading(tmp_path):
+    rng = np.random.default_rng(0)
+    features = rng.normal(size=(40, 16))
+    classes = (features[:, 0] > 0).astype(int)
+    gated = GatedSvmClassifier.from_training_data(features, classes)
+    decoder_path = str(tmp_path / "decoder.json")
+    DecoderPipeline([gated]).to_json(decoder_path)
+    loaded = DecoderPipeline.from_json(decoder_path)
+
+    # Classes are shifted up by one, leaving 0 for frames the classifier isn't sure of
+    confident = np.zeros(16)
+    confident[0] = 10
+    assert(gated.process(confident) == loaded.decode(confident) == 2)
+    loaded.pipeline_stages[0].threshold = 1.1
+    assert(loaded.decode(confident) == 0)
+
+
+def test_sliding_delta_f_matches_window_means():
+    rng = np.random.default_rng(0)
+    frames = rng.normal(1000, 50, size=(40, 16, 16))
+    sliding = sig_proc.DeltaFSliding(3, 12, (16, 16))
+    for i, frame in enumerate(frames):
+        # Before a window fills, its mean is over the frames seen so far
+        fast_mean = frames[max(0, i - 2):i + 1].mean(axis=0)
+        slow_mean = frames[max(0, i - 11):i + 1].mean(axis=0)
+        np.testing.assert_allclose((fast_mean - slow_mean) / slow_mean, sliding.process(frame), atol=1e-12)
+
+
+def test_sliding_delta_f_percentile_baseline_round_trips(tmp_path):
+    rng = np.random.default_rng(0)
+    frames = rng.normal(1000, 50, size=(400, 8, 8))
+    # Transients in a third of the frames drag the mean up, but not the 10th percentile
+    frames += (rng.random(frames.shape) < 0.3) * 300
+    decoder_path = str(tmp_path / "decoder.json")
+    DecoderPipeline([sig_proc.DeltaFSliding(5, 200, (8, 8), baseline_percentile=10)]).to_json(decoder_path)
+    sliding = DecoderPipeline.from_json(decoder_path).pipeline_stages[0]
+    assert(sliding.baseline_percentile == 10 and sliding.slow_history.shape == (200, 8, 8))
+    for frame in frames:
+        sliding.process(frame)
+    expected = np.percentile(frames[-200:], 10, axis=0)
+    np.testing.assert_allclose(expected, sliding.baseline, rtol=0.02)
@@ -0,0 +1,67 @@
+import pytest
+import numpy as np
+from reticade.frame_assembly import RawFrameAssembler
+
+TEST_IMAGE_DIMS = (16, 8)
+SAMPLES_PER_PIXEL = 3
+
+
+def reference_frame(samples):
+    # The original implementation from the imaging links (widened so very
+    # negative samples do not wrap around when offset)
+    reshaped = samples.reshape(
+        (TEST_IMAGE_DIMS[0], TEST_IMAGE_DIMS[1], SAMPLES_PER_PIXEL)).astype(np.int32)
+    reshaped = reshaped - 8192
+    reshaped[reshaped < 0] = 0
+    mean_over_samples = np.mean(reshaped, axis=2)
+    mean_over_samples[1::2] = mean_over_samples[1::2, ::-1]
+    return mean_over_samples
+
+
+def make_stream(num_frames):
+    rng = np.random.default_rng(1234)
+    samples_per_frame = TEST_IMAGE_DIMS[0] * \
+        TEST_IMAGE_DIMS[1] * SAMPLES_PER_PIXEL
+    stream = rng.integers(-32768, 32767, size=samples_per_frame *
+                          num_frames, dtype=np.int16)
+    return stream, samples_per_frame
+
+
+def feed(assembler, stream, chunk_size):
+    completed = []
+    for i in range(0, len(stream), chunk_size):
+        if assembler.add_samples(np.copy(stream[i:i + chunk_size])):
+            completed.append((i + chunk_size, assembler.assemble_into(
+                np.zeros(TEST_IMAGE_DIMS))))
+    return completed
+
+
+def test_matches_reference_across_chunk_sizes():
+    stream, samples_per_frame = make_stream(5)
+    for chunk_size in [7, samples_per_frame // 3, samples_per_frame, samples_per_frame + 5]:
+        assembler = RawFrameAssembler(TEST_IMAGE_DIMS, SAMPLES_PER_PIXEL)
+        for chunk_end, frame in feed(assembler, stream, chunk_size):
+            newest_frame = min(chunk_end, len(stream)) // samples_per_frame
+            expected = reference_frame(
+                stream[(newest_frame - 1) * samples_per_frame:newest_frame * samples_per_frame])
+            np.testing.assert_array_equal(expected, frame)
+
+
+def test_chunk_spanning_several_frames_keeps_newest():
+    stream, samples_per_frame = make_stream(4)
+    assembler = RawFrameAssembler(TEST_IMAGE_DIMS, SAMPLES_PER_PIXEL)
+    assert(not assembler.add_samples(np.copy(stream[:10])))
+    assert(assembler.add_samples(np.copy(stream[10:3 * samples_per_frame + 10])))
+    frame = assembler.assemble_into(np.zeros(TEST_IMAGE_DIMS))
+    np.testing.assert_array_equal(reference_frame(
+        stream[2 * samples_per_frame:3 * samples_per_frame]), frame)
+
+
+def test_compact_outputs():
+    stream, samples_per_frame = make_stream(1)
+    expected = reference_frame(stream)
+    for dtype in [np.float32, np.uint16]:
+        assembler = RawFrameAssembler(TEST_IMAGE_DIMS, SAMPLES_PER_PIXEL)
+        assert(assembler.add_samples(np.copy(stream)))
+        frame = assembler.assemble_into(np.zeros(TEST_IMAGE_DIMS, dtype=dtype))
+        np.testing.assert_array_equal(expected.astype(dtype), frame)
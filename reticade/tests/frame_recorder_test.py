@@ -0,0 +1,66 @@
+import threading
+import numpy as np
+from reticade.frame_recorder import FrameRecorder, load_recording
+from reticade.imaging_link import ImagingLink
+from reticade.sapv_link import StandaloneImager
+from reticade.tests.tools.fake_prairie_link import FakePrairieLink
+
+TEST_IMAGE_DIMS = (32, 32)
+
+
+def test_recorded_frames_round_trip(tmp_path):
+    out_file = str(tmp_path / "recording.npy")
+    recorder = FrameRecorder(out_file, TEST_IMAGE_DIMS, max_frames=10)
+    for i in range(5):
+        assert(recorder.record(np.full(TEST_IMAGE_DIMS, i), i + 1, 1000 * i))
+    recorder.close()
+    frames, timestamps = load_recording(out_file)
+    assert(frames.shape == (5, TEST_IMAGE_DIMS[0], TEST_IMAGE_DIMS[1]))
+    for i in range(5):
+        assert(np.all(frames[i] == i))
+        assert(timestamps[i, 0] == i + 1)
+        assert(timestamps[i, 1] == 1000 * i)
+
+
+def test_record_drops_instead_of_blocking(tmp_path):
+    out_file = str(tmp_path / "recording.npy")
+    recorder = FrameRecorder(out_file, TEST_IMAGE_DIMS,
+                             max_frames=10, num_buffers=2)
+    # Simulate a stalled disk
+    disk_ready = threading.Event()
+    write_frame = recorder._write_frame
+
+    def slow_write_frame(*args):
+        disk_ready.wait()
+        write_frame(*args)
+    recorder._write_frame = slow_write_frame
+
+    results = [recorder.record(np.full(TEST_IMAGE_DIMS, i), i + 1, i)
+               for i in range(5)]
+    assert(results == [True, True, False, False, False])
+    assert(recorder.frames_dropped == 3)
+    recorder.report_back_pressure()
+    assert(recorder.frames_dropped_since_report == 0)
+
+    disk_ready.set()
+    recorder.close()
+    frames, timestamps = load_recording(out_file)
+    assert(list(timestamps[:, 0]) == [1, 2])
+    assert(np.all(frames[1] == 1))
+
+
+def test_timeseries_records_published_frames(tmp_path):
+    out_file = str(tmp_path / "session.npy")
+    fake_link = FakePrairieLink(TEST_IMAGE_DIMS, frame_rate_hz=60.0)
+    imager = StandaloneImager(TEST_IMAGE_DIMS, prairie_link=fake_link)
+    imaging_link = ImagingLink(TEST_IMAGE_DIMS)
+    imager.run_timeseries(0.3, record_to=out_file)
+    last_frame = np.array(imaging_link.get_current_frame())
+    frames, timestamps = load_recording(out_file)
+    assert(len(frames) > 0)
+    assert(timestamps[-1, 0] == imaging_link.last_sequence_number)
+    assert(timestamps[-1, 1] == imaging_link.last_timestamp_ns)
+    assert(np.array_equal(frames[-1], last_frame))
+    imaging_link.release_frame()
+    imaging_link.notify_socket.close()
+    imager.close()
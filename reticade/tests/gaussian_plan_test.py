@@ -0,0 +1,108 @@
+import pytest
+import tracemalloc
+import numpy as np
+from skimage.filters import gaussian, difference_of_gaussians
+from reticade.decoder_harness import DecoderPipeline
+from reticade.decoding import sig_proc, gaussian_plan
+from reticade.decoding.gaussian_plan import GaussianPlan
+
+
+def make_frames(shape, dtype):
+    rng = np.random.default_rng(0)
+    return rng.normal(1000, 50, size=shape).astype(dtype)
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+@pytest.mark.parametrize("sigma", [0.5, 1.2, 8.0])
+def test_low_pass_matches_skimage(dtype, sigma):
+    frame = make_frames((96, 80), dtype)
+    expected = gaussian(frame, sigma, mode='nearest')
+    result = sig_proc.LowPassFilter(sigma).process(frame)
+    assert(result.dtype == expected.dtype)
+    np.testing.assert_allclose(expected, result, rtol=1e-5 if dtype == np.float32 else 1e-12)
+
+
+def test_low_pass_leaves_integer_frames_to_skimage():
+    frame = make_frames((96, 80), np.uint16)
+    low_pass = sig_proc.LowPassFilter(1.2)
+    shape, dtype = low_pass.prepare(frame.shape, frame.dtype)
+    out = np.zeros(shape, dtype=dtype)
+    result = low_pass.process(frame, out=out)
+    assert(result is out)
+    np.testing.assert_allclose(gaussian(frame, 1.2), result)
+
+
+def test_both_plan_types_match_difference_of_gaussians():
+    frame = make_frames((96, 80), np.float64)
+    terms = [(1.0, 0.5), (-1.0, 2.5)]
+    direct = GaussianPlan(terms, 3.0, frame.shape, frame.dtype, use_fft=False)
+    fft = GaussianPlan(terms, 3.0, frame.shape, frame.dtype, use_fft=True)
+
+    expected = difference_of_gaussians(frame, 0.5, 2.5, truncate=3.0)
+    np.testing.assert_allclose(expected, direct.apply(frame, np.zeros(frame.shape)), atol=1e-9)
+    np.testing.assert_allclose(expected, fft.apply(frame, np.zeros(frame.shape)), atol=1e-9)
+
+
+def test_dog_filters_stacks_frame_by_frame():
+    stack = make_frames((3, 64, 48), np.float64)
+    dog = sig_proc.DoGFilter(0.5, 2.5)
+    expected = difference_of_gaussians(stack, (0, 0.5, 0.5), (0, 2.5, 2.5), truncate=3.0)
+    np.testing.assert_allclose(expected, dog.process_batch(stack), atol=1e-9)
+    out = np.zeros(stack.shape[1:])
+    dog.prepare(out.shape, out.dtype)
+    np.testing.assert_allclose(expected[1], dog.process(stack[1], out=out), atol=1e-9)
+
+
+def test_plans_filter_directly_without_fft_out(monkeypatch):
+    # Before numpy 2.0, transforms can't write into existing arrays
+    monkeypatch.setattr(gaussian_plan, '_FFT_TAKES_OUT', False)
+    frame = make_frames((256, 256), np.float64)
+    terms = [(1.0, 0.5), (-1.0, 2.5)]
+    plan = GaussianPlan(terms, 3.0, frame.shape, frame.dtype)
+    assert(not plan.use_fft)
+
+    # The fallback transforms still work when asked for explicitly
+    fft = GaussianPlan(terms, 3.0, frame.shape, frame.dtype, use_fft=True)
+    expected = difference_of_gaussians(frame, 0.5, 2.5, truncate=3.0)
+    np.testing.assert_allclose(expected, fft.apply(frame, np.zeros(frame.shape)), atol=1e-9)
+
+    out = np.zeros(frame.shape)
+    plan.apply(frame, out)
+    tracemalloc.start()
+    plan.apply(frame, out)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    np.testing.assert_allclose(expected, out, atol=1e-9)
+    assert(peak < 16 * 1024)
+
+
+@pytest.mark.parametrize("fft_takes_out", [True, False])
+def test_dog_only_degrades_when_the_short_kernel_is_cheaper(monkeypatch, fft_takes_out):
+    monkeypatch.setattr(gaussian_plan, '_FFT_TAKES_OUT', fft_takes_out)
+    frame = make_frames((512, 512), np.float64)
+    dog = sig_proc.DoGFilter(0.5, 2.5)
+    # Every frame is past its deadline from the start
+    pipeline = DecoderPipeline([dog], frame_budget_s=1e-9)
+    pipeline.decode(frame)
+    full_plan = dog._plan(frame.shape, frame.dtype, degraded=False)
+    degraded_plan = dog._plan(frame.shape, frame.dtype, degraded=True)
+    if fft_takes_out:
+        # Filtering in the frequency domain costs the same whatever the kernel's
+        # width, and beats even the shorter kernel applied directly
+        assert(full_plan.use_fft and degraded_plan is full_plan)
+        assert(not dog.degrades(frame.shape, frame.dtype))
+        assert(pipeline.degraded_frames == 0)
+    else:
+        assert(not degraded_plan.use_fft and degraded_plan.cost < full_plan.cost)
+        assert(dog.degrades(frame.shape, frame.dtype))
+        assert(pipeline.degraded_frames == 1)
+
+
+def test_stacks_of_any_length_share_the_frame_plan():
+    low_pass = sig_proc.LowPassFilter(1.2)
+    for length in [5, 3, 1]:
+        stack = make_frames((length, 64, 48), np.float64)
+        np.testing.assert_allclose(gaussian(stack, (0, 1.2, 1.2), mode='nearest'),
+                                   low_pass.process_batch(stack), rtol=1e-12)
+    low_pass.process(stack[0])
+    assert(len(low_pass.plans) == 1)
@@ -1,6 +1,9 @@
 import pytest
 import numpy as np
+import threading
+import time
 from reticade.imaging_link import ImagingLink
+import reticade.imaging_link as imlink
 from reticade.tests.tools.fake_prairie_view import FakeStandalone
 
 TEST_IMAGE_DIMS = (512, 512)
@@ -31,3 +34,113 @@ def test_updates_work():
     current_frame = imaging_link.get_current_frame()
     np.testing.assert_array_equal(np.ones(TEST_IMAGE_DIMS), current_frame)
     close_resources(imaging_link, fake_prairie_view)
+
+
+def test_sequence_numbers_track_dropped_frames():
+    imaging_link, fake_prairie_view = open_resources()
+    fake_prairie_view.write_sharedmem_contents(1)
+    imaging_link.get_current_frame()
+    for value in range(2, 5):
+        fake_prairie_view.write_sharedmem_contents(value)
+    current_frame = imaging_link.get_current_frame()
+    imaging_link.get_current_frame()
+    np.testing.assert_array_equal(np.full(TEST_IMAGE_DIMS, 4), current_frame)
+    assert(imaging_link.last_sequence_number == 4)
+    assert(imaging_link.frames_dropped == 2)
+    assert(imaging_link.frames_repeated == 1)
+    close_resources(imaging_link, fake_prairie_view)
+
+
+def test_partially_written_frame_not_visible():
+    imaging_link, fake_prairie_view = open_resources()
+    fake_prairie_view.write_sharedmem_contents(1)
+    imaging_link.get_current_frame()
+    # Start writing the next frame, but don't publish it yet
+    fake_prairie_view.frame_ring.begin_frame().fill(2)
+    assert(not imaging_link.has_new_frame())
+    current_frame = imaging_link.get_current_frame()
+    np.testing.assert_array_equal(np.ones(TEST_IMAGE_DIMS), current_frame)
+    fake_prairie_view.frame_ring.publish_frame()
+    assert(imaging_link.has_new_frame())
+    current_frame = imaging_link.get_current_frame()
+    np.testing.assert_array_equal(np.full(TEST_IMAGE_DIMS, 2), current_frame)
+    close_resources(imaging_link, fake_prairie_view)
+
+
+def test_held_frame_is_stable_until_released():
+    imaging_link, fake_prairie_view = open_resources()
+    fake_prairie_view.write_sharedmem_contents(1)
+    held_frame = imaging_link.get_current_frame()
+    assert(not held_frame.flags.writeable)
+    # The producer laps the ring several times while the frame is held
+    for value in range(2, 12):
+        fake_prairie_view.write_sharedmem_contents(value)
+    np.testing.assert_array_equal(np.ones(TEST_IMAGE_DIMS), held_frame)
+    imaging_link.release_frame()
+    current_frame = imaging_link.get_current_frame()
+    np.testing.assert_array_equal(np.full(TEST_IMAGE_DIMS, 11), current_frame)
+    close_resources(imaging_link, fake_prairie_view)
+
+
+def test_reader_retries_if_producer_claimed_the_slot(monkeypatch):
+    imaging_link, fake_prairie_view = open_resources()
+    fake_prairie_view.write_sharedmem_contents(1)
+    slot = fake_prairie_view.frame_ring.latest_slot
+    slot_headers = fake_prairie_view.frame_ring.slot_headers
+    fences = []
+
+    def racing_fence():
+        # Just after the reader's first check, a producer that hadn't seen the
+        # hold yet claims the slot, then notices it and backs off
+        fences.append(None)
+        if len(fences) == 2:
+            slot_headers[slot, imlink.SLOT_WRITE_COUNTER] += 2
+    monkeypatch.setattr(imlink, '_memory_fence', racing_fence)
+    current_frame = imaging_link.get_current_frame()
+    assert(len(fences) == 4)
+    np.testing.assert_array_equal(np.ones(TEST_IMAGE_DIMS), current_frame)
+    assert(imaging_link.last_sequence_number == 1)
+    close_resources(imaging_link, fake_prairie_view)
+
+
+def test_compact_transport_types():
+    for transport, dtype in imlink.transport_dtypes.items():
+        fake_prairie_view = FakeStandalone()
+        fake_prairie_view.open_sharedmem(TEST_IMAGE_DIMS, transport=transport)
+        imaging_link = ImagingLink(TEST_IMAGE_DIMS)
+        fake_prairie_view.write_sharedmem_contents(1000)
+        current_frame = imaging_link.get_current_frame()
+        assert(current_frame.dtype == dtype)
+        np.testing.assert_array_equal(np.full(TEST_IMAGE_DIMS, 1000), current_frame)
+        close_resources(imaging_link, fake_prairie_view)
+
+
+def test_wait_for_frame_wakes_on_publish():
+    imaging_link, fake_prairie_view = open_resources()
+    assert(not imaging_link.wait_for_frame(0.05))
+
+    publisher = threading.Timer(
+        0.05, fake_prairie_view.write_sharedmem_contents, args=(1,))
+    wait_start = time.perf_counter()
+    publisher.start()
+    assert(imaging_link.wait_for_frame(5.0))
+    waited_s = time.perf_counter() - wait_start
+    publisher.join()
+    assert(waited_s < 1.0)
+    imaging_link.get_current_frame()
+    assert(not imaging_link.wait_for_frame(0.01))
+    close_resources(imaging_link, fake_prairie_view)
+
+
+def test_reduced_frames_carry_their_shape():
+    imaging_link, fake_prairie_view = open_resources()
+    reduced_frame = np.arange(128 * 128, dtype=np.float32).reshape((128, 128))
+    fake_prairie_view.frame_ring.write_frame(reduced_frame, stages_applied=2)
+    current_frame = imaging_link.get_current_frame()
+    np.testing.assert_array_equal(reduced_frame, current_frame)
+    assert(imaging_link.last_stages_applied == 2)
+    fake_prairie_view.write_sharedmem_contents(1)
+    current_frame = imaging_link.get_current_frame()
+    np.testing.assert_array_equal(np.ones(TEST_IMAGE_DIMS), current_frame)
+    assert(imaging_link.last_stages_applied == 0)
+    close_resources(imaging_link, fake_prairie_view)
@@ -0,0 +1,116 @@
+import pytest
+import numpy as np
+from sklearn.svm import LinearSVC
+from reticade.decoder_harness import DecoderPipeline
+from reticade.decoding import linear_fusion
+from reticade.decoding import sig_proc
+from reticade.decoding.svm_decoder import SvmClassifier
+from reticade.decoding.linear_fusion import FusedLinearStage
+
+TEST_IMAGE_DIMS = (256, 256)
+
+
+def make_classifier(num_features, num_classes=5):
+    rng = np.random.default_rng(1)
+    features = rng.normal(size=(200, num_features))
+    classes = rng.integers(0, num_classes, size=200)
+    return SvmClassifier(LinearSVC(penalty='l1', C=0.2, dual=False, max_iter=3000).fit(features, classes))
+
+
+def make_stages(classifier):
+    return [sig_proc.Downsampler((4, 4)), sig_proc.LowPassFilter(1.2), sig_proc.DoGFilter(0.5, 2.5),
+            sig_proc.Threshold(0), sig_proc.Downsampler((4, 4)), sig_proc.Flatten(), classifier,
+            sig_proc.OutputScaler(0.5)]
+
+
+def make_frames(num_frames):
+    rng = np.random.default_rng(2)
+    return rng.integers(0, 4000, size=(num_frames,) + TEST_IMAGE_DIMS).astype(np.float32)
+
+
+def test_fused_pipeline_matches_unfused():
+    classifier = make_classifier(16 * 16)
+    unfused = DecoderPipeline(make_stages(classifier))
+    fused = DecoderPipeline(make_stages(classifier), fuse_linear_stages=True)
+    unit_types = [type(unit[0]) for unit in fused.execution_units]
+    assert(unit_types == [FusedLinearStage, sig_proc.Threshold, FusedLinearStage, sig_proc.OutputScaler])
+    for frame in make_frames(10):
+        assert(unfused.decode(frame) == fused.decode(frame))
+
+
+def test_fused_filters_match_within_tolerance():
+    stages = [sig_proc.Downsampler((4, 4)), sig_proc.LowPassFilter(1.2), sig_proc.DoGFilter(0.5, 2.5)]
+    fused = FusedLinearStage(stages)
+    for frame in make_frames(3):
+        expected = frame
+        for stage in stages:
+            expected = stage.process(expected)
+        np.testing.assert_allclose(fused.process(frame), expected, rtol=1e-6, atol=1e-6)
+    assert(fused.operators[TEST_IMAGE_DIMS] is not None)
+
+
+def test_runs_stop_at_instrumented_stages_and_imaging_boundary():
+    classifier = make_classifier(16 * 16)
+    pipeline = DecoderPipeline(make_stages(classifier), instrumented_stages=[5, 6],
+                               imaging_stages=1, fuse_linear_stages=True)
+    spans = [(start, end) for _, start, end in pipeline.execution_units]
+    assert(spans == [(0, 0), (1, 2), (3, 3), (4, 5), (6, 6), (7, 7)])
+    # The classifier on its own still folds into a weight map
+    classifier_unit = pipeline.execution_units[4][0]
+    assert(isinstance(classifier_unit, FusedLinearStage))
+
+    unfused = DecoderPipeline(make_stages(classifier), instrumented_stages=[5, 6])
+    for frame in make_frames(3):
+        assert(unfused.decode(frame) == pipeline.decode(frame))
+    for recorded, expected in zip(pipeline.instrumentation_history[1:], unfused.instrumentation_history[1:]):
+        np.testing.assert_allclose(np.array(recorded), np.array(expected), rtol=1e-6, atol=1e-6)
+    assert(classifier_unit.operators[(16 * 16,)] is not None)
+
+
+def test_mismatched_fusion_falls_back_to_unfused(monkeypatch):
+    def wrong_gaussian_matrix(size, sigma, truncate):
+        return np.eye(size)
+    monkeypatch.setattr(linear_fusion, '_gaussian_matrix', wrong_gaussian_matrix)
+    stages = [sig_proc.Downsampler((4, 4)), sig_proc.LowPassFilter(1.2)]
+    fused = FusedLinearStage(stages)
+    frame = make_frames(1)[0]
+    expected = stages[1].process(stages[0].process(frame))
+    np.testing.assert_array_equal(fused.process(frame), expected)
+    assert(fused.operators[TEST_IMAGE_DIMS] is None)
+
+
+def test_filters_on_full_frames_run_unfused_in_place():
+    # Dense per-axis matrices on a full frame cost more than filtering it directly
+    stages = [sig_proc.LowPassFilter(1.2), sig_proc.DoGFilter(0.5, 2.5)]
+    frame = make_frames(1)[0].astype(np.float64)
+    fused = FusedLinearStage(stages)
+    output_shape, output_dtype = fused.prepare(frame.shape, frame.dtype)
+    assert(fused.operators[TEST_IMAGE_DIMS] is None)
+    out = np.zeros(output_shape, dtype=output_dtype)
+    assert(fused.process(frame, out=out) is out)
+    np.testing.assert_array_equal(out, stages[1].process(stages[0].process(frame)))
+
+
+def test_loaded_decoders_are_fused(tmp_path):
+    decoder_path = str(tmp_path / "decoder.json")
+    classifier = make_classifier(16 * 16)
+    DecoderPipeline(make_stages(classifier)).to_json(decoder_path)
+    loaded = DecoderPipeline.from_json(decoder_path)
+    assert(any(isinstance(unit[0], FusedLinearStage) for unit in loaded.execution_units))
+    assert([type(s) for s in loaded.pipeline_stages] == [type(s) for s in make_stages(classifier)])
+    reference = DecoderPipeline(make_stages(classifier))
+    for frame in make_frames(3):
+        assert(reference.decode(frame) == loaded.decode(frame))
+
+
+def test_loaded_decoders_batch_exactly_like_frames(tmp_path):
+    decoder_path = str(tmp_path / "decoder.json")
+    classifier = make_classifier(16 * 16)
+    # Without the classifier, so the results are the filtered frames themselves
+    DecoderPipeline(make_stages(classifier)[:3]).to_json(decoder_path)
+    per_frame = DecoderPipeline.from_json(decoder_path)
+    batched = DecoderPipeline.from_json(decoder_path)
+    assert(isinstance(batched.execution_units[0][0], FusedLinearStage))
+    frames = make_frames(6)
+    expected = np.array([np.copy(per_frame.decode(frame)) for frame in frames])
+    np.testing.assert_array_equal(expected, batched.decode_batch(frames, batch_size=4))
@@ -0,0 +1,65 @@
+import itertools
+import pytest
+import numpy as np
+from scipy.ndimage import median_filter
+from reticade.decoding import sig_proc
+from reticade.decoding.median_plan import sorting_network
+
+
+def make_frame(shape, dtype):
+    rng = np.random.default_rng(0)
+    return rng.uniform(0, 4000, size=shape).astype(dtype)
+
+
+@pytest.mark.parametrize("wires", range(1, 10))
+def test_sorting_networks_sort_every_binary_input(wires):
+    # Any network that sorts all 0/1 inputs sorts everything
+    network = sorting_network(wires)
+    for bits in itertools.product([0, 1], repeat=wires):
+        values = list(bits)
+        for i, j in network:
+            values[i], values[j] = min(values[i], values[j]), max(values[i], values[j])
+        assert(values == sorted(values))
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32, np.uint16])
+@pytest.mark.parametrize("size", [3, 5])
+def test_small_windows_match_scipy(dtype, size):
+    frame = make_frame((66, 49), dtype)
+    # Plenty of ties, too
+    frame[:20] = np.round(frame[:20] / 1000)
+    expected = median_filter(frame, size=size, mode='nearest')
+    result = sig_proc.FastMedianFilter(size).process(frame)
+    assert(result.dtype == expected.dtype)
+    np.testing.assert_array_equal(expected, result)
+
+
+@pytest.mark.parametrize("size", [7, 11])
+def test_large_windows_are_within_half_a_level(size):
+    frame = make_frame((64, 48), np.float64)
+    expected = median_filter(frame, size=size, mode='nearest')
+    result = sig_proc.FastMedianFilter(size, levels=32).process(frame)
+    step = (frame.max() - frame.min()) / 32
+    assert(np.abs(expected - result).max() <= step / 2 + 1e-9)
+
+    # Integer frames with no more distinct values than levels are exact
+    quantised = (frame // 200).astype(np.uint16)
+    np.testing.assert_array_equal(median_filter(quantised, size=size, mode='nearest'),
+                                  sig_proc.FastMedianFilter(size, levels=32).process(quantised))
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.uint16])
+@pytest.mark.parametrize("size", [3, 7])
+def test_constant_frames_are_unchanged(dtype, size):
+    frame = np.full((10, 12), 5, dtype=dtype)
+    np.testing.assert_array_equal(frame, sig_proc.FastMedianFilter(size).process(frame))
+
+
+def test_fast_median_filters_stacks_frame_by_frame():
+    stack = make_frame((3, 32, 40), np.float64)
+    median = sig_proc.FastMedianFilter(5)
+    expected = median_filter(stack, size=(1, 5, 5), mode='nearest')
+    np.testing.assert_array_equal(expected, median.process_batch(stack))
+    out = np.zeros(stack.shape[1:])
+    median.prepare(out.shape, out.dtype)
+    np.testing.assert_array_equal(expected[1], median.process(stack[1], out=out))
@@ -0,0 +1,85 @@
+import pytest
+import time
+import numpy as np
+from reticade.decoder_harness import DecoderPipeline
+from reticade.decoding import sig_proc
+from reticade.decoding.dummy_decoder import MeanValueTaker
+from reticade.pipelined_decoder import HandoffSlot, PipelinedDecoder
+
+SEGMENT_STARTS = [2, 3]
+
+
+def make_stages():
+    return [sig_proc.LowPassFilter(1.2), sig_proc.DoGFilter(0.5, 2.5),
+            sig_proc.Threshold(0), MeanValueTaker()]
+
+
+def test_handoff_slot_keeps_newest_value():
+    slot = HandoffSlot()
+    assert(slot.take_latest() is None)
+    first = np.zeros(4)
+    slot.put(first, 'first')
+    slot.put(np.ones(4), 'second')
+    # The slot holds its own copy
+    first[:] = 5
+    value, tag = slot.take()
+    assert(tag == 'second')
+    np.testing.assert_array_equal(np.ones(4), value)
+    assert(slot.values_dropped == 1)
+    assert(slot.take(timeout_s=0.01) is None)
+    assert(slot.take_latest()[1] == 'second')
+    slot.close()
+    assert(slot.take() is None)
+
+
+def test_pipelined_results_match_sequential_decode():
+    rng = np.random.default_rng(0)
+    frames = rng.uniform(0, 100, size=(5, 64, 64))
+    sequential = DecoderPipeline(make_stages())
+    expected = [sequential.decode(frame) for frame in frames]
+
+    pipeline = DecoderPipeline(make_stages(), fuse_linear_stages=True, segment_starts=SEGMENT_STARTS)
+    decoder = PipelinedDecoder(pipeline, SEGMENT_STARTS)
+    for frame, expected_result in zip(frames, expected):
+        # Results lag behind submissions, so keep submitting until this frame comes out
+        deadline = time.perf_counter() + 5.0
+        while decoder.decode(frame) != pytest.approx(expected_result):
+            assert(time.perf_counter() < deadline)
+            time.sleep(0.001)
+    decoder.close()
+
+    summary = decoder.segment_timings.summary()
+    assert(list(summary.keys()) == ['stages 0-1', 'stages 2-2', 'stages 3-3', 'submission to result'])
+    assert(decoder.stage_timings.counts.sum() > 0)
+
+
+def test_segment_errors_reach_the_caller():
+    class Failing:
+        def process(self, raw_input):
+            raise ValueError("bad frame")
+
+    pipeline = DecoderPipeline([sig_proc.LowPassFilter(1.2), Failing()], segment_starts=[1])
+    decoder = PipelinedDecoder(pipeline, [1])
+    with pytest.raises(ValueError):
+        decoder.decode(np.zeros((16, 16)))
+    decoder.close()
+
+
+def test_instrumentation_rows_stay_aligned_when_frames_are_dropped():
+    rng = np.random.default_rng(0)
+    frames = rng.uniform(0, 100, size=(40, 64, 64))
+    pipeline = DecoderPipeline(make_stages(), instrumented_stages=[1, 2, 3],
+                               fuse_linear_stages=True, segment_starts=SEGMENT_STARTS)
+    decoder = PipelinedDecoder(pipeline, SEGMENT_STARTS)
+    # Submitting faster than the segments keep up drops frames between them
+    for frame in frames:
+        decoder.decode(frame)
+    time.sleep(0.2)
+    decoder.close()
+
+    timestamps, filtered, thresholded, commands = pipeline.instrumentation_history
+    assert(len(timestamps) == len(filtered) == len(thresholded) == len(commands) > 0)
+    # Every row holds the outputs of one frame
+    for filtered_frame, thresholded_frame, command in zip(filtered, thresholded, commands):
+        np.testing.assert_array_equal(np.maximum(filtered_frame, 0), thresholded_frame)
+        assert(command == pytest.approx(np.mean(thresholded_frame)))
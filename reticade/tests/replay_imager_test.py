@@ -0,0 +1,98 @@
+import pytest
+import queue
+import threading
+import time
+import numpy as np
+import tifffile
+from reticade.imaging_link import ImagingLink
+from reticade.sapv_link import ReplayImager
+
+TEST_IMAGE_DIMS = (32, 48)
+NUM_TEST_FRAMES = 10
+
+
+def make_recording():
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 4000, size=(NUM_TEST_FRAMES, TEST_IMAGE_DIMS[0], TEST_IMAGE_DIMS[1])).astype(np.uint16)
+
+
+def replay_and_read(recording_path, frame_rate_hz, duration_s, loop=True):
+    imager = ReplayImager(recording_path, frame_rate_hz=frame_rate_hz, loop=loop)
+    imaging_link = ImagingLink(TEST_IMAGE_DIMS)
+    imager.run_liveview(duration_s)
+    frame = np.copy(imaging_link.get_current_frame())
+    sequence_number = imaging_link.last_sequence_number
+    imaging_link.release_frame()
+    imaging_link.notify_socket.close()
+    imager.close()
+    return frame, sequence_number
+
+
+def test_replays_npy_in_order(tmp_path):
+    recording = make_recording()
+    recording_path = str(tmp_path / 'session.npy')
+    np.save(recording_path, recording)
+    frame, sequence_number = replay_and_read(recording_path, 50.0, 0.1, loop=False)
+    # Sequence numbers start at 1 and follow the recording, so frame n is recording[n - 1]
+    assert(3 <= sequence_number <= NUM_TEST_FRAMES)
+    np.testing.assert_array_equal(recording[sequence_number - 1], frame)
+
+
+def test_loops_tiff_stack(tmp_path):
+    recording = make_recording()
+    recording_path = str(tmp_path / 'session.tif')
+    tifffile.imwrite(recording_path, recording)
+    frame, sequence_number = replay_and_read(recording_path, 200.0, 0.2)
+    assert(sequence_number > NUM_TEST_FRAMES)
+    np.testing.assert_array_equal(
+        recording[(sequence_number - 1) % NUM_TEST_FRAMES], frame)
+
+
+def test_stops_at_end_without_loop(tmp_path):
+    recording = make_recording()
+    for i, image in enumerate(recording):
+        tifffile.imwrite(str(tmp_path / f"{i:03d}.tif"), image)
+    frame, sequence_number = replay_and_read(str(tmp_path), 500.0, 0.5, loop=False)
+    assert(sequence_number == NUM_TEST_FRAMES)
+    np.testing.assert_array_equal(recording[-1], frame)
+
+
+def test_prefetcher_stops_while_queue_is_full(tmp_path):
+    recording_path = str(tmp_path / 'session.npy')
+    np.save(recording_path, make_recording())
+    imager = ReplayImager(recording_path, loop=False)
+    imager.next_frame_idx = NUM_TEST_FRAMES
+    frame_queue = queue.Queue(maxsize=1)
+    frame_queue.put(np.zeros(TEST_IMAGE_DIMS))
+    stop_event = threading.Event()
+    prefetcher = threading.Thread(target=imager._prefetch, args=(frame_queue, stop_event))
+    prefetcher.start()
+    # Waiting to mark the end of the recording
+    stop_event.set()
+    prefetcher.join(timeout=1.0)
+    assert(not prefetcher.is_alive())
+    imager.close()
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_replay_ends_if_prefetcher_dies(tmp_path):
+    recording = make_recording()
+    recording_path = str(tmp_path / 'session.npy')
+    np.save(recording_path, recording)
+    imager = ReplayImager(recording_path, frame_rate_hz=100.0, loop=False)
+    read_frame = imager._read_frame
+
+    def unreadable_after_three(frame_idx):
+        if frame_idx >= 3:
+            raise IOError("unreadable frame")
+        return read_frame(frame_idx)
+    imager._read_frame = unreadable_after_three
+    imaging_link = ImagingLink(TEST_IMAGE_DIMS)
+    start = time.perf_counter()
+    imager.run_liveview(5.0)
+    assert(time.perf_counter() - start < 2.0)
+    np.testing.assert_array_equal(recording[2], imaging_link.get_current_frame())
+    assert(imaging_link.last_sequence_number == 3)
+    imaging_link.release_frame()
+    imaging_link.notify_socket.close()
+    imager.close()
@@ -0,0 +1,46 @@
+import pytest
+import numpy as np
+from reticade.decoder_harness import DecoderPipeline
+from reticade.decoding import sig_proc
+from reticade.decoding.roi_extraction import RoiExtractor
+
+
+def test_traces_subtract_neuropil_ring():
+    mask = np.zeros((15, 15), dtype=int)
+    mask[7, 7] = 4
+    # A second cell inside the first one's ring, whose pixel is left out of it
+    mask[5, 7] = 9
+    frame = np.random.default_rng(0).uniform(0, 100, size=mask.shape)
+    extractor = RoiExtractor(mask, neuropil_coefficient=0.5, neuropil_gap=1, neuropil_width=1)
+
+    # Pixels more than 1 and at most 2 away from (7, 7): the diagonals, and 2 along each axis
+    ring = [(6, 6), (6, 8), (8, 6), (8, 8), (9, 7), (7, 5), (7, 9)]
+    expected = frame[7, 7] - 0.5 * np.mean([frame[p] for p in ring])
+    traces = extractor.process(frame)
+    assert(traces.shape == (2,))
+    assert(traces[0] == pytest.approx(expected))
+
+
+def test_batches_match_frames():
+    rng = np.random.default_rng(0)
+    mask = rng.integers(0, 20, size=(32, 24)) * (rng.random((32, 24)) > 0.8)
+    frames = rng.normal(1000, 50, size=(4, 32, 24))
+    extractor = RoiExtractor(mask)
+    np.testing.assert_allclose([extractor.process(frame) for frame in frames], extractor.process_batch(frames))
+
+
+@pytest.mark.parametrize("sidecar", [True, False])
+def test_decoder_with_cell_traces_round_trips(tmp_path, sidecar):
+    rng = np.random.default_rng(0)
+    mask = np.zeros((64, 64), dtype=int)
+    for label in range(1, 30):
+        row, col = rng.integers(0, 60, size=2)
+        mask[row:row + 4, col:col + 4] = label
+    original = DecoderPipeline([RoiExtractor(mask), sig_proc.OutputScaler(0.5)])
+    decoder_path = str(tmp_path / "decoder.json")
+    original.to_json(decoder_path, sidecar=sidecar)
+
+    loaded = DecoderPipeline.from_json(decoder_path)
+    np.testing.assert_array_equal(mask, loaded.pipeline_stages[0].roi_mask)
+    frame = rng.normal(1000, 50, size=(64, 64))
+    np.testing.assert_allclose(original.decode(frame), loaded.decode(frame))
@@ -0,0 +1,73 @@
+import pytest
+import numpy as np
+from reticade.imaging_link import ImagingLink
+from reticade.sapv_link import StandaloneImager
+from reticade.win_imaging_link import SharedMemImagingLink
+from reticade.decoder_harness import DecoderPipeline
+from reticade.decoding.sig_proc import Downsampler, LowPassFilter
+from reticade.decoding.dummy_decoder import MeanValueTaker
+from reticade.tests.tools.fake_prairie_link import FakePrairieLink, NUM_SOURCE_FRAMES
+
+TEST_IMAGE_DIMS = (64, 64)
+TEST_FRAME_RATE_HZ = 60.0
+
+
+def matches_a_source_frame(fake_link, frame):
+    return any(np.array_equal(fake_link.expected_frame(i).astype(frame.dtype), frame)
+               for i in range(NUM_SOURCE_FRAMES))
+
+
+def test_standalone_imager_publishes_assembled_frames():
+    fake_link = FakePrairieLink(TEST_IMAGE_DIMS, frame_rate_hz=TEST_FRAME_RATE_HZ,
+                                chunk_size=5000)
+    imager = StandaloneImager(TEST_IMAGE_DIMS, prairie_link=fake_link)
+    imaging_link = ImagingLink(TEST_IMAGE_DIMS)
+    imager.run_liveview(0.5)
+    frame = imaging_link.get_current_frame()
+    assert(imaging_link.last_sequence_number >= 0.5 * TEST_FRAME_RATE_HZ / 2)
+    assert(matches_a_source_frame(fake_link, frame))
+    imaging_link.release_frame()
+    imaging_link.notify_socket.close()
+    imager.close()
+
+
+def test_dropped_data_is_reported():
+    fake_link = FakePrairieLink(TEST_IMAGE_DIMS, frame_rate_hz=TEST_FRAME_RATE_HZ,
+                                chunk_size=5000, drop_probability=0.2)
+    imager = StandaloneImager(TEST_IMAGE_DIMS, prairie_link=fake_link)
+    imager.run_liveview(0.2)
+    assert(fake_link.SendScriptCommands("-dd"))
+    imager.close()
+
+
+def test_shared_mem_imaging_link_assembles_frames():
+    fake_link = FakePrairieLink(TEST_IMAGE_DIMS, frame_rate_hz=TEST_FRAME_RATE_HZ,
+                                chunk_size=3000)
+    fake_link.SendScriptCommands("-lv on")
+    imaging = SharedMemImagingLink(2, TEST_IMAGE_DIMS, prairie_link=fake_link)
+    for _ in range(3):
+        assert(matches_a_source_frame(fake_link, imaging.get_current_frame()))
+    imaging.close()
+
+
+def test_preprocessing_runs_in_imaging_process(tmp_path):
+    decoder_path = str(tmp_path / "decoder.json")
+    DecoderPipeline([Downsampler((4, 4)), LowPassFilter(1.2), MeanValueTaker()],
+                    imaging_stages=2).to_json(decoder_path)
+    fake_link = FakePrairieLink(TEST_IMAGE_DIMS, frame_rate_hz=TEST_FRAME_RATE_HZ)
+    imager = StandaloneImager(TEST_IMAGE_DIMS, prairie_link=fake_link)
+    imager.load_preprocessing(decoder_path)
+    imaging_link = ImagingLink(TEST_IMAGE_DIMS)
+    imager.run_liveview(0.2)
+
+    frame = imaging_link.get_current_frame()
+    assert(frame.shape == (16, 16))
+    assert(imaging_link.last_stages_applied == 2)
+    decoder = DecoderPipeline.from_json(decoder_path)
+    reference = DecoderPipeline.from_json(decoder_path)
+    decoded = decoder.decode(frame, first_stage=2)
+    expected = [reference.decode(fake_link.expected_frame(i)) for i in range(NUM_SOURCE_FRAMES)]
+    assert(any(np.isclose(decoded, e) for e in expected))
+    imaging_link.release_frame()
+    imaging_link.notify_socket.close()
+    imager.close()
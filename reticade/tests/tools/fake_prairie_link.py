@@ -0,0 +1,119 @@
+import ctypes
+import time
+import numpy as np
+
+PRAIRIEVIEW_SAMPLE_OFFSET = 8192
+NUM_SOURCE_FRAMES = 4
+
+
+class FakePrairieLink:
+    """
+    A stand-in for the PrairieLink COM object, so that raw stream handling can
+    be tested and benchmarked without PrairieView. Once streaming and acquisition
+    have been started through script commands, it produces interleaved int16
+    samples at frame_rate_hz (cycling through a few random source frames) and
+    copies them to the requested address in chunks of at most chunk_size samples.
+    Each chunk is dropped with probability drop_probability, which is reported
+    through the '-dd' command as PrairieView does.
+    """
+
+    def __init__(self, image_size=(512, 512), samples_per_pixel=3, frame_rate_hz=30.0,
+                 chunk_size=None, drop_probability=0.0, seed=0):
+        self.image_size = image_size
+        self.samples_per_pixel = samples_per_pixel
+        self.frame_rate_hz = frame_rate_hz
+        self.num_samples_per_frame = image_size[0] * \
+            image_size[1] * samples_per_pixel
+        self.chunk_size = chunk_size if chunk_size else self.num_samples_per_frame
+        self.drop_probability = drop_probability
+        self.rng = np.random.default_rng(seed)
+        self.source_frames = self.rng.integers(
+            0, 2 * PRAIRIEVIEW_SAMPLE_OFFSET, size=(NUM_SOURCE_FRAMES, self.num_samples_per_frame), dtype=np.int16)
+
+        self.connected = False
+        self.streaming = False
+        self.acquiring = False
+        self.stream_start_time = 0.0
+        self.stream_position = 0
+        self.dropped_data = False
+        self.commands_received = []
+
+    def Connect(self):
+        self.connected = True
+
+    def Disconnect(self):
+        self.connected = False
+
+    def PixelsPerLine(self):
+        return self.image_size[0]
+
+    def LinesPerFrame(self):
+        return self.image_size[1]
+
+    def SamplesPerPixel(self):
+        return self.samples_per_pixel
+
+    def GetImage(self, channel_number):
+        return self.expected_frame(self.stream_position // self.num_samples_per_frame)
+
+    def SendScriptCommands(self, command):
+        self.commands_received.append(command)
+        if command.startswith('-srd True'):
+            self.streaming = True
+        elif command == '-srd False':
+            self.streaming = False
+        elif command in ['-ts', '-lv on']:
+            self._start_acquisition()
+        elif command == '-lv off':
+            self.acquiring = False
+        elif command == '-dd':
+            return self.dropped_data
+        return True
+
+    def _start_acquisition(self):
+        self.acquiring = True
+        self.stream_start_time = time.perf_counter()
+        self.stream_position = 0
+        self.dropped_data = False
+
+    def ReadRawDataStream_3(self, pid, address, num_samples_requested):
+        if not (self.streaming and self.acquiring):
+            return 0
+        elapsed_s = time.perf_counter() - self.stream_start_time
+        samples_acquired = int(
+            elapsed_s * self.frame_rate_hz * self.num_samples_per_frame)
+        num_samples = min(samples_acquired - self.stream_position,
+                          self.chunk_size, num_samples_requested, self.source_frames.size)
+        if num_samples <= 0:
+            return 0
+
+        start = self.stream_position
+        self.stream_position += num_samples
+        if self.drop_probability > 0 and self.rng.random() < self.drop_probability:
+            self.dropped_data = True
+            return 0
+
+        self._copy_stream_samples(address, start, num_samples)
+        return num_samples
+
+    def _copy_stream_samples(self, address, start, num_samples):
+        # The stream is the source frames repeated end to end
+        stream = self.source_frames.reshape(-1)
+        offset = start % len(stream)
+        first_part = min(num_samples, len(stream) - offset)
+        ctypes.memmove(address, stream[offset:].ctypes.data,
+                       first_part * stream.itemsize)
+        if first_part < num_samples:
+            ctypes.memmove(address + first_part * stream.itemsize, stream.ctypes.data,
+                           (num_samples - first_part) * stream.itemsize)
+
+    def expected_frame(self, frame_number):
+        """
+        The image that the nth frame in the stream should be assembled into.
+        """
+        samples = self.source_frames[frame_number % NUM_SOURCE_FRAMES].reshape(
+            (self.image_size[0], self.image_size[1], self.samples_per_pixel)).astype(np.int32)
+        samples = np.clip(samples - PRAIRIEVIEW_SAMPLE_OFFSET, 0, None)
+        frame = np.mean(samples, axis=2)
+        frame[1::2] = frame[1::2, ::-1]
+        return frame
@@ -1,24 +1,18 @@
-from multiprocessing import shared_memory
-import numpy as np
 import reticade.imaging_link as imlink
 
 
 class FakeStandalone:
     def __init__(self):
-        self.memory_block = None
-        self.shared_array = None
+        self.frame_ring = None
 
-    def open_sharedmem(self, image_dimensions):
-        # Note(charlie): frame count is hardcoded here
-        memsize = image_dimensions[0] * image_dimensions[1] * 8
-        self.memory_block = shared_memory.SharedMemory(
-            create=True, size=memsize, name=imlink.IMAGING_LINK_MEMSHARE_NAME)
-        self.shared_array = np.ndarray(
-            (512, 512), dtype=np.float64, buffer=self.memory_block.buf)
+    def open_sharedmem(self, image_dimensions, transport=imlink.DEFAULT_TRANSPORT):
+        self.frame_ring = imlink.FrameRingWriter(
+            image_dimensions, transport=transport)
 
     def write_sharedmem_contents(self, value):
-        assert(self.memory_block != None)
-        self.shared_array.fill(value)
+        assert(self.frame_ring != None)
+        self.frame_ring.begin_frame().fill(value)
+        return self.frame_ring.publish_frame()
 
     def close(self):
-        self.memory_block.close()
+        self.frame_ring.close()
@@ -16,6 +16,8 @@ MAX_POS_VALUE = 400.0
 MIN_LAP_VALUE = 50.0
 MIN_SAMPLES_PER_LAP = 20
 SAMPLE_RATE_HZ = 30
+# Frames are decoded this many at a time when training
+DECODE_BATCH_SIZE = 256
 
 REWARD_POSITION = 250.0
 REWARD_ZONE_WIDTH = 50.0
@@ -63,10 +65,11 @@ def train_decoder(path_in, withheld_fraction=0.0, cache_images=None):
 
     interim_harness = decoder_harness.DecoderPipeline([downsampler, low_pass])
     first_stage_out = []
-    for image_file in get_image_paths(path_in):
-        image = imread(image_file)
-        first_stage_out.append(interim_harness.decode(image))
-    first_stage_out = np.array(first_stage_out)
+    image_paths = get_image_paths(path_in)
+    for batch_start in range(0, len(image_paths), DECODE_BATCH_SIZE):
+        images = np.array([imread(image_file) for image_file in image_paths[batch_start:batch_start + DECODE_BATCH_SIZE]])
+        first_stage_out.append(interim_harness.decode_batch(images))
+    first_stage_out = np.concatenate(first_stage_out)
     reference_image = first_stage_out.mean(axis=0)
 
     motion = motion_correction.FlowMotionCorrection(reference_image)
@@ -79,11 +82,8 @@ def train_decoder(path_in, withheld_fraction=0.0, cache_images=None):
 
     interim_harness = decoder_harness.DecoderPipeline(
         [motion, delta, dog, threshold, second_downsampler, flat])
-    post_sig_proc = []
     print(f"[{(time.perf_counter() - start_time):.2f}s] Passing images through sigproc pipeline")
-    for image in first_stage_out:
-        post_sig_proc.append(interim_harness.decode(image))
-    post_sig_proc = np.array(post_sig_proc)
+    post_sig_proc = interim_harness.decode_batch(first_stage_out, batch_size=DECODE_BATCH_SIZE)
     if cache_images:
         with open(cache_images, 'wb') as file:
             np.save(file, post_sig_proc)
@@ -72,8 +72,8 @@ def create_flask_app(harness_pipe, imaging_pipe, udp_rx_pipe, shared_dict):
     @app.route('/load_decoder', methods=["POST"])
     def load_decoder():
         logging.info("UI Request: load decoder")
-        if shared_dict['harness_busy'] == True:
-            logging.warn("Harness is busy, ignoring request")
+        if shared_dict['harness_busy'] == True or shared_dict['imaging_busy'] == True:
+            logging.warn("ReTiCaDe is busy, ignoring request")
         else:
             decoder_name = request.form['decoderfile']
             instruction = (ProcessMessage.SEND_LOAD_DECODER, decoder_name)
@@ -81,6 +81,11 @@ def create_flask_app(harness_pipe, imaging_pipe, udp_rx_pipe, shared_dict):
             done = harness_pipe.recv()
             if done != ProcessMessage.ACK_LOAD_DECODER:
                 logging.error(f"Expected ACK_LOAD_DECODER, received: {done}")
+            # The imaging process runs any stages the decoder marks as imaging_stages
+            imaging_pipe.send(instruction)
+            done = imaging_pipe.recv()
+            if done != ProcessMessage.ACK_LOAD_DECODER:
+                logging.error(f"Expected ACK_LOAD_DECODER, received: {done}")
         return redirect(url_for('index'))
 
 
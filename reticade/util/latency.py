@@ -0,0 +1,107 @@
+import numpy as np
+import logging
+
+INITIAL_CAPACITY = 4096
+PERCENTILES = [50, 99]
+
+# Note: timestamps come from time.perf_counter_ns, which is a system-wide
+# monotonic clock on Windows and Linux, so acquisition times stamped in the
+# imaging process can be compared directly with times in the harness.
+
+
+class LatencyRecorder:
+    """
+    Records, for every tick, how old the frame was when decoding started,
+    how long decoding took, and how long it then took to send the command,
+    as well as whether the decoder had to fall back to degraded stages.
+    Storage is preallocated and grows by doubling, so recording is cheap.
+    """
+
+    def __init__(self, initial_capacity=INITIAL_CAPACITY):
+        self.initial_capacity = initial_capacity
+        self.reset()
+
+    def reset(self):
+        self.num_ticks = 0
+        self.sequence_numbers = np.full(self.initial_capacity, -1, dtype=np.int64)
+        # Seconds. Frame age is NaN when the frame had no acquisition time (e.g. autopilot)
+        self.frame_age_s = np.zeros(self.initial_capacity)
+        self.decode_s = np.zeros(self.initial_capacity)
+        self.send_s = np.zeros(self.initial_capacity)
+        self.degraded = np.zeros(self.initial_capacity, dtype=bool)
+        self.last_sequence_number = None
+        self.skipped_sequence_numbers = 0
+        self.repeated_sequence_numbers = 0
+
+    def _grow(self):
+        self.sequence_numbers = np.concatenate(
+            [self.sequence_numbers, np.full(len(self.sequence_numbers), -1, dtype=np.int64)])
+        self.frame_age_s = np.concatenate(
+            [self.frame_age_s, np.zeros(len(self.frame_age_s))])
+        self.decode_s = np.concatenate(
+            [self.decode_s, np.zeros(len(self.decode_s))])
+        self.send_s = np.concatenate([self.send_s, np.zeros(len(self.send_s))])
+        self.degraded = np.concatenate(
+            [self.degraded, np.zeros(len(self.degraded), dtype=bool)])
+
+    def record(self, sequence_number, acquisition_ns, decode_start_ns, decode_end_ns, send_end_ns, degraded=False):
+        if self.num_ticks == len(self.sequence_numbers):
+            self._grow()
+        i = self.num_ticks
+        if acquisition_ns:
+            self.frame_age_s[i] = (decode_start_ns - acquisition_ns) * 1e-9
+        else:
+            self.frame_age_s[i] = np.nan
+        self.decode_s[i] = (decode_end_ns - decode_start_ns) * 1e-9
+        self.send_s[i] = (send_end_ns - decode_end_ns) * 1e-9
+        self.degraded[i] = degraded
+        self.num_ticks += 1
+
+        if sequence_number is None:
+            return
+        self.sequence_numbers[i] = sequence_number
+        if self.last_sequence_number is not None:
+            if sequence_number == self.last_sequence_number:
+                self.repeated_sequence_numbers += 1
+            elif sequence_number > self.last_sequence_number + 1:
+                self.skipped_sequence_numbers += sequence_number - self.last_sequence_number - 1
+        self.last_sequence_number = sequence_number
+
+    def summary(self):
+        """
+        Returns {metric: (p50, p99, max)} in seconds, plus sequence number statistics.
+        """
+        result = {}
+        for name, values in [('frame_age', self.frame_age_s), ('decode', self.decode_s),
+                             ('send', self.send_s)]:
+            values = values[:self.num_ticks]
+            values = values[~np.isnan(values)]
+            if values.size == 0:
+                continue
+            result[name] = tuple(np.percentile(values, PERCENTILES)) + (np.max(values),)
+        result['ticks'] = self.num_ticks
+        result['degraded_ticks'] = int(np.count_nonzero(self.degraded[:self.num_ticks]))
+        result['skipped_sequence_numbers'] = self.skipped_sequence_numbers
+        result['repeated_sequence_numbers'] = self.repeated_sequence_numbers
+        return result
+
+    def log_summary(self):
+        summary = self.summary()
+        logging.info(
+            f"Latency over {summary['ticks']} ticks (ms) [p50, p99, max]:")
+        for name in ['frame_age', 'decode', 'send']:
+            if name in summary:
+                p50, p99, worst = summary[name]
+                logging.info(
+                    f"  {name}: {(p50 * 1000):.2f}, {(p99 * 1000):.2f}, {(worst * 1000):.2f}")
+        logging.info(
+            f"  Frames skipped: {summary['skipped_sequence_numbers']}. Frames decoded more than once: {summary['repeated_sequence_numbers']}")
+        if summary['degraded_ticks'] > 0:
+            logging.warn(
+                f"  Frames decoded with degraded stages to meet their deadline: {summary['degraded_ticks']}")
+
+    def as_array(self):
+        # Columns: sequence number, frame age, decode time, send time, degraded (0 or 1)
+        n = self.num_ticks
+        return np.stack([self.sequence_numbers[:n].astype(np.float64), self.frame_age_s[:n],
+                         self.decode_s[:n], self.send_s[:n], self.degraded[:n].astype(np.float64)], axis=1)
@@ -1,5 +1,9 @@
+import os
 import pickle
 import base64
+import contextlib
+import tempfile
+import numpy as np
 
 """
 Note: this is a quick-and-dirty way of storing arbitrary objects in the json
@@ -7,13 +11,117 @@ serialisation. It's not robust and we should prefer reconstructing from
 constructor parameters, but is useful for saving opaque classes like scikit
 learn models.
 It can be temporarily (grossly) misused to store things like reference image data.
+
+While a sidecar file is open (see writing_sidecar and reading_sidecar), objects
+are stored in it instead: the JSON only holds a reference, and the object's
+arrays are written as raw, aligned bytes that are memory-mapped back on load
+rather than base64 decoded and copied.
 """
+
+# Arrays in the sidecar start on cache line boundaries
+SIDECAR_ALIGNMENT = 64
+
+_sidecar_writer = None
+_sidecar_reader = None
+
+
 def obj_to_picklestring(obj_to_save):
+    if _sidecar_writer is not None:
+        return _sidecar_writer.add(obj_to_save)
     raw = pickle.dumps(obj_to_save)
     # Omit the b'' indicators in string representation
     as_string = str(base64.b64encode(raw))[2:-1]
     return as_string
 
+
 def obj_from_picklestring(obj_to_extract):
+    if isinstance(obj_to_extract, dict):
+        if _sidecar_reader is None:
+            raise ValueError("This object is stored in a sidecar file, which isn't open")
+        return _sidecar_reader.load(obj_to_extract)
     as_bytes = base64.b64decode(obj_to_extract.encode('utf-8'))
-    return pickle.loads(as_bytes)
\ No newline at end of file
+    return pickle.loads(as_bytes)
+
+
+class SidecarWriter:
+    """
+    Appends pickled objects to a raw binary file. Each object is pickled with
+    protocol 5, so its numpy arrays are kept out of band and written as they are.
+    """
+
+    def __init__(self, path):
+        # Written alongside and moved into place on close, since objects being saved
+        # may still be mapped from the file at path (e.g. re-saving a loaded decoder)
+        self.path = path
+        descriptor, self.temporary_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        self.file = os.fdopen(descriptor, 'wb')
+        self.offset = 0
+
+    def _write(self, data):
+        padding = -self.offset % SIDECAR_ALIGNMENT
+        self.file.write(bytes(padding))
+        start = self.offset + padding
+        length = memoryview(data).nbytes
+        self.file.write(data)
+        self.offset = start + length
+        return [start, length]
+
+    def add(self, obj):
+        buffers = []
+        stream = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+        return {'sidecar_pickle': self._write(stream),
+                'sidecar_buffers': [self._write(b.raw()) for b in buffers]}
+
+    def close(self):
+        self.file.close()
+        os.replace(self.temporary_path, self.path)
+
+    def discard(self):
+        self.file.close()
+        os.remove(self.temporary_path)
+
+
+class SidecarReader:
+    """
+    Loads objects written by SidecarWriter. The file is memory-mapped copy-on-write,
+    so arrays are read from disk as they're used, and can still be modified in
+    memory without changing the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Mapped on first use, since decoders with nothing to pickle leave the file empty
+        self.data = None
+
+    def load(self, reference):
+        if self.data is None:
+            self.data = np.memmap(self.path, dtype=np.uint8, mode='c')
+        start, length = reference['sidecar_pickle']
+        buffers = [self.data[start:start + length] for start, length in reference['sidecar_buffers']]
+        return pickle.loads(self.data[start:start + length], buffers=buffers)
+
+
+@contextlib.contextmanager
+def writing_sidecar(path):
+    global _sidecar_writer
+    _sidecar_writer = SidecarWriter(path)
+    try:
+        yield _sidecar_writer
+    except BaseException:
+        _sidecar_writer.discard()
+        raise
+    else:
+        _sidecar_writer.close()
+    finally:
+        _sidecar_writer = None
+
+
+@contextlib.contextmanager
+def reading_sidecar(path):
+    global _sidecar_reader
+    _sidecar_reader = SidecarReader(path)
+    try:
+        yield _sidecar_reader
+    finally:
+        _sidecar_reader = None
@@ -0,0 +1,107 @@
+import numpy as np
+import logging
+import math
+
+# Buckets are spaced logarithmically, four to every doubling, from 1 us up to
+# about 17 s, so each holds times within ~19% of each other. The first bucket
+# holds anything faster than 1 us and the last anything slower than 17 s.
+SMALLEST_BUCKET_NS = 1000
+BUCKETS_PER_DOUBLING = 4
+NUM_BUCKETS = 2 + 24 * BUCKETS_PER_DOUBLING
+PERCENTILES = [50, 99]
+
+
+def bucket_upper_edges_ns():
+    edges = SMALLEST_BUCKET_NS * \
+        np.power(2.0, np.arange(NUM_BUCKETS) / BUCKETS_PER_DOUBLING)
+    edges[-1] = np.inf
+    return edges
+
+
+def load_stage_timings(in_file):
+    """
+    Returns {stage name: (bucket upper edges in seconds, counts)} from a file
+    written by StageTimings.save.
+    """
+    contents = np.load(in_file)
+    edges_s = contents['bucket_upper_edges_s']
+    return {str(name): (edges_s, counts) for name, counts in zip(contents['stage_names'], contents['counts'])}
+
+
+class StageTimings:
+    """
+    Keeps a histogram of how long each stage of a decoder takes. The histograms
+    have a fixed number of buckets, so they can stay on for a whole run and
+    recording a time costs about the same as reading the clock.
+    Percentiles are read from the buckets, so they're only as precise as a bucket.
+    """
+
+    def __init__(self, stage_names):
+        self.stage_names = stage_names
+        self.bucket_upper_edges_ns = bucket_upper_edges_ns()
+        self.reset()
+
+    def reset(self):
+        num_stages = len(self.stage_names)
+        self.counts = np.zeros((num_stages, NUM_BUCKETS), dtype=np.int64)
+        self.max_ns = [0 for _ in range(num_stages)]
+        # Slowest time per stage since the last call to take_interval_max
+        self.interval_max_ns = [0 for _ in range(num_stages)]
+
+    def record(self, stage_idx, duration_ns):
+        if duration_ns < SMALLEST_BUCKET_NS:
+            bucket = 0
+        else:
+            bucket = min(NUM_BUCKETS - 1, 1 + int(math.log2(duration_ns /
+                         SMALLEST_BUCKET_NS) * BUCKETS_PER_DOUBLING))
+        self.counts[stage_idx, bucket] += 1
+        if duration_ns > self.max_ns[stage_idx]:
+            self.max_ns[stage_idx] = duration_ns
+        if duration_ns > self.interval_max_ns[stage_idx]:
+            self.interval_max_ns[stage_idx] = duration_ns
+
+    def take_interval_max(self):
+        """
+        Returns (stage name, seconds) for the slowest stage since the last call,
+        or None if nothing was recorded.
+        """
+        slowest = int(np.argmax(self.interval_max_ns)) if self.stage_names else 0
+        if not self.stage_names or self.interval_max_ns[slowest] == 0:
+            return None
+        result = (self.stage_names[slowest], self.interval_max_ns[slowest] * 1e-9)
+        self.interval_max_ns = [0 for _ in self.stage_names]
+        return result
+
+    def percentile(self, stage_idx, q):
+        # The upper edge of the bucket holding the qth percentile, capped at the slowest time
+        counts = self.counts[stage_idx]
+        total = counts.sum()
+        if total == 0:
+            return np.nan
+        bucket = int(np.searchsorted(np.cumsum(counts), q / 100 * total))
+        return min(self.bucket_upper_edges_ns[bucket], self.max_ns[stage_idx]) * 1e-9
+
+    def summary(self):
+        """
+        Returns {stage name: (p50, p99, max)} in seconds, for stages that have run.
+        """
+        result = {}
+        for i, name in enumerate(self.stage_names):
+            if self.counts[i].sum() == 0:
+                continue
+            result[name] = tuple(self.percentile(i, q)
+                                 for q in PERCENTILES) + (self.max_ns[i] * 1e-9,)
+        return result
+
+    def log_summary(self):
+        summary = self.summary()
+        if not summary:
+            return
+        printable = ", ".join([f"{name} {(p50 * 1000):.2f}/{(p99 * 1000):.2f}/{(worst * 1000):.2f}"
+                               for name, (p50, p99, worst) in summary.items()])
+        logging.info(f"Stage times (ms) [p50/p99/max]: {printable}")
+
+    def save(self, out_file):
+        np.savez(out_file, stage_names=np.array(self.stage_names), counts=self.counts,
+                 bucket_upper_edges_s=self.bucket_upper_edges_ns * 1e-9)
+        logging.info(f"Wrote per-stage timings to {out_file}")
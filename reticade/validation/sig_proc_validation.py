@@ -1,5 +1,6 @@
 import sys
 import os
+from reticade.decoder_harness import DecoderPipeline
 from reticade.decoding import sig_proc
 from reticade.decoding import motion_correction
 from matplotlib.pyplot import imread
@@ -23,16 +24,9 @@ def get_image_paths(image_path):
     return all_images
 
 def get_intermediate_ims(path, stages):
-    results = []
-    for i, image_file in enumerate(get_image_paths(path)):
-        if i > NUM_FRAMES_TO_VIEW:
-            break
-        image = imread(image_file)
-        last_val = image
-        for j, stage in enumerate(stages):
-            last_val = stage.process(last_val)
-        results.append(last_val)
-    return np.array(results)
+    image_paths = get_image_paths(path)[:NUM_FRAMES_TO_VIEW + 1]
+    images = np.array([imread(image_file) for image_file in image_paths])
+    return DecoderPipeline(stages).decode_batch(images)
 
 path_in = sys.argv[1]
 save_file = None
@@ -1,9 +1,13 @@
 import numpy as np
-import win32com.client
 from multiprocessing import shared_memory
 import logging
 import os
 import ctypes
+import time
+import platform
+if platform.system() == 'Windows':
+    import win32com.client
+from reticade.frame_assembly import RawFrameAssembler
 
 
 """
@@ -24,6 +28,10 @@ class ImagingLink:
         channel_image = self.prairie_link.GetImage(self.channel_number)
         return np.array(channel_image).astype(np.float64)
 
+    def release_frame(self):
+        # Frames are always fresh arrays, so there's nothing to hand back
+        pass
+
     def close(self):
         self.prairie_link.Disconnect()
 
@@ -34,10 +42,13 @@ is tightly coupled to PrairieView version 5.6's handling of raw data streams,
 and makes use of some tricky workarounds to correctly marshall the data.
 """
 class SharedMemImagingLink:
-    def __init__(self, channel_number, image_size=(512, 512)):
+    def __init__(self, channel_number, image_size=(512, 512), prairie_link=None):
         self.channel_number = channel_number
         self.image_size = image_size
-        self.prairie_link = win32com.client.Dispatch("PrairieLink.Application")
+        # A stand-in for PrairieLink can be supplied for testing (see tests/tools/fake_prairie_link.py)
+        if prairie_link is None:
+            prairie_link = win32com.client.Dispatch("PrairieLink.Application")
+        self.prairie_link = prairie_link
         self.prairie_link.Connect()
 
         # Check that the image dimensions are as expected
@@ -85,56 +96,31 @@ class SharedMemImagingLink:
         buf = Buffer.from_buffer(self.memory_block.buf)
         self.sharedmem_addr = ctypes.addressof(buf)
 
-        self.data_layout = (
-            image_size[0], image_size[1], self.pview_samples_per_pixel)
-
-        self.mem_offset = 0
-        self.frame_idx = 0
-        self.frame_storage = [np.ndarray(
-            self.num_samples_per_frame, dtype=np.int16) for _ in range(2)]
+        self.frame_assembler = RawFrameAssembler(
+            image_size, self.pview_samples_per_pixel)
+        self.output_frame = np.zeros(image_size, dtype=np.float64)
+        self.last_sequence_number = 0
+        self.last_timestamp_ns = 0
 
     def get_current_frame(self):
         waiting_for_new_frame = True
         while waiting_for_new_frame:
             num_samples_written = self._send_prairieview_rrd()
-            samples_copied = 0
-            while (samples_copied < num_samples_written):
-                samples_to_read = min(num_samples_written - samples_copied,
-                                      self.num_samples_per_frame - self.mem_offset)
-
-                self.frame_storage[self.frame_idx][self.mem_offset:self.mem_offset +
-                                                   samples_to_read] = self.shared_array[samples_copied:samples_copied + samples_to_read]
-
-                if samples_to_read == self.num_samples_per_frame - self.mem_offset:
-                    # we've got a complete frame, so swap current frame and pending frame
-                    waiting_for_new_frame = False
-                    self.frame_idx = (self.frame_idx + 1) % 2
-
-                self.mem_offset = (
-                    self.mem_offset + samples_to_read) % self.num_samples_per_frame
-                samples_copied += samples_to_read
-
-        reshaped = self.frame_storage[(
-            self.frame_idx + 1) % 2].reshape(self.data_layout)
-
-        # Note(charlie): this subtraction of 8192 is at the suggestion of the 
-        # PrairieView engineer to duplicate their behaviour. It needs validating.
-        reshaped = reshaped - 8192
-        reshaped[reshaped < 0] = 0
-        mean_over_samples = np.mean(reshaped, axis=2)
-        return self._unraster_image(mean_over_samples)
+            waiting_for_new_frame = not self.frame_assembler.add_samples(
+                self.shared_array[:num_samples_written])
+        self.last_timestamp_ns = time.perf_counter_ns()
+        self.last_sequence_number = self.frame_assembler.frames_completed
+        # Note: the output is reused, so it's only valid until the next frame is requested
+        return self.frame_assembler.assemble_into(self.output_frame)
 
     def _send_prairieview_rrd(self):
         num_samples_written = self.prairie_link.ReadRawDataStream_3(
             self.pid, self.sharedmem_addr, self.num_samples_to_request)
         return num_samples_written
 
-    # Note: this will mutate an underlying image, it's indended for use
-    # on the post-mean image and *not* the shared underlying data
-    def _unraster_image(self, frame):
-        assert(frame.shape == self.image_size)
-        frame[1::2] = frame[1::2, ::-1]
-        return frame
+    def release_frame(self):
+        # The frame is handed over before the next one is requested, so there's nothing to do
+        pass
 
     def close(self):
         success = self.prairie_link.SendScriptCommands('-srd False')